@@ -0,0 +1,258 @@
+"""
+benchmark.py replays traffic against a real capoeira site, backed by local stand-ins for last.fm, songkick and memcache,
+and reports latency percentiles, throughput and upstream calls for each cache scenario as JSON, so that runs can be
+compared:
+
+    python benchmark.py --requests 500 --concurrency 20 --latency 0.05 --output before.json
+
+Traffic is either generated from --seed, with artists picked from a long-tailed distribution, or replayed from a file
+of JSON lines like {"path": "/capoeira/events/similar/artist", "args": {"artist": "Artist 12", "location": "London"}}.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import sys
+import urllib
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
+from twisted.internet.task import deferLater
+from twisted.web.server import Site
+
+from capoeira.cache import LRUCache, TieredCache
+from capoeira.calendar import MetroCalendarIndex
+from capoeira.capoeira import CapoeiraAPIService, CapoeiraResource
+from capoeira.eventstore import EventStore
+from capoeira.httpclient import PooledHTTPClient
+from capoeira.lastfm import LastFMAPIService
+from capoeira.memcacheclient import AsyncMemcacheClient
+from capoeira.metroindex import MetroAreaIndex
+from capoeira.mocks import FakeLastFMResource, FakeSongkickResource, MemcacheServerFactory, fakeArtistName
+from capoeira.songkick import SongkickAPIService
+
+SCENARIOS = ['cold', 'warm', 'memcache-down']
+LOCATIONS = ['London', 'Los Angeles', 'Berlin', 'New York', 'Tokyo']
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Benchmark capoeira against local upstream stand-ins")
+    parser.add_argument('--requests', type=int, default=200, help="requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=10, help="requests in flight at once")
+    parser.add_argument('--latency', type=float, default=0.02, help="upstream response time, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of upstream calls which fail")
+    parser.add_argument('--similar-artists', type=int, default=100, help="artists per last.fm similar response")
+    parser.add_argument('--events-per-artist', type=int, default=3, help="upcoming events per artist")
+    parser.add_argument('--artist-pool', type=int, default=5000, help="distinct artists upstream")
+    parser.add_argument('--events-mode', choices=['fanout', 'calendar'], default='fanout')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help="keep the production upstream rate limits, rather than measuring capoeira alone")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="comma separated, from " + ', '.join(SCENARIOS))
+    parser.add_argument('--traffic', help="JSON lines file of requests to replay instead of generated traffic")
+    parser.add_argument('--save-traffic', help="write the traffic used to this file, for replaying later")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the report here rather than to stdout")
+    return parser.parse_args(argv)
+
+
+def generateTraffic(count, poolSize, seed):
+    """
+    generateTraffic returns count artist queries, a few popular artists making up most of them, like real traffic
+    """
+    rng = random.Random(seed)
+    traffic = []
+    for _ in range(count):
+        index = int(rng.paretovariate(1.2)) % poolSize
+        traffic.append({'path': '/capoeira/events/similar/artist',
+                        'args': {'artist': fakeArtistName(index), 'location': rng.choice(LOCATIONS)}})
+    return traffic
+
+
+def loadTraffic(path):
+    with open(path) as trafficFile:
+        return [json.loads(line) for line in trafficFile if line.strip()]
+
+
+def percentile(values, fraction):
+    """
+    percentile returns the nearest-rank percentile of values, which must be sorted
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {'p50': percentile(latencies, 0.5) * 1000,
+            'p95': percentile(latencies, 0.95) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': latencies[-1] * 1000,
+            'mean': sum(latencies) / len(latencies) * 1000}
+
+
+class Upstreams(object):
+    """
+    Upstreams runs the stand-ins for last.fm, songkick and memcache on local ports for the length of a benchmark
+    """
+
+    def __init__(self, options):
+        self.lastfm = FakeLastFMResource(similarArtists=options.similar_artists, latency=options.latency,
+                                         errorRate=options.error_rate, poolSize=options.artist_pool, seed=options.seed)
+        self.songkick = FakeSongkickResource(eventsPerArtist=options.events_per_artist, latency=options.latency,
+                                             errorRate=options.error_rate, poolSize=options.artist_pool,
+                                             seed=options.seed)
+        self.memcache = MemcacheServerFactory()
+        self.ports = [reactor.listenTCP(0, Site(self.lastfm), interface='127.0.0.1'),
+                      reactor.listenTCP(0, Site(self.songkick), interface='127.0.0.1'),
+                      reactor.listenTCP(0, self.memcache, interface='127.0.0.1')]
+        self.lastfmRoot = 'http://127.0.0.1:{}/2.0'.format(self.ports[0].getHost().port)
+        self.songkickRoot = 'http://127.0.0.1:{}/api/3.0'.format(self.ports[1].getHost().port)
+        self.memcachePort = self.ports[2].getHost().port
+
+    def counts(self):
+        return {'lastfm': self.lastfm.calls, 'songkick': self.songkick.calls,
+                'lastfm_errors': self.lastfm.errors, 'songkick_errors': self.songkick.errors}
+
+    def stop(self):
+        return DeferredList([port.stopListening() for port in self.ports])
+
+
+class Stack(object):
+    """
+    Stack is a freshly built capoeira site, with empty caches, serving on a local port
+    """
+
+    def __init__(self, options, upstreams, memcachePort):
+        self.memcache = AsyncMemcacheClient('127.0.0.1', memcachePort).connect()
+        cache = TieredCache(LRUCache(), self.memcache)
+        self.httpClient = PooledHTTPClient(maxPerHost=max(20, options.concurrency))
+        lastfm = LastFMAPIService('benchmark', apiRoot=upstreams.lastfmRoot, memcacheClient=cache,
+                                  httpClient=self.httpClient)
+        songkick = SongkickAPIService('benchmark', apiRoot=upstreams.songkickRoot, memcacheClient=cache,
+                                      httpClient=self.httpClient)
+        if not options.rate_limits:
+            lastfm.scheduler.requestRate = songkick.scheduler.requestRate = None
+        calendarIndex = MetroCalendarIndex(songkick) if options.events_mode == 'calendar' else None
+        service = CapoeiraAPIService(lastfm, songkick, metroIndex=MetroAreaIndex(), calendarIndex=calendarIndex,
+                                     eventStore=EventStore(), memcacheClient=cache, httpClient=self.httpClient)
+        self.port = reactor.listenTCP(0, Site(CapoeiraResource(service)), interface='127.0.0.1')
+        self.root = 'http://127.0.0.1:{}'.format(self.port.getHost().port)
+
+    @inlineCallbacks
+    def waitForMemcache(self, timeout=2):
+        for _ in range(int(timeout / 0.05)):
+            if self.memcache.protocol is not None:
+                break
+            yield deferLater(reactor, 0.05, lambda: None)
+
+    def stop(self):
+        self.memcache.disconnect()
+        self.httpClient.close()
+        return self.port.stopListening()
+
+
+@inlineCallbacks
+def replay(root, traffic, concurrency):
+    """
+    replay sends traffic to the site at root, concurrency requests at a time, and returns the latency of every
+    successful request, the number of failures, and how long it all took
+    """
+    client = PooledHTTPClient(maxPerHost=concurrency, readTimeout=60)
+    queue = iter(traffic)
+    latencies = []
+    errors = []
+
+    @inlineCallbacks
+    def worker():
+        for entry in queue:
+            url = root + entry['path'] + '?' + urllib.urlencode(entry.get('args', {}))
+            start = reactor.seconds()
+            try:
+                yield client.getPage(url)
+            except Exception as e:
+                errors.append(e)
+            else:
+                latencies.append(reactor.seconds() - start)
+
+    start = reactor.seconds()
+    yield DeferredList([worker() for _ in range(concurrency)])
+    duration = reactor.seconds() - start
+    yield client.close()
+    returnValue((latencies, len(errors), duration))
+
+
+@inlineCallbacks
+def runScenario(name, options, upstreams, traffic):
+    if name == 'memcache-down':
+        # a port nothing is listening on any more
+        closed = reactor.listenTCP(0, MemcacheServerFactory(), interface='127.0.0.1')
+        memcachePort = closed.getHost().port
+        yield closed.stopListening()
+    else:
+        upstreams.memcache.store.clear()
+        memcachePort = upstreams.memcachePort
+    stack = Stack(options, upstreams, memcachePort)
+    if name != 'memcache-down':
+        yield stack.waitForMemcache()
+    if name == 'warm':
+        yield replay(stack.root, traffic, options.concurrency)
+
+    before = upstreams.counts()
+    latencies, errors, duration = yield replay(stack.root, traffic, options.concurrency)
+    after = upstreams.counts()
+    yield stack.stop()
+    returnValue({'scenario': name,
+                 'requests': len(traffic),
+                 'errors': errors,
+                 'duration_s': duration,
+                 'throughput_rps': len(traffic) / duration if duration else None,
+                 'latency_ms': summarize(latencies),
+                 'upstream_calls': dict((key, after[key] - before[key]) for key in after)})
+
+
+@inlineCallbacks
+def benchmark(options):
+    if options.traffic:
+        traffic = loadTraffic(options.traffic)
+    else:
+        traffic = generateTraffic(options.requests, options.artist_pool, options.seed)
+    if options.save_traffic:
+        with open(options.save_traffic, 'w') as trafficFile:
+            for entry in traffic:
+                trafficFile.write(json.dumps(entry) + '\n')
+
+    upstreams = Upstreams(options)
+    results = []
+    for name in options.scenarios.split(','):
+        if name not in SCENARIOS:
+            raise ValueError("Unknown scenario {}".format(name))
+        results.append((yield runScenario(name, options, upstreams, traffic)))
+    yield upstreams.stop()
+    returnValue({'config': vars(options), 'scenarios': results})
+
+
+def main(argv=None):
+    options = parseArgs(sys.argv[1:] if argv is None else argv)
+    report = {}
+
+    def run():
+        d = benchmark(options)
+        d.addCallback(report.update)
+        d.addErrback(lambda failure: report.update(error=failure.getTraceback()))
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    return 1 if 'error' in report else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
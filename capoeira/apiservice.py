@@ -1,37 +1,224 @@
 from copy import copy
+import hashlib
 import json
-from urllib import urlencode
+from urllib import unquote_plus, urlencode
 from twisted.application import service
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, fail, maybeDeferred, succeed
 from twisted.python import log
-from twisted.web.client import getPage
+from twisted.python.failure import Failure
+from twisted.web.error import Error
+
+from breaker import CircuitBreaker, CircuitOpenError
+from cache import packEntry, unpackEntry
+from codec import NEGATIVE, decodeValue, encodeValue, project
+from httpclient import sharedHTTPClient
+from metrics import upstreamInFlight, upstreamLatency, upstreamRequests
+from scheduler import QueryScheduler
+from singleflight import SingleFlight
+from util import nameKey
 
 
 class APIService(service.Service):
     enableCache = False
+    enableMemcache = False
+    # upstream call limits, overridden per API and per instance
+    maxConcurrent = 50
+    requestRate = None
+    requestBurst = None
+    # cache TTLs in seconds for API calls which don't set their own with _ttl / _softTTL parameters. Entries older than
+    # the soft TTL are still served, but refreshed in the background; entries older than the (hard) TTL are gone
+    defaultTTL = 60 * 60
+    defaultSoftTTL = None
+    # background refreshes queue behind queries someone is waiting on
+    refreshPriority = 10000
+    # cached responses bigger than this many bytes, once projected and encoded, are compressed
+    compressAbove = 1024
+    # how long in seconds to remember that a query failed, so that it's answered straight away rather than retried
+    # upstream on every request, and how long to keep error responses from the API itself
+    negativeTTL = 30
+    errorTTL = 5 * 60
+    # names this API's circuit breaker, which stops calls after this many upstream failures in a row; unnamed breakers
+    # aren't exported
+    upstreamName = 'other'
+    breakerThreshold = 5
+    # call parameters which hold credentials, and are left out of cache keys, and ones which hold names, which are
+    # normalized in cache keys so that differently typed names share an entry
+    secretParams = ()
+    normalizedParams = ()
 
-    def __init__(self, memcacheClient=None):
+    def __init__(self, memcacheClient=None, httpClient=None, maxConcurrent=None, requestRate=None, requestBurst=None,
+                 clock=None):
         self.defaults = {}
+        self.clock = clock or reactor
+        self.httpClient = httpClient or sharedHTTPClient()
+        self.scheduler = QueryScheduler(maxConcurrent=maxConcurrent or self.maxConcurrent,
+                                        requestRate=requestRate or self.requestRate,
+                                        requestBurst=requestBurst or self.requestBurst,
+                                        clock=clock)
+        # identical queries made while one is already outstanding share its response
+        self.singleFlight = SingleFlight(self.upstreamName, promote=self.scheduler.promote)
+        self._refreshing = set()
+        self.breaker = CircuitBreaker(self.upstreamName, failureThreshold=self.breakerThreshold, clock=clock)
 
         if memcacheClient:
             self.cache = memcacheClient
             self.enableMemcache = True
 
-    def _addToCache(self, query, response):
+    def stopService(self):
+        service.Service.stopService(self)
+        return self.httpClient.close()
+
+    def _addToCache(self, query, response, ttl=0, softTTL=None):
         """
-        _addToCache adds k/v pair to memcache. TODO: configure TTL on cache entries
+        _addToCache adds k/v pair to the cache, expiring it after ttl seconds and marking it stale after softTTL seconds
         """
-        log.msg("adding {} to cache".format(query))
-        self.cache.add(query, response)
+        log.msg("adding {} to cache for {}s".format(query, ttl))
+        staleAt = self.clock.seconds() + (softTTL or ttl or 0)
+        self.cache.set(query, packEntry(response, staleAt), ttl)
         return response
 
+    def _cacheResponse(self, value, query, parameters):
+        ttl = parameters.get('_ttl', self.defaultTTL)
+        softTTL = parameters.get('_softTTL', self.defaultSoftTTL)
+        if self._isErrorResponse(value):
+            ttl, softTTL = min(ttl, self.errorTTL), None
+        self._addToCache(query, encodeValue(value, self.compressAbove), ttl, softTTL)
+        return value
+
+    def _cacheFailure(self, query):
+        """
+        _cacheFailure caches a negative entry for query, so that it isn't retried upstream for negativeTTL seconds
+        """
+        if self.enableMemcache:
+            self._addToCache(query, encodeValue(NEGATIVE), self.negativeTTL)
+
+    def _isErrorResponse(self, value):
+        """
+        _isErrorResponse tells whether a parsed response is the API reporting an error, overridden per API
+        """
+        return False
+
+    def _loadResponse(self, response, parameters):
+        """
+        _loadResponse parses an upstream response, keeping only the fields named by the call's _projection parameter
+        """
+        return project(json.loads(response), parameters.get('_projection', True))
+
+    def _decodeEntry(self, entry, query, parameters):
+        """
+        _decodeEntry returns the value held by a cache entry, or None if it can't be read and should be refetched
+        """
+        try:
+            return decodeValue(entry, parameters.get('_projection', True))
+        except ValueError as e:
+            log.msg("Ignoring cache entry for {}: {}".format(query, e))
+            return None
+
+    def _fetch(self, query, parameters, priority=None):
+        """
+        _fetch queues an upstream call for parameters, sharing any call already in flight for the same query key
+        """
+        if priority is None:
+            priority = parameters.get('_priority', 0)
+        if self.breaker.isOpen():
+            upstreamRequests.inc(endpoint=parameters.get('_endpoint', 'other'), outcome='rejected')
+            return fail(CircuitOpenError("The circuit to {} is open".format(self.upstreamName)))
+        return self.singleFlight.call(query, self.scheduler.submit, self._getPage, self._buildQuery(parameters),
+                                      parameters.get('_endpoint', 'other'), priority=priority)
+
+    def _getPage(self, url, endpoint):
+        """
+        _getPage makes an upstream call, recording how long it took under endpoint, unless the circuit breaker refuses it
+        """
+        if not self.breaker.allow():
+            upstreamRequests.inc(endpoint=endpoint, outcome='rejected')
+            return fail(CircuitOpenError("The circuit to {} is open".format(self.upstreamName)))
+        start = self.clock.seconds()
+        upstreamInFlight.inc(endpoint=endpoint)
+
+        def done(result):
+            upstreamInFlight.dec(endpoint=endpoint)
+            upstreamLatency.observe(self.clock.seconds() - start, endpoint=endpoint)
+            if not isinstance(result, Failure):
+                outcome = 'ok'
+                self.breaker.succeeded()
+            elif result.check(CancelledError):
+                outcome = 'cancelled'
+                self.breaker.abandoned()
+            else:
+                outcome = 'error'
+                if self._isUpstreamFault(result):
+                    self.breaker.failed()
+                else:
+                    self.breaker.succeeded()
+            upstreamRequests.inc(endpoint=endpoint, outcome=outcome)
+            return result
+
+        d = self.httpClient.getPage(url)
+        d.addBoth(done)
+        return d
+
+    def _isUpstreamFault(self, failure):
+        """
+        _isUpstreamFault tells whether a failed call counts against the upstream: anything but an HTTP error response
+        blaming the request does
+        """
+        if failure.check(Error):
+            status = str(failure.value.status)
+            return status.startswith('5') or status == '429'
+        return True
+
+    def _refresh(self, query, parameters):
+        """
+        _refresh schedules a background fetch of a stale query, unless one is already scheduled
+        """
+        if query in self._refreshing:
+            return
+        self._refreshing.add(query)
+
+        def refresh():
+            d = self._fetch(query, parameters, priority=self.refreshPriority)
+            d.addCallback(self._validateRefresh, query, parameters)
+            d.addErrback(lambda failure: log.err("Refresh of {} failed: {}".format(query, failure.getErrorMessage())))
+            d.addBoth(lambda _: self._refreshing.discard(query))
+
+        self.clock.callLater(0, refresh)
+
+    def _validateRefresh(self, response, query, parameters):
+        # don't replace a good entry with one we can't parse, or with an error
+        value = self._loadResponse(response, parameters)
+        if self._isErrorResponse(value):
+            raise ValueError("the API returned an error")
+        return self._cacheResponse(value, query, parameters)
+
     def _buildQuery(self, params):
         merged = copy(self.defaults)
-        merged.update(params)
+        # keys with a leading underscore describe how to make the call, and aren't sent upstream
+        merged.update((key, value) for key, value in params.iteritems()
+                      if key == '_baseURL' or not key.startswith('_'))
         base = merged['_baseURL']
         del merged['_baseURL']
         return base + urlencode(merged)
 
+    def _cacheKey(self, params):
+        """
+        _cacheKey derives the cache key for an API call: its endpoint, then a hash of its parameters in a canonical order,
+        with names normalized and secrets left out, so that equivalent calls share an entry and keys stay short
+        """
+        merged = copy(self.defaults)
+        merged.update(params)
+        canonical = []
+        for key, value in sorted(merged.iteritems()):
+            if key in self.secretParams or (key.startswith('_') and key != '_baseURL'):
+                continue
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            if key in self.normalizedParams:
+                value = nameKey(unquote_plus(str(value))).encode('utf-8')
+            canonical.append((key, value))
+        return '{}:{}'.format(params.get('_endpoint', 'other'), hashlib.sha1(urlencode(canonical)).hexdigest())
+
     def _unwrapArgs(self, request):
         """
         _unwrapArgs unwraps the values in the argument dict passed in by a request
@@ -41,26 +228,64 @@ class APIService(service.Service):
         [unwrappedDict.setdefault(key, val[0]) for key, val in argDict.iteritems()]
         return unwrappedDict
 
-    @inlineCallbacks
     def _deferredQuery(self, parameters):
         """
-        _deferredQuery constructs API calls via implemented API interfaces, taking care of loading responses and caching
+        _deferredQuery constructs API calls via implemented API interfaces, taking care of loading responses and caching.
+        Cancelling the returned Deferred cancels the upstream call too, unless another query is sharing it. Calls with
+        a true _bypassCache parameter go upstream whatever is cached, and cache what comes back
         """
-        query = self._buildQuery(parameters)
+        query = self._cacheKey(parameters)
 
-        response, parsed = None, None
-        if self.enableMemcache:
-            response = self.cache.get(query)
+        if self.enableMemcache and not parameters.get('_bypassCache'):
+            # cache clients may block or return Deferreds
+            d = maybeDeferred(self.cache.get, query)
+        else:
+            d = succeed(None)
+        d.addCallback(self._cachedOrFetched, query, parameters)
+        d.addCallbacks(self._parseResponse, self._queryFailed,
+                       callbackArgs=(query, parameters), errbackArgs=(query,))
+        return d
+
+    def _cachedOrFetched(self, entry, query, parameters):
+        """
+        _cachedOrFetched returns a (response, cached) pair for query, going upstream if the cache missed. Cached
+        responses come back already decoded, and negative entries as an empty dict, like a failed query
+        """
+        if entry is not None:
+            response, staleAt = unpackEntry(entry)
+            value = self._decodeEntry(response, query, parameters) if response else None
+            if value is NEGATIVE:
+                # negative entries aren't refreshed, just retried once they're stale, as a cache tier may outlive them
+                if staleAt > self.clock.seconds():
+                    return dict(), True
+            elif value is not None:
+                if staleAt <= self.clock.seconds():
+                    self._refresh(query, parameters)
+                return value, True
+        d = self._fetch(query, parameters)
+        d.addCallback(lambda response: (response, False))
+        return d
+
+    def _parseResponse(self, result, query, parameters):
+        response, cached = result
+        if cached:
+            return response
         try:
-            if not response:  # if we couldn't get response from the cache
-                response = yield getPage(query)
-            parsed = json.loads(response)
-            if self.enableMemcache:
-                # TODO: check how long this actually takes - most likely a blocking call
-                self._addToCache(query, response)
+            parsed = self._loadResponse(response, parameters)
         except ValueError as e:
             log.err("Response was not valid JSON: " + str(response))
-        except Exception as e:
-            log.err("Query to {} failed for unknown reason: {}".format(query, e))
-            returnValue(dict())
-        returnValue(parsed)
+            self._cacheFailure(query)
+            return None
+        if self.enableMemcache:
+            self._cacheResponse(parsed, query, parameters)
+        return parsed
+
+    def _queryFailed(self, failure, query):
+        if failure.check(CancelledError):
+            return failure
+        if failure.check(CircuitOpenError):
+            # answered straight away, and not cached, so that the query goes upstream again once the circuit closes
+            return dict()
+        self._cacheFailure(query)
+        log.err("Query to {} failed for unknown reason: {}".format(query, failure.getErrorMessage()))
+        return dict()
@@ -0,0 +1,97 @@
+from twisted.internet import reactor
+from twisted.python import log
+
+from metrics import circuitState
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# how each state is reported by the capoeira_circuit_state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """
+    CircuitOpenError fails a call which wasn't made because its upstream's circuit is open
+    """
+
+
+class CircuitBreaker(object):
+    """
+    CircuitBreaker stops calls to an upstream which keeps failing. After failureThreshold failures in a row the circuit
+    opens, and calls are refused straight away. Once resetTimeout seconds have passed, it's half open: a single probe
+    call is let through, closing the circuit if it succeeds and opening it again if it fails, for twice as long each
+    time, up to maxResetTimeout. The circuit's state is exported under name, unless it's None.
+    """
+    failureThreshold = 5
+    resetTimeout = 5
+    maxResetTimeout = 5 * 60
+
+    def __init__(self, name, failureThreshold=None, resetTimeout=None, maxResetTimeout=None, clock=None):
+        self.name = name
+        if failureThreshold is not None:
+            self.failureThreshold = failureThreshold
+        if resetTimeout is not None:
+            self.resetTimeout = resetTimeout
+        if maxResetTimeout is not None:
+            self.maxResetTimeout = maxResetTimeout
+        self.clock = clock or reactor
+        self.failures = 0
+        self.openUntil = None
+        self._timeout = self.resetTimeout
+        self._probing = False
+        self._setState(CLOSED)
+
+    def _setState(self, state):
+        self.state = state
+        if self.name is not None:
+            circuitState.set(STATE_VALUES[state], upstream=self.name)
+
+    def isOpen(self):
+        """
+        isOpen tells whether calls are being refused outright, with no probe due yet
+        """
+        return self.state == OPEN and self.clock.seconds() < self.openUntil
+
+    def allow(self):
+        """
+        allow tells whether a call may be made now. When it lets a half open circuit's probe through, the caller must
+        report how the call went
+        """
+        if self.state == OPEN and self.clock.seconds() >= self.openUntil:
+            self._setState(HALF_OPEN)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def succeeded(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != CLOSED:
+            log.msg("Closing the circuit to {}".format(self.name))
+            self._timeout = self.resetTimeout
+            self._setState(CLOSED)
+
+    def failed(self):
+        self.failures += 1
+        if self.state == HALF_OPEN and self._probing:
+            self._probing = False
+            self._timeout = min(self._timeout * 2, self.maxResetTimeout)
+            self._open()
+        elif self.state == CLOSED and self.failures >= self.failureThreshold:
+            self._open()
+
+    def abandoned(self):
+        """
+        abandoned reports a call which ended without telling us anything, such as a cancelled one
+        """
+        self._probing = False
+
+    def _open(self):
+        log.msg("Opening the circuit to {} for {}s after {} failures".format(self.name, self._timeout, self.failures))
+        self.openUntil = self.clock.seconds() + self._timeout
+        self._setState(OPEN)
@@ -0,0 +1,172 @@
+import sys
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.python import log
+
+from metrics import cacheRequests
+
+
+def packEntry(value, staleAt):
+    """
+    packEntry wraps a cached value with the time after which it should be refreshed in the background
+    """
+    return '{:.0f}|{}'.format(staleAt, value)
+
+
+def unpackEntry(entry):
+    """
+    unpackEntry returns the (value, staleAt) pair held by a packed cache entry. Entries written before soft TTLs existed
+    come back as already stale, so that they get refreshed.
+    """
+    staleAt, separator, value = entry.partition('|')
+    if not separator or not staleAt.isdigit():
+        return entry, 0
+    return value, int(staleAt)
+
+
+class LRUCache(object):
+    """
+    LRUCache is an in-process cache bounded both by entry count and by the total size of its keys and values. Entries
+    expire after their TTL, and the least recently used entries are evicted to make room. It speaks the same get / add /
+    set / delete subset of the memcache client API that APIService uses, with time=0 meaning no expiry.
+    """
+
+    def __init__(self, maxEntries=10000, maxBytes=64 * 1024 * 1024, clock=None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.clock = clock or reactor
+        self._entries = OrderedDict()  # key -> (value, size, expiresAt), least recently used first
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _sizeOf(self, key, value):
+        if isinstance(value, basestring):
+            return len(key) + len(value)
+        if isinstance(value, tuple):
+            return len(key) + sum(len(part) if isinstance(part, basestring) else sys.getsizeof(part) for part in value)
+        return len(key) + sys.getsizeof(value)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= self.clock.seconds():
+            self.delete(key)
+            return None
+        return entry
+
+    def get(self, key):
+        entry = self._lookup(key)
+        if entry is None:
+            return None
+        # re-insert to mark as most recently used
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry[0]
+
+    def set(self, key, value, time=0):
+        size = self._sizeOf(key, value)
+        if size > self.maxBytes:
+            return False
+        self.delete(key)
+        expiresAt = self.clock.seconds() + time if time else None
+        self._entries[key] = (value, size, expiresAt)
+        self.bytes += size
+        while len(self._entries) > self.maxEntries or self.bytes > self.maxBytes:
+            oldest = next(iter(self._entries))
+            self.delete(oldest)
+        return True
+
+    def add(self, key, value, time=0):
+        if self._lookup(key) is not None:
+            return False
+        return self.set(key, value, time)
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+        return entry is not None
+
+
+class TieredCache(object):
+    """
+    TieredCache puts a local LRUCache in front of a shared memcache client. Reads try the local tier first, promoting
+    remote hits into it, and writes go to both. Entries are kept locally for at most localTTL seconds, so that dynos
+    don't drift too far from each other. The remote client may be blocking or return Deferreds, in which case a local
+    miss returns a Deferred too.
+    """
+
+    def __init__(self, local, remote=None, localTTL=300):
+        self.local = local
+        self.remote = remote
+        self.localTTL = localTTL
+
+    def _localTime(self, time):
+        if not self.localTTL:
+            return time
+        return min(time, self.localTTL) if time else self.localTTL
+
+    def _remoteFailed(self, failure, method, key):
+        log.err("Remote cache {} for {} failed: {}".format(method, key, failure.getErrorMessage()))
+        return None
+
+    def _promote(self, value, key):
+        cacheRequests.inc(tier='remote', result='hit' if value is not None else 'miss')
+        if value is not None:
+            self.local.set(key, value, self._localTime(0))
+        return value
+
+    def _remoteGetFailed(self, failure, key):
+        if failure.check(CancelledError):
+            # the caller gave up, so don't let it carry on as a miss
+            return failure
+        cacheRequests.inc(tier='remote', result='error')
+        return self._remoteFailed(failure, 'get', key)
+
+    def get(self, key):
+        value = self.local.get(key)
+        cacheRequests.inc(tier='local', result='hit' if value is not None else 'miss')
+        if value is not None or self.remote is None:
+            return value
+        try:
+            value = self.remote.get(key)
+        except Exception as e:
+            cacheRequests.inc(tier='remote', result='error')
+            log.err("Remote cache get for {} failed: {}".format(key, e))
+            return None
+        if isinstance(value, Deferred):
+            value.addCallbacks(self._promote, self._remoteGetFailed, callbackArgs=(key,), errbackArgs=(key,))
+            return value
+        return self._promote(value, key)
+
+    def _write(self, method, key, value, time):
+        stored = getattr(self.local, method)(key, value, self._localTime(time))
+        if self.remote is not None:
+            try:
+                remoteStored = getattr(self.remote, method)(key, value, time)
+            except Exception as e:
+                log.err("Remote cache {} for {} failed: {}".format(method, key, e))
+            else:
+                if isinstance(remoteStored, Deferred):
+                    remoteStored.addErrback(self._remoteFailed, method, key)
+        return stored
+
+    def set(self, key, value, time=0):
+        return self._write('set', key, value, time)
+
+    def add(self, key, value, time=0):
+        return self._write('add', key, value, time)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.remote is not None:
+            try:
+                self.remote.delete(key)
+            except Exception as e:
+                log.err("Remote cache delete for {} failed: {}".format(key, e))
@@ -0,0 +1,173 @@
+import math
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
+from twisted.python import log
+
+from singleflight import SingleFlight
+from util import normalizeName
+
+
+class MetroCalendar(object):
+    """
+    MetroCalendar holds the upcoming events for one metro area, indexed by the normalized name and songkick id of every
+    performer, so that a set of artists can be joined against it without going upstream
+    """
+
+    def __init__(self, events, loadedAt, truncated=False):
+        self.loadedAt = loadedAt
+        # whether there were more events than were paged in, so that some artists' later events are missing
+        self.truncated = truncated
+        self.events = OrderedDict()
+        self.byPerformer = {}
+        self.byArtistId = {}
+        for event in events:
+            try:
+                eventId = event['id']
+            except (KeyError, TypeError):
+                continue
+            if eventId in self.events:
+                continue
+            self.events[eventId] = event
+            for performance in event.get('performance', []):
+                artist = performance.get('artist', {})
+                name = normalizeName(artist.get('displayName') or performance.get('displayName') or u'')
+                if name:
+                    self.byPerformer.setdefault(name, []).append(eventId)
+                if 'id' in artist:
+                    self.byArtistId.setdefault(artist['id'], []).append(eventId)
+
+    def __len__(self):
+        return len(self.events)
+
+    def eventsFor(self, artistName):
+        """
+        eventsFor returns the events which artistName is performing at, in date order
+        """
+        return [self.events[eventId] for eventId in self.byPerformer.get(normalizeName(artistName), [])]
+
+    def eventsForArtistId(self, artistId):
+        return [self.events[eventId] for eventId in self.byArtistId.get(artistId, [])]
+
+
+class MetroCalendarIndex(object):
+    """
+    MetroCalendarIndex keeps the whole upcoming-events calendar for the busiest metro areas, paged in from songkick once
+    and refreshed in the background every refreshInterval seconds. Refreshes go to songkick whatever is cached, as
+    cached pages could be as old as the calendar being refreshed. Asking for a calendar which isn't loaded yet starts
+    loading it, and concurrent loads of the same metro area are shared. At most maxMetroAreas calendars are kept, least
+    recently used first out. A load whose first page fails keeps whatever calendar was already there, and one missing
+    any later page is flagged as truncated.
+    """
+    refreshInterval = 60 * 60
+    maxMetroAreas = 50
+    # songkick pages are capped at 50 events; busy metro areas run to a few thousand events over the coming months, and
+    # calendars running to more than maxPages pages are cut short, logged and flagged as truncated
+    perPage = 50
+    maxPages = 100
+
+    def __init__(self, songkickService, clock=None):
+        self.songkickService = songkickService
+        self.clock = clock or reactor
+        self._calendars = OrderedDict()  # location -> MetroCalendar, least recently used first
+        self._loads = SingleFlight('calendar')
+
+    def __len__(self):
+        return len(self._calendars)
+
+    def calendar(self, location):
+        """
+        calendar returns the MetroCalendar for a location like 'sk:26330' if it's loaded, or None, loading it or
+        refreshing it in the background as needed
+        """
+        calendar = self._calendars.pop(location, None)
+        if calendar is None:
+            self.load(location)
+            return None
+        self._calendars[location] = calendar
+        if calendar.loadedAt + self.refreshInterval <= self.clock.seconds():
+            self.load(location)
+        return calendar
+
+    def load(self, location):
+        """
+        load pages in the calendar for location, returning a Deferred which fires with the new MetroCalendar
+        """
+        return self._loads.call(location, self._load, location)
+
+    def _page(self, metroAreaId, page, refresh=False):
+        return self.songkickService.songkickMetroAreaCalendar(metroAreaId, page=page, perPage=self.perPage,
+                                                              priority=self.songkickService.refreshPriority,
+                                                              bypassCache=refresh)
+
+    def _load(self, location):
+        metroAreaId = location.split(':')[-1]
+        refresh = location in self._calendars
+        d = self._page(metroAreaId, 1, refresh)
+        d.addCallback(self._remainingPages, metroAreaId, location, refresh)
+        d.addCallback(self._loaded, location)
+        d.addErrback(self._loadFailed, location)
+        return d
+
+    def _pageOk(self, response):
+        try:
+            return response['resultsPage']['status'] == 'ok'
+        except (KeyError, TypeError):
+            return False
+
+    def _pageEvents(self, response):
+        try:
+            return response['resultsPage']['results'].get('event', [])
+        except (KeyError, TypeError, AttributeError):
+            return []
+
+    def _remainingPages(self, firstPage, metroAreaId, location, refresh):
+        """
+        _remainingPages pages in the rest of a calendar, firing with (events, truncated)
+        """
+        if not self._pageOk(firstPage):
+            # failed, error and negatively cached pages say nothing about the calendar, so don't replace it with one
+            raise ValueError("the first page of the calendar for {} failed".format(location))
+        events = self._pageEvents(firstPage)
+        try:
+            totalEntries = firstPage['resultsPage']['totalEntries']
+        except (KeyError, TypeError):
+            totalEntries = len(events)
+        pages = int(math.ceil(float(totalEntries) / self.perPage))
+        truncated = pages > self.maxPages
+        if truncated:
+            log.msg("Only paging in {} of {} events for metro area {}".format(self.maxPages * self.perPage,
+                                                                              totalEntries, location))
+            pages = self.maxPages
+        if pages <= 1:
+            return events, truncated
+
+        def merge(results):
+            failed = 0
+            for success, response in results:
+                if success and self._pageOk(response):
+                    events.extend(self._pageEvents(response))
+                else:
+                    failed += 1
+            if failed:
+                log.msg("{} of {} later pages failed for metro area {}".format(failed, len(results), location))
+            return events, truncated or failed > 0
+
+        d = DeferredList([self._page(metroAreaId, page, refresh) for page in range(2, pages + 1)], consumeErrors=True)
+        d.addCallback(merge)
+        return d
+
+    def _loaded(self, result, location):
+        events, truncated = result
+        calendar = MetroCalendar(events, self.clock.seconds(), truncated)
+        log.msg("loaded {} events for metro area {}".format(len(calendar), location))
+        self._calendars.pop(location, None)
+        self._calendars[location] = calendar
+        while len(self._calendars) > self.maxMetroAreas:
+            self._calendars.popitem(last=False)
+        return calendar
+
+    def _loadFailed(self, failure, location):
+        log.err("Loading the calendar for {} failed: {}".format(location, failure.getErrorMessage()))
+        return None
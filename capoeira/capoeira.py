@@ -1,133 +1,660 @@
 from __future__ import print_function
 
+import hashlib
+import math
 import urllib
+from collections import OrderedDict
 
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 from negotiator import ContentNegotiator, AcceptParameters, ContentType, Language
-from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed, DeferredList
+from twisted.internet.threads import deferToThread
 from twisted.python import log
+from twisted.python.failure import Failure
 
-from util import formatJSONResponse, formatHTMLResponse
+from cache import LRUCache
+from eventstore import sharedEventStore
+from fanout import BudgetedFanOut
+from metrics import registry, cacheRequests, fanOutWidth, renderTime, requestsInFlight
+from metroindex import MetroAreaIndex
+from pipeline import Pipeline
+from util import formatJSONResponse, formatJSONChunks, formatHTMLResponse, formatNDJSONRecord, formatSSERecord
+from util import acceptedEncoding, compressBody, formatServerTiming, nameKey, normalizeName, snapshot
 from apiservice import APIService
 from songkick import SongkickResponse
 
 
 class CapoeiraAPIService(APIService):
+    # how many of the most similar artists to query before widening the fan-out, when a request has a deadline
+    initialFanOut = 25
+    # most seeds a batch query may name; any more are ignored
+    maxBatchSeeds = 25
+    # last.fm and songkick are only called through their own services, so there's no upstream, or circuit breaker state,
+    # to export here
+    upstreamName = None
 
-    def __init__(self, lastfmService, songkickService, *args, **kwargs):
+    def __init__(self, lastfmService, songkickService, metroIndex=None, defaultDeadline=None, calendarIndex=None,
+                 eventStore=None, similarityGraph=None, *args, **kwargs):
         APIService.__init__(self, *args, **kwargs)
         self.lastfmService = lastfmService
         self.songkickService = songkickService
+        # latency budget in seconds for requests which don't pass their own deadline, or None for no budget
+        self.defaultDeadline = defaultDeadline
+        # location names we've already resolved, so that songkick is only asked about new ones
+        self.metroIndex = metroIndex if metroIndex is not None else MetroAreaIndex()
+        # whole metro area calendars, which similar artists are joined against locally, or None to always fan out
+        self.calendarIndex = calendarIndex
+        # one shared record per event, however many requests it turns up in
+        self.eventStore = eventStore if eventStore is not None else sharedEventStore()
+        # a SimilarityGraph which similar artists are looked up in before asking last.fm, or None
+        self.similarityGraph = similarityGraph
+        self._refreshingSimilar = set()
+        # a CachePrewarmer which is told about every query's seeds and location, or None
+        self.prewarmer = None
 
     # /capoeira/events/similar/artist
-    def capoeiraSimilarByArtistQuery(self, request):
-        response = self.eventsBySimilarQuery(request, self.lastfmService.lastFMArtistSimilar)
+    def capoeiraSimilarByArtistQuery(self, request, onEvent=None, location=None, timings=None):
+        response = self.eventsBySimilarQuery(request, self.lastfmService.lastFMArtistSimilar, onEvent=onEvent,
+                                             location=location, timings=timings)
         return response
 
     # /capoeira/events/similar/track
-    def capoeiraSimilarByTrackQuery(self, request):
-        response = self.eventsBySimilarQuery(request, self.lastfmService.lastFMTrackSimilar)
+    def capoeiraSimilarByTrackQuery(self, request, onEvent=None, location=None, timings=None):
+        response = self.eventsBySimilarQuery(request, self.lastfmService.lastFMTrackSimilar, onEvent=onEvent,
+                                             location=location, timings=timings)
         return response
 
+    # /capoeira/events/similar/batch
+    def capoeiraSimilarBatchQuery(self, request, onEvent=None, location=None, timings=None):
+        """
+        Find upcoming events near the requested location for artists similar to any of several seeds, given as repeated
+        artist parameters and / or repeated track and track_artist pairs. The location is resolved once, and each similar
+        artist is queried once however many seeds it's similar to. The events found for each seed are listed by id
+        under seeds, in the order the seeds were given
+        """
+        seeds = self._batchSeeds(request)
+        deadline = self._deadline(self._unwrapArgs(request).get('deadline'))
+        resolved = location is not None
+
+        pipeline = Pipeline(clock=self.clock)
+        if location is None:
+            pipeline.addStage('location', lambda: self._locationStage(request))
+        else:
+            pipeline.addStage('location', lambda: location)
+        pipeline.addStage('similar', lambda: self._similarForSeeds(seeds))
+
+        def events(location, similar):
+            if not resolved:
+                self._recordSeeds(location, seeds)
+            return self._batchEvents(location, seeds, similar, onEvent, deadline)
+
+        pipeline.addStage('events', events, dependsOn=('location', 'similar'))
+        return self._runPipeline(pipeline, 'events', timings)
+
+    def _batchSeeds(self, request):
+        """
+        _batchSeeds returns the seeds named by a batch request, as dicts of artist, and track for track seeds
+        """
+        seeds = [{'artist': artist} for artist in request.args.get('artist', [])]
+        seeds.extend({'track': track, 'artist': artist}
+                     for track, artist in zip(request.args.get('track', []), request.args.get('track_artist', [])))
+        if len(seeds) > self.maxBatchSeeds:
+            log.msg("Ignoring {} seeds past the first {}".format(len(seeds) - self.maxBatchSeeds, self.maxBatchSeeds))
+        return seeds[:self.maxBatchSeeds]
+
+    def _similarForSeeds(self, seeds):
+        """
+        _similarForSeeds looks up similar artists for every seed at once, firing with a list of responses in seed order,
+        with None for any lookup which failed
+        """
+        queries = []
+        for seed in seeds:
+            if 'track' in seed:
+                queries.append(self.lastfmService.lastFMTrackSimilar(track=seed['track'], artist=seed['artist']))
+            else:
+                queries.append(self._artistSimilar(seed['artist']))
+        d = DeferredList(queries, consumeErrors=True)
+        d.addCallback(lambda results: [response if success else None for success, response in results])
+        return d
+
+    @inlineCallbacks
+    def _batchEvents(self, location, seeds, responses, onEvent=None, deadline=None):
+        """
+        _batchEvents merges the similar artists for every seed, ordered by how similar each is to its closest seed, runs
+        one fan-out for all of them, and attributes the events found to the seeds they came from
+        """
+        bestRank = {}  # normalized name -> (rank, first seen)
+        names = {}  # normalized name -> (escaped, raw)
+        seedsFor = {}  # normalized name -> seed indexes
+        for seedIndex, response in enumerate(responses):
+            similar = self._similarArtistNames(response)
+            for rank, (escaped, raw) in enumerate(similar):
+                key = normalizeName(raw)
+                if key not in names:
+                    names[key] = (escaped, raw)
+                    bestRank[key] = (rank, len(bestRank))
+                    seedsFor[key] = set()
+                bestRank[key] = min(bestRank[key], (rank, bestRank[key][1]))
+                seedsFor[key].add(seedIndex)
+
+        keys = sorted(names, key=bestRank.get)
+        byArtist = {}
+        degraded = any(not response for response in responses)
+        final = yield self._artistEvents(location, [names[key] for key in keys], onEvent, deadline, byArtist, degraded)
+
+        final['seeds'] = []
+        for seedIndex, seed in enumerate(seeds):
+            eventIds = []
+            seen = set()
+            for rank, key in enumerate(keys):
+                if seedIndex in seedsFor[key]:
+                    for eventId in byArtist.get(rank, []):
+                        if eventId not in seen:
+                            seen.add(eventId)
+                            eventIds.append(eventId)
+            attributed = dict(seed)
+            attributed['event_ids'] = eventIds
+            final['seeds'].append(attributed)
+        returnValue(final)
+
     @inlineCallbacks
     def locationQuery(self, request):
         """
-        Make a call to Songkick, and return the metroarea id of the first city returned
+        Return the metroarea id for the requested location, from the metro area index if we've seen it before, or else
+        from the first city returned by Songkick. Locations Songkick has nothing for are completed from the index, if
+        they're an unambiguous prefix of a name in it
         """
         args = self._unwrapArgs(request)
         if 'location' not in args:
             returnValue('sk:26330')
+        metroAreaId = self.metroIndex.lookup(args['location'])
+        if metroAreaId is not None:
+            returnValue('sk:' + str(metroAreaId))
         response = yield self.songkickService.songkickLocationByName(name=args['location'])
-        response = SongkickResponse(response)
+        try:
+            response = SongkickResponse(response)
+        except (KeyError, TypeError):
+            # the query failed, so fall back to the default without remembering it
+            returnValue('sk:26330')
         if response.success and len(response.results) > 0:
+            self.metroIndex.record(args['location'], response.results['location'])
             returnValue('sk:' + str(response.results['location'][0]['metroArea']['id']))
-        returnValue('sk:26330')
+        metroAreaId = self.metroIndex.lookup(args['location'], prefix=True) if response.success else None
+        returnValue('sk:' + str(metroAreaId) if metroAreaId is not None else 'sk:26330')
 
-    @inlineCallbacks
-    def eventsBySimilarQuery(self, request, fmFn):
+    def _locationStage(self, request):
+        """
+        _locationStage resolves the requested location, falling back to the default metro area if that fails
+        """
+        d = self.locationQuery(request)
+
+        def failed(failure):
+            log.err(failure)
+            return 'sk:26330'
+
+        d.addErrback(failed)
+        return d
+
+    def _runPipeline(self, pipeline, result, timings=None):
+        """
+        _runPipeline runs pipeline, firing with the result of the stage named result, and logs where the time went. Stage
+        durations are added to timings, if given, unless it already has a step of the same name
+        """
+        def finished(results):
+            durations = pipeline.durations()
+            log.msg("pipeline timings: {} critical path: {}".format(
+                ' '.join('{}={:.1f}ms'.format(name, duration * 1000) for name, duration in durations.iteritems()),
+                ' -> '.join(pipeline.criticalPath())))
+            if timings is not None:
+                for name, duration in durations.iteritems():
+                    timings.setdefault(name, duration)
+            return results[result]
+
+        d = pipeline.run()
+        d.addCallback(finished)
+        return d
+
+    def _deadline(self, deadline):
+        """
+        _deadline turns a request's deadline in milliseconds, or the default budget, into a time on self.clock
+        """
+        budget = self.defaultDeadline
+        if deadline is not None:
+            try:
+                requested = float(deadline) / 1000
+            except ValueError:
+                requested = None
+            if requested is None or math.isnan(requested) or math.isinf(requested):
+                log.msg("Ignoring invalid deadline {}".format(deadline))
+            else:
+                budget = requested
+        if budget is None:
+            return None
+        return self.clock.seconds() + budget
+
+    def eventsBySimilarQuery(self, request, fmFn, onEvent=None, location=None, timings=None):
+        """
+        Find upcoming events near the requested location for artists similar to the query. If onEvent is given, it's
+        called with each distinct event as soon as the query for its artist returns. Passing location skips the
+        location query, for callers which have already resolved the metro area. If the request has a deadline, in
+        milliseconds, events are returned for as many artists as could be queried in time, flagged as partial
+        """
         args = self._unwrapArgs(request)
+        args.pop('location', None)
+        deadline = self._deadline(args.pop('deadline', None))
+        hops = self._hops(args.pop('hops', None))
+        resolved = location is not None
+
+        # the location and similarity lookups are independent, so run them side by side and only start the songkick
+        # fan-out once both are in
+        pipeline = Pipeline(clock=self.clock)
+        if location is None:
+            pipeline.addStage('location', lambda: self._locationStage(request))
+        else:
+            pipeline.addStage('location', lambda: location)
+        if fmFn == self.lastfmService.lastFMArtistSimilar and args.keys() == ['artist']:
+            pipeline.addStage('similar', lambda: self._artistSimilar(args['artist'], hops))
+        else:
+            pipeline.addStage('similar', lambda: fmFn(**args))
+
+        def events(location, similar):
+            if not resolved:
+                self._recordSeeds(location, [args])
+            return self._similarArtistEvents(location, similar, onEvent, deadline)
+
+        pipeline.addStage('events', events, dependsOn=('location', 'similar'))
+        return self._runPipeline(pipeline, 'events', timings)
+
+    def _hops(self, hops):
+        """
+        _hops turns a request's hops argument into how far out to look for similar artists in the similarity graph
+        """
         try:
-            location = yield self.locationQuery(request)
-            if 'location' in args:
-                del args['location']
-        except Exception as e:
-            log.err(e)
+            return min(max(int(hops), 1), 2) if hops is not None else 1
+        except ValueError:
+            log.msg("Ignoring invalid hops {}".format(hops))
+            return 1
 
-        response = yield fmFn(**args)
+    def _artistSimilar(self, artist, hops=1):
+        """
+        _artistSimilar looks up the artists similar to artist in the similarity graph, in the shape of a last.fm similar
+        artists response, and only asks last.fm if the graph doesn't know the artist. Stale neighbours are still served,
+        while last.fm is asked again in the background
+        """
+        graph = self.similarityGraph
+        similar = graph.similar(artist, hops=hops) if graph is not None else None
+        if similar is None:
+            if graph is not None:
+                cacheRequests.inc(tier='graph', result='miss')
+            return self.lastfmService.lastFMArtistSimilar(artist=artist)
+        if graph.isStale(artist):
+            cacheRequests.inc(tier='graph', result='stale')
+            self._refreshSimilar(artist)
+        else:
+            cacheRequests.inc(tier='graph', result='hit')
+        return succeed({'similarartists': {'artist': [{'name': name, 'match': match} for name, match in similar]}})
+
+    def _refreshSimilar(self, artist):
+        # the response is recorded in the graph by the last.fm service
+        key = nameKey(artist)
+        if key in self._refreshingSimilar:
+            return
+        self._refreshingSimilar.add(key)
+        d = self.lastfmService.lastFMArtistSimilar(artist=artist, priority=self.lastfmService.refreshPriority)
+        d.addBoth(lambda _: self._refreshingSimilar.discard(key))
 
-        # build list of escaped similar artist names
-        artistNameList = []
-        for index in range(len(response['similarartists']['artist'])):
+    def _recordSeeds(self, location, seeds):
+        # callers which resolve the location themselves, like CapoeiraResource, record the seeds themselves too
+        if self.prewarmer is not None:
+            for seed in seeds:
+                self.prewarmer.record(location, seed.get('artist'), seed.get('track'))
+
+    def _similarArtistNames(self, response):
+        """
+        _similarArtistNames returns (escaped, raw) name pairs for the artists in a last.fm similar artists or similar
+        tracks response, most similar first, without repeats. Failed, error and empty responses have none
+        """
+        try:
+            if 'similartracks' in response:
+                entries = [track.get('artist', track) if isinstance(track, dict) else track
+                           for track in response['similartracks']['track']]
+            else:
+                entries = response['similarartists']['artist']
+        except (KeyError, TypeError):
+            log.msg("No similar artists in {!r}".format(response)[:200])
+            return []
+        if isinstance(entries, dict):
+            # last.fm sends a lone similar artist or track on its own, rather than in a list
+            entries = [entries]
+        names = []
+        seen = set()
+        for entry in entries:
             try:
-                artistNameList.append(urllib.quote_plus(response['similarartists']['artist'][index]['name']))
+                artistName = entry['name']
+                escaped = urllib.quote_plus(artistName)
             except KeyError:
                 # we get a weird byte back occasionally, instead of a dict
-                pass
+                continue
             except Exception as e:
                 log.err(e)
+                continue
+            if artistName not in seen:
+                seen.add(artistName)
+                names.append((escaped, artistName))
+        return names
 
-        # create deferred list of songkick upcoming event queries, fire off all our songkick API queries
-        try:
-            similarArtistList = yield DeferredList([self.songkickService.songkickUpcomingEvents(artistName,
-                                                                                                location=location)
-                                                    for artistName in artistNameList])
-        except Exception as e:
-            log.err(e)
+    def _similarArtistEvents(self, location, response, onEvent=None, deadline=None):
+        """
+        _similarArtistEvents queries songkick for upcoming events near location for every artist in a last.fm similar
+        artists response, and merges the results. A failed last.fm lookup leaves the results degraded
+        """
+        return self._artistEvents(location, self._similarArtistNames(response), onEvent, deadline,
+                                  degraded=not response)
+
+    @inlineCallbacks
+    def _artistEvents(self, location, artistNames, onEvent=None, deadline=None, byArtist=None, degraded=False):
+        """
+        _artistEvents queries songkick for upcoming events near location for every (escaped, raw) artist name, and
+        merges the results. With a deadline, the fan-out starts with the first artists, and only widens while there's
+        time left. If the calendar for location is loaded, the artists are joined against it instead, without any
+        songkick queries. If byArtist is given, it's filled in with the event ids found for each artist, by index.
+        Results missing any upstream answer, because a query failed or was turned away, are flagged as degraded, as
+        they are if degraded is passed in
+        """
+        artistNameList = [escaped for escaped, raw in artistNames]
+        rawNameList = [raw for escaped, raw in artistNames]
+
+        calendar = self.calendarIndex.calendar(location) if self.calendarIndex is not None else None
+        if calendar is not None:
+            fanOutWidth.observe(len(rawNameList), mode='calendar')
+            final = self._joinCalendar(calendar, rawNameList, onEvent, byArtist)
+            final['degraded'] = degraded
+            returnValue(final)
+
+        # queue songkick upcoming event queries with the songkick scheduler, so that the most similar artists are
+        # queried first
+        streamed = {}  # event id -> record, for the events already handed to onEvent
+
+        def query(rank, artistName):
+            d = self.songkickService.songkickUpcomingEvents(artistName, location=location, priority=rank)
+            if byArtist is not None:
+                d.addCallback(self._recordEvents, byArtist, rank)
+            if onEvent is not None:
+                d.addCallback(self._streamEvents, streamed, onEvent)
+            return d
+
+        if deadline is None:
+            similarArtistList = yield DeferredList([query(rank, artistName)
+                                                    for rank, artistName in enumerate(artistNameList)],
+                                                   consumeErrors=True)
+            covered = len(artistNameList)
+        else:
+            fanOut = BudgetedFanOut(query, artistNameList, deadline, self.initialFanOut, self.clock)
+            similarArtistList, covered = yield fanOut.run()
+        fanOutWidth.observe(covered, mode='fanout')
 
         # package up our results for reply
-        merged = self._mergeResults(similarArtistList)
+        merged = self._mergeResults(similarArtistList, streamed)
         final = {'events': merged}
         final['event_count'] = len(merged)
+        final['artists_covered'] = covered
+        final['partial'] = covered < len(artistNameList)
+        # failed, rejected and negatively cached queries all come back empty
+        final['degraded'] = degraded or any(not success or not response for success, response in similarArtistList)
         returnValue(final)
 
-    def _mergeResults(self, results):
-        merged = []
-        # check all of our songkick query responses, and add the results if the query was successful, and there are concerts
-        results = [callbackResult[1]['resultsPage']['results'] for callbackResult in results if (callbackResult[0] and
-                                                                                                 len(callbackResult[1][
-                                                                                                     'resultsPage'][
-                                                                                                     'results']) > 0)]
-        # remove duplicate events
-        ids = set()
-        for result in results:
-            if 'event' in result:
-                for event in result['event']:
-                    if event['id'] not in ids:
-                        merged.append(event)
-                        ids.add(event['id'])
-        return merged
+    def _eventsIn(self, response):
+        """
+        _eventsIn returns the events in a songkick upcoming events response, or none if it failed or is an error
+        """
+        try:
+            return response['resultsPage']['results'].get('event', [])
+        except (KeyError, TypeError, AttributeError):
+            return []
+
+    def _recordEvents(self, response, byArtist, rank):
+        try:
+            byArtist[rank] = [event['id'] for event in self._eventsIn(response)]
+        except Exception as e:
+            log.err(e)
+        return response
+
+    def _joinCalendar(self, calendar, artistNames, onEvent=None, byArtist=None):
+        """
+        _joinCalendar looks up each artist's events in a metro area calendar, in the same shape and order as a fan-out
+        """
+        events = [calendar.eventsFor(artistName) for artistName in artistNames]
+        if byArtist is not None:
+            for rank, artistEvents in enumerate(events):
+                byArtist[rank] = [event['id'] for event in artistEvents]
+        merged = self.eventStore.merge(events)
+        if onEvent is not None:
+            for event in merged:
+                onEvent(event)
+        # a truncated calendar is missing some artists' events, as a fan-out cut short by its deadline would be
+        return {'events': merged, 'event_count': len(merged), 'artists_covered': len(artistNames),
+                'partial': calendar.truncated}
+
+    def _streamEvents(self, response, streamed, onEvent):
+        """
+        _streamEvents hands the record for each event in a songkick response to onEvent, skipping ids in streamed, and
+        keeps the records in streamed by id
+        """
+        try:
+            for event in self._eventsIn(response):
+                if event['id'] not in streamed:
+                    streamed[event['id']] = self.eventStore.add(event)
+                    onEvent(streamed[event['id']])
+        except Exception as e:
+            log.err(e)
+        return response
+
+    def _mergeResults(self, results, streamed=None):
+        # take the concerts from every songkick query which succeeded, skipping failed, error and empty responses
+        eventLists = [self._eventsIn(response) for success, response in results if success]
+        if streamed:
+            # events which were streamed are already in the store, so use their records rather than adding them again
+            eventLists = [[streamed.get(event['id'], event) for event in events] for events in eventLists]
+        # remove duplicate events, sharing records with every other request which has seen them
+        return self.eventStore.merge(events for events in eventLists if events)
 
 
 class CapoeiraResource(Resource):
-    def __init__(self, service):
+    # how long, in seconds, a rendered response is served before the query is run again
+    responseTTL = 300
+    # responses listing more events than this are serialized in a thread, and bodies bigger than this many bytes are
+    # compressed in one, so that the reactor keeps serving other requests meanwhile
+    threadAbove = 500
+    threadCompressAbove = 256 * 1024
+    # bodies smaller than this many bytes aren't worth compressing
+    compressAbove = 1024
+    compressLevel = 6
+    deferToThread = staticmethod(deferToThread)
+
+    def __init__(self, service, responseCache=None):
         Resource.__init__(self)
         self.service = service
+        # rendered responses, keyed by query, metro area and content type; an empty cache passed in is still used
+        if responseCache is None:
+            responseCache = LRUCache(maxEntries=1000, maxBytes=32 * 1024 * 1024)
+        self.responseCache = responseCache
         self.resources = {
             '/capoeira/events/similar/artist': self.service.capoeiraSimilarByArtistQuery,
-            '/capoeira/events/similar/track': self.service.capoeiraSimilarByTrackQuery
+            '/capoeira/events/similar/track': self.service.capoeiraSimilarByTrackQuery,
+            '/capoeira/events/similar/batch': self.service.capoeiraSimilarBatchQuery
         }
+        self.metricsPath = '/capoeira/metrics'
         self.isLeaf = True
 
         # default_params is used in lieu of a defined Accept field in the header
         default_params = AcceptParameters(ContentType("text/html"), Language("en"))
         acceptable = [AcceptParameters(ContentType("text/html"), Language("en")),
                       AcceptParameters(ContentType("text/json"), Language("en")),
-                      AcceptParameters(ContentType("application/json"), Language("en"))]
+                      AcceptParameters(ContentType("application/json"), Language("en")),
+                      AcceptParameters(ContentType("application/x-ndjson"), Language("en")),
+                      AcceptParameters(ContentType("text/event-stream"), Language("en"))]
         self.contentNegotiator = ContentNegotiator(default_params, acceptable)
-        # function mapping for rendering response
+        # function mapping for rendering response, from the serialized JSON; None serves the JSON as it is
         self.renderFns = {'text/html': formatHTMLResponse,
-                          'text/json': formatJSONResponse,
-                          'application/json': formatJSONResponse}
+                          'text/json': None,
+                          'application/json': None}
+        # function mapping for streaming responses, which write each event as it arrives, then a summary record
+        self.streamFns = {'application/x-ndjson': formatNDJSONRecord,
+                          'text/event-stream': formatSSERecord}
+
+    def _responseKey(self, request, contentType, location):
+        """
+        _responseKey normalizes a query into a response cache key, so that equivalent queries share rendered responses
+        """
+        # repeated parameters, like batch seeds, keep their order
+        normalized = sorted(((key.lower(), ' '.join(value.lower().split()))
+                             for key, values in request.args.iteritems() if key not in ('location', 'deadline')
+                             for value in values), key=lambda pair: pair[0])
+        return '|'.join([request.path, contentType, location, urllib.urlencode(normalized)])
+
+    def _seeds(self, request):
+        if request.path == '/capoeira/events/similar/batch':
+            return self.service._batchSeeds(request)
+        return [self.service._unwrapArgs(request)]
+
+    def _notModified(self, request, etag):
+        tags = request.getHeader('If-None-Match')
+        if not tags:
+            return False
+        tags = [tag.strip() for tag in tags.split(',')]
+        return etag in tags or 'W/' + etag in tags or '*' in tags
+
+    @inlineCallbacks
+    def _renderCached(self, request, contentType, renderFn, closed):
+        """
+        _renderCached writes the rendered response for request, rendering it only if there isn't a cached copy, and
+        answers conditional requests whose ETag still matches with a 304. Where the time went is returned in a
+        Server-Timing header. If the client has gone by the time the response is ready, it's cached but not written.
+        Degraded responses are only cached for as long as the upstream failures behind them are
+        """
+        clock = self.service.clock
+        timings = OrderedDict()
+        start = clock.seconds()
+        location = yield self.service._locationStage(request)
+        timings['location'] = clock.seconds() - start
+        # every request counts towards prewarming, however it's answered
+        self.service._recordSeeds(location, self._seeds(request))
+        key = self._responseKey(request, contentType, location)
+        cached = self.responseCache.get(key)
+        cacheRequests.inc(tier='response', result='hit' if cached is not None else 'miss')
+        cacheable = True
+        ttl = self.responseTTL
+        if cached is None:
+            result = yield self.resources[request.path](request, location=location, timings=timings)
+            start = clock.seconds()
+            body = yield self._serialize(result, renderFn)
+            timings['render'] = clock.seconds() - start
+            renderTime.observe(timings['render'], content_type=contentType)
+            cached = ('"{}"'.format(hashlib.md5(body).hexdigest()), body)
+            # a partial response is only good for the request whose deadline cut it short
+            cacheable = not result.get('partial')
+            if result.get('degraded'):
+                ttl = self.service.negativeTTL
+            if cacheable:
+                self.responseCache.set(key, cached, ttl)
+
+        etag, body = cached
+        encoding = acceptedEncoding(request.getHeader('Accept-Encoding')) if len(body) > self.compressAbove else None
+        if encoding is not None:
+            # each encoding of a body is cached alongside it, under its own ETag
+            encodedKey = '|'.join([key, etag, encoding])
+            encoded = self.responseCache.get(encodedKey)
+            if encoded is None:
+                start = clock.seconds()
+                compressed = yield self._compress(body, encoding)
+                timings['compress'] = clock.seconds() - start
+                encoded = ('{}-{}"'.format(etag[:-1], encoding), compressed)
+                if cacheable:
+                    self.responseCache.set(encodedKey, encoded, ttl)
+            etag, body = encoded
+            request.setHeader("Content-Encoding", encoding)
+
+        if closed:
+            return
+        request.setHeader("Server-Timing", formatServerTiming(timings))
+        request.setHeader("ETag", etag)
+        request.setHeader("Vary", "Accept, Accept-Encoding")
+        if self._notModified(request, etag):
+            request.setResponseCode(304)
+        else:
+            request.write(body)
+        request.finish()
 
-    def _delayedRender(self, request, deferred, renderFn):
-        def d(_):
-            request.write(renderFn(deferred.result))
+    def _serialize(self, result, renderFn):
+        """
+        _serialize serializes a query result as JSON, rendered by renderFn if it's not None. Results with more than
+        threadAbove events are copied and serialized in a thread
+        """
+        if len(result.get('events', ())) > self.threadAbove:
+            d = self.deferToThread(formatJSONChunks, snapshot(result))
+        else:
+            d = succeed(formatJSONResponse(result))
+        if renderFn is not None:
+            d.addCallback(renderFn)
+        return d
+
+    def _compress(self, body, encoding):
+        if len(body) > self.threadCompressAbove:
+            return self.deferToThread(compressBody, body, encoding, self.compressLevel)
+        return succeed(compressBody(body, encoding, self.compressLevel))
+
+    def _renderFailed(self, request, closed):
+        def d(failure):
+            log.err(failure)
+            if closed:
+                return
+            request.setResponseCode(500)
             request.finish()
 
         return d
 
+    def _streamEvent(self, request, renderFn, closed):
+        def write(event):
+            if not closed:
+                request.write(renderFn('event', event))
+
+        return write
+
+    def _finishStream(self, request, renderFn, closed):
+        def d(result):
+            if closed:
+                return
+            if isinstance(result, Failure):
+                log.err(result)
+                result = {'error': result.getErrorMessage()}
+            else:
+                result = dict((key, value) for key, value in result.iteritems() if key != 'events')
+            request.write(renderFn('summary', result))
+            request.finish()
+
+        return d
+
+    def _renderStream(self, request, contentType):
+        renderFn = self.streamFns[contentType]
+        # stop writing if the client goes away before we're done
+        closed = []
+        request.notifyFinish().addBoth(closed.append)
+        if contentType == 'text/event-stream':
+            request.setHeader("Cache-Control", "no-cache")
+        d = self.resources[request.path](request, onEvent=self._streamEvent(request, renderFn, closed))
+        d.addBoth(self._finishStream(request, renderFn, closed))
+        return NOT_DONE_YET
+
+    def _trackInFlight(self, request):
+        requestsInFlight.inc(path=request.path)
+        request.notifyFinish().addBoth(lambda _: requestsInFlight.dec(path=request.path))
+
     def render_GET(self, request):
+        if request.path == self.metricsPath:
+            request.setHeader("Content-Type", "text/plain; version=0.0.4")
+            return registry.render()
+
         # try to find acceptable response format, else fail with 406
         acceptable = self.contentNegotiator.negotiate(request.getHeader('Accept'))
         if not acceptable:
@@ -136,11 +663,18 @@ class CapoeiraResource(Resource):
 
         # get acceptable content type and associated render function
         contentType = str(acceptable.content_type)
-        renderFn = self.renderFns[contentType]
+        renderFn = self.renderFns.get(contentType)
         request.setHeader("Content-Type", contentType)
         if request.path in self.resources:
-            d = self.resources[request.path](request)
-            d.addCallback(self._delayedRender(request, d, renderFn))
+            self._trackInFlight(request)
+        if request.path in self.resources and contentType in self.streamFns:
+            return self._renderStream(request, contentType)
+        elif request.path in self.resources:
+            # don't write to the client if it goes away before the response is ready
+            closed = []
+            request.notifyFinish().addBoth(closed.append)
+            d = self._renderCached(request, contentType, renderFn, closed)
+            d.addErrback(self._renderFailed(request, closed))
             return NOT_DONE_YET
         else:
             # TODO: better handling of path not found
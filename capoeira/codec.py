@@ -0,0 +1,67 @@
+import json
+import marshal
+import zlib
+
+# cached values start with CODEC_TAG, the codec version and a flag saying whether the payload is compressed. Raw JSON,
+# as cached before the codec existed, starts with '{' or '[' instead. Bump CODEC_VERSION whenever the payload format or a
+# projection changes, so that older entries are refetched rather than misread.
+CODEC_TAG = '#'
+CODEC_VERSION = 1
+
+
+class _Negative(object):
+    def __repr__(self):
+        return 'NEGATIVE'
+
+
+# the value of a negative entry, which records that a query failed rather than what it returned
+NEGATIVE = _Negative()
+
+
+def project(value, projection):
+    """
+    project copies the parts of a parsed JSON value which projection keeps. A projection is either True, keeping the
+    whole value, or a dict of key -> projection for the keys to keep. Lists are projected item by item.
+    """
+    if projection is True:
+        return value
+    if isinstance(value, list):
+        return [project(item, projection) for item in value]
+    if isinstance(value, dict):
+        return dict((key, project(value[key], keep)) for key, keep in projection.iteritems() if key in value)
+    return value
+
+
+def encodeValue(value, compressAbove=1024):
+    """
+    encodeValue serializes a parsed response for the cache, compressing it if it's over compressAbove bytes
+    """
+    if value is NEGATIVE:
+        return '{}{}n'.format(CODEC_TAG, CODEC_VERSION)
+    payload = marshal.dumps(value, 2)
+    if compressAbove is not None and len(payload) > compressAbove:
+        return '{}{}z'.format(CODEC_TAG, CODEC_VERSION) + zlib.compress(payload)
+    return '{}{}m'.format(CODEC_TAG, CODEC_VERSION) + payload
+
+
+def decodeValue(entry, projection=True):
+    """
+    decodeValue returns the value held by a cache entry written by encodeValue. Raw JSON entries are parsed and
+    projected. Entries from any other codec version, or which are corrupt, raise ValueError.
+    """
+    if not entry.startswith(CODEC_TAG):
+        return project(json.loads(entry), projection)
+    header = '{}{}'.format(CODEC_TAG, CODEC_VERSION)
+    if not entry.startswith(header) or len(entry) <= len(header):
+        raise ValueError("Unknown cache codec version in {!r}".format(entry[:8]))
+    flag, payload = entry[len(header)], entry[len(header) + 1:]
+    if flag == 'n':
+        return NEGATIVE
+    try:
+        if flag == 'z':
+            payload = zlib.decompress(payload)
+        elif flag != 'm':
+            raise ValueError("Unknown cache codec flag {!r}".format(flag))
+        return marshal.loads(payload)
+    except (zlib.error, EOFError, TypeError) as e:
+        raise ValueError("Corrupt cache entry: {}".format(e))
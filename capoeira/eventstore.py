@@ -0,0 +1,155 @@
+import sys
+from collections import OrderedDict
+
+# marks a field an event doesn't have, as opposed to one it has as null
+_UNSET = object()
+
+
+class EventRecord(object):
+    """
+    EventRecord is a compact, shared copy of a songkick event. Records are handed out by an EventStore, so every request
+    which sees the same event holds the same record, and are only turned back into dicts when they're rendered.
+    """
+    __slots__ = ('id', 'displayName', 'type', 'uri', 'status', 'popularity', 'ageRestriction', 'start', 'location',
+                 'venue', 'performance', 'extra', 'size')
+    fields = __slots__[:-2]
+
+    def __getitem__(self, key):
+        # lets code which expects event dicts read records too
+        value = getattr(self, key, _UNSET) if key in self.fields else (self.extra or {}).get(key, _UNSET)
+        if value is _UNSET:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def toDict(self):
+        event = dict(self.extra or {})
+        for field in self.fields:
+            value = getattr(self, field, _UNSET)
+            if value is not _UNSET:
+                event[field] = value
+        return event
+
+
+class EventStore(object):
+    """
+    EventStore holds one EventRecord per songkick event id for the whole process, so that the same event returned to
+    many concurrent requests is only kept once. Strings are interned, so venues, artists and cities shared between events
+    are only kept once too. Records are evicted least recently used first once there are more than maxEvents of them or
+    their estimated size passes maxBytes; a request which still holds an evicted record keeps it until it's done.
+    """
+    # the intern table is cleared when it grows past this many strings; strings in live records stay shared
+    maxStrings = 200000
+
+    def __init__(self, maxEvents=50000, maxBytes=32 * 1024 * 1024):
+        self.maxEvents = maxEvents
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self._records = OrderedDict()  # event id -> EventRecord, least recently used first
+        self._strings = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, eventId):
+        return eventId in self._records
+
+    def _intern(self, value):
+        if isinstance(value, basestring):
+            if len(self._strings) >= self.maxStrings:
+                self._strings.clear()
+            return self._strings.setdefault(value, value)
+        if isinstance(value, dict):
+            return dict((self._intern(key), self._intern(item)) for key, item in value.iteritems())
+        if isinstance(value, list):
+            return [self._intern(item) for item in value]
+        return value
+
+    def _sizeOf(self, value):
+        # a rough estimate, which counts shared strings once per record
+        size = sys.getsizeof(value)
+        if isinstance(value, dict):
+            size += sum(self._sizeOf(key) + self._sizeOf(item) for key, item in value.iteritems())
+        elif isinstance(value, list):
+            size += sum(self._sizeOf(item) for item in value)
+        return size
+
+    def _unchanged(self, record, event):
+        # comparing is much cheaper than interning and sizing the event all over again
+        fields = sum(1 for field in EventRecord.fields if getattr(record, field, _UNSET) is not _UNSET)
+        if len(event) != fields + len(record.extra or {}):
+            return False
+        return all(record.get(key, _UNSET) == value for key, value in event.iteritems())
+
+    def add(self, event):
+        """
+        add stores a songkick event dict, returning the shared record for its id. If the id is already stored, the
+        record is returned as it is, unless the event has changed, in which case it's updated in place, so that every
+        holder sees the latest copy
+        """
+        eventId = event['id']
+        record = self._records.pop(eventId, None)
+        if record is not None and self._unchanged(record, event):
+            self._records[eventId] = record
+            return record
+        if record is None:
+            record = EventRecord()
+        else:
+            self.bytes -= record.size
+            for field in EventRecord.fields:
+                setattr(record, field, _UNSET)
+        record.extra = None
+        size = sys.getsizeof(record)
+        for key, value in event.iteritems():
+            value = self._intern(value)
+            size += self._sizeOf(value)
+            if key in EventRecord.fields:
+                setattr(record, key, value)
+            else:
+                if record.extra is None:
+                    record.extra = {}
+                record.extra[self._intern(key)] = value
+        record.size = size
+        self._records[eventId] = record
+        self.bytes += size
+        while len(self._records) > 1 and (len(self._records) > self.maxEvents or self.bytes > self.maxBytes):
+            self.bytes -= self._records.popitem(last=False)[1].size
+        return record
+
+    def get(self, eventId):
+        record = self._records.pop(eventId, None)
+        if record is not None:
+            self._records[eventId] = record
+        return record
+
+    def merge(self, eventLists):
+        """
+        merge adds every event in eventLists to the store, returning the distinct records in order of first appearance
+        """
+        seen = set()
+        merged = []
+        for events in eventLists:
+            for event in events:
+                eventId = event['id']
+                if eventId not in seen:
+                    seen.add(eventId)
+                    merged.append(self.add(event) if not isinstance(event, EventRecord) else event)
+        return merged
+
+
+_sharedEventStore = None
+
+
+def sharedEventStore():
+    """
+    sharedEventStore returns the process-wide EventStore, creating it on first use
+    """
+    global _sharedEventStore
+    if _sharedEventStore is None:
+        _sharedEventStore = EventStore()
+    return _sharedEventStore
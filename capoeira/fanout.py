@@ -0,0 +1,68 @@
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, DeferredList
+
+
+class BudgetedFanOut(object):
+    """
+    BudgetedFanOut calls queryFn(rank, item) for items, most important first, in waves which double in width. A new wave
+    only starts while the time left before deadline is at least what the last wave took. At the deadline, outstanding
+    queries are cancelled and the fan-out finishes with whatever has come back. run fires with a (results, covered) pair,
+    where results is in DeferredList format and covered counts the items which were answered.
+    """
+
+    def __init__(self, queryFn, items, deadline, initialWidth=25, clock=None):
+        self.queryFn = queryFn
+        self.items = items
+        self.deadline = deadline
+        self.width = initialWidth
+        self.clock = clock or reactor
+        self.results = []
+        self.covered = 0
+
+        self._next = 0
+        self._outstanding = []
+        self._expired = False
+        self._timer = None
+        self._done = None
+
+    def run(self):
+        self._done = Deferred()
+        remaining = self.deadline - self.clock.seconds()
+        if remaining <= 0 or not self.items:
+            self._finish()
+        else:
+            self._timer = self.clock.callLater(remaining, self._expire)
+            self._launch()
+        return self._done
+
+    def _launch(self):
+        wave = self.items[self._next:self._next + self.width]
+        waveStart = self.clock.seconds()
+        self._outstanding = [self.queryFn(rank, item) for rank, item in enumerate(wave, self._next)]
+        self._next += len(wave)
+        self.width *= 2
+        DeferredList(self._outstanding, consumeErrors=True).addCallback(self._waveDone, waveStart)
+
+    def _waveDone(self, results, waveStart):
+        self._outstanding = []
+        for success, result in results:
+            if not success and result.check(CancelledError):
+                continue
+            self.results.append((success, result))
+            self.covered += 1
+
+        elapsed = self.clock.seconds() - waveStart
+        if not self._expired and self._next < len(self.items) and self.deadline - self.clock.seconds() >= elapsed:
+            self._launch()
+        else:
+            self._finish()
+
+    def _expire(self):
+        self._expired = True
+        for query in list(self._outstanding):
+            query.cancel()
+
+    def _finish(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._done.callback((self.results, self.covered))
@@ -0,0 +1,94 @@
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, HTTPConnectionPool, PartialDownloadError, ResponseDone
+from twisted.web.error import Error
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+
+class _BodyReader(Protocol):
+    """
+    _BodyReader collects a response body, firing deferred with it once the response is complete
+    """
+
+    def __init__(self, response, deferred):
+        self.response = response
+        self.deferred = deferred
+        self.dataBuffer = []
+
+    def dataReceived(self, data):
+        self.dataBuffer.append(data)
+
+    def connectionLost(self, reason):
+        if self.deferred.called:  # cancelled by the read timeout
+            return
+        body = ''.join(self.dataBuffer)
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            self.deferred.errback(reason)
+        elif reason.check(PotentialDataLoss):
+            self.deferred.errback(PartialDownloadError(self.response.code, self.response.phrase, body))
+        elif self.response.code != 200:
+            self.deferred.errback(Error(self.response.code, self.response.phrase, body))
+        else:
+            self.deferred.callback(body)
+
+
+class PooledHTTPClient(object):
+    """
+    PooledHTTPClient fetches pages over persistent connections, keeping up to maxPerHost idle connections open for each
+    host for idleTimeout seconds. A single client is meant to be shared by every APIService talking to the same hosts.
+    """
+
+    def __init__(self, maxPerHost=10, idleTimeout=60, connectTimeout=5, readTimeout=15, clock=None):
+        self.clock = clock or reactor
+        self.pool = HTTPConnectionPool(self.clock, persistent=True)
+        self.pool.maxPersistentPerHost = maxPerHost
+        self.pool.cachedConnectionTimeout = idleTimeout
+        self.agent = Agent(self.clock, connectTimeout=connectTimeout, pool=self.pool)
+        self.readTimeout = readTimeout
+
+    def getPage(self, url):
+        """
+        getPage returns a Deferred firing with the body of url, failing with twisted.web.error.Error on a non-200
+        response and with CancelledError if the whole response doesn't arrive within readTimeout seconds
+        """
+        d = self.agent.request('GET', url, Headers({'User-Agent': ['capoeira']}))
+        d.addCallback(self._readBody)
+        if self.readTimeout:
+            timeoutCall = self.clock.callLater(self.readTimeout, d.cancel)
+            d.addBoth(self._cancelTimeout, timeoutCall)
+        return d
+
+    def _readBody(self, response):
+        def cancel(d):
+            # drop the connection rather than hand a half-read response back to the pool
+            reader.transport.stopProducing()
+
+        reader = _BodyReader(response, Deferred(cancel))
+        response.deliverBody(reader)
+        return reader.deferred
+
+    def _cancelTimeout(self, result, timeoutCall):
+        if timeoutCall.active():
+            timeoutCall.cancel()
+        return result
+
+    def close(self):
+        """
+        close drops every idle connection in the pool, returning a Deferred which fires once they're all closed
+        """
+        return self.pool.closeCachedConnections()
+
+
+_sharedClient = None
+
+
+def sharedHTTPClient():
+    """
+    sharedHTTPClient returns the process-wide default PooledHTTPClient, creating it on first use
+    """
+    global _sharedClient
+    if _sharedClient is None:
+        _sharedClient = PooledHTTPClient()
+    return _sharedClient
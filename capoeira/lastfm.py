@@ -1,47 +1,106 @@
 from apiservice import APIService
+from similaritygraph import similarFromResponse
+
+# the parts of similar artist and track responses which are worth caching
+SIMILAR_PROJECTION = {'similarartists': {'artist': {'name': True, 'mbid': True, 'match': True}, '@attr': True},
+                      'similartracks': {'track': {'name': True, 'mbid': True, 'match': True,
+                                                  'artist': {'name': True, 'mbid': True}},
+                                        '@attr': True},
+                      'error': True,
+                      'message': True}
 
 
 class LastFMAPIService(APIService):
+    upstreamName = 'lastfm'
+    secretParams = ('api_key',)
+    normalizedParams = ('artist', 'track', 'tag')
+    # last.fm asks for no more than 5 requests per second, averaged over 5 minutes
+    requestRate = 5
+    requestBurst = 25
+    # cache TTLs in seconds; similarity data moves slowly, so a week old list is still worth serving while it's refreshed
+    similarSoftTTL = 60 * 60 * 24
+    similarTTL = 60 * 60 * 24 * 7
+    # where the API lives; point it elsewhere to run against a stand-in
+    apiRoot = 'http://ws.audioscrobbler.com/2.0'
 
-    def __init__(self, apiKey, *args, **kwargs):
+    def __init__(self, apiKey, apiRoot=None, *args, **kwargs):
         APIService.__init__(self, *args, **kwargs)
         self._apiKey = apiKey
+        if apiRoot is not None:
+            self.apiRoot = apiRoot
         self.defaults = {'api_key': self._apiKey,
                          'format': 'json',
-                         '_baseURL': "http://ws.audioscrobbler.com/2.0/?"}
+                         '_baseURL': self.apiRoot + '/?'}
+        # a SimilarityGraph which every full similar artists response is recorded in, or None
+        self.similarityGraph = None
+
+    def _isErrorResponse(self, value):
+        # last.fm reports errors, like unknown artists or going over the rate limit, as {"error": code, "message": ...}
+        return isinstance(value, dict) and 'error' in value
 
     # BEGIN DEFINE API CALLS
 
     def _artistGetSimilar(self, artist, limit=1000, autocorrect=0):
         params = {'method': 'artist.getsimilar',
+                  '_endpoint': 'lastfm.similar',
                   'artist': artist,
                   'limit': limit,
-                  'autocorrect': autocorrect}
+                  'autocorrect': autocorrect,
+                  '_ttl': self.similarTTL,
+                  '_softTTL': self.similarSoftTTL,
+                  '_projection': SIMILAR_PROJECTION}
         return params
 
     def _trackGetSimilar(self, track, artist, limit=1000, autocorrect=0):
         params = {'method': 'track.getsimilar',
+                  '_endpoint': 'lastfm.similar',
                   'track': track,
                   'artist': artist,
                   'limit': limit,
-                  'autocorrect': autocorrect}
+                  'autocorrect': autocorrect,
+                  '_ttl': self.similarTTL,
+                  '_softTTL': self.similarSoftTTL,
+                  '_projection': SIMILAR_PROJECTION}
         return params
 
     def _tagGetSimilar(self, tag):
         params = {'method': 'tag.getsimilar',
-                  'tag': tag}
+                  '_endpoint': 'lastfm.similar',
+                  'tag': tag,
+                  '_ttl': self.similarTTL,
+                  '_softTTL': self.similarSoftTTL,
+                  '_projection': SIMILAR_PROJECTION}
         return params
 
     # END DEFINE API CALLS
 
     # /lastfm/artist/similar
     def lastFMArtistSimilar(self, *args, **kwargs):
-        response = self._deferredQuery(self._artistGetSimilar(*args, **kwargs))
+        priority = kwargs.pop('priority', 0)
+        parameters = self._artistGetSimilar(*args, **kwargs)
+        parameters['_priority'] = priority
+        response = self._deferredQuery(parameters)
+        if self.similarityGraph is not None:
+            response.addCallback(self._recordSimilar, parameters)
+        return response
+
+    def _recordSimilar(self, response, parameters):
+        similar = similarFromResponse(response)
+        try:
+            # a shortened list would hide the rest of the artist's neighbours
+            complete = int(parameters['limit']) >= self.similarityGraph.maxNeighbours
+        except ValueError:
+            complete = False
+        if similar is not None and complete:
+            self.similarityGraph.record(parameters['artist'], similar)
         return response
 
     # /lastfm/track/similar
     def lastFMTrackSimilar(self, *args, **kwargs):
-        response = self._deferredQuery(self._trackGetSimilar(*args, **kwargs))
+        priority = kwargs.pop('priority', 0)
+        parameters = self._trackGetSimilar(*args, **kwargs)
+        parameters['_priority'] = priority
+        response = self._deferredQuery(parameters)
         return response
 
     # /lastfm/tag/similar
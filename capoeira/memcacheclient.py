@@ -0,0 +1,165 @@
+import hashlib
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.protocols.memcache import MemCacheProtocol
+from twisted.python import log
+
+
+class _MemcacheClientProtocol(MemCacheProtocol):
+
+    def connectionMade(self):
+        MemCacheProtocol.connectionMade(self)
+        self.factory.client._connected(self)
+
+
+class _MemcacheClientFactory(ReconnectingClientFactory):
+    maxDelay = 30
+
+    def __init__(self, client):
+        self.client = client
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        protocol = _MemcacheClientProtocol(timeOut=self.client.timeout)
+        protocol.factory = self
+        return protocol
+
+    def clientConnectionLost(self, connector, reason):
+        self.client._disconnected()
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+
+class AsyncMemcacheClient(object):
+    """
+    AsyncMemcacheClient is a non-blocking memcache client which speaks the memcache protocol on the reactor over a
+    single reconnecting connection. It has the same get / add / set / delete API as the python-memcached client, but
+    returns Deferreds. Gets issued during the same reactor turn are pipelined into a single multi-get, so a whole fan-out
+    of lookups costs one round trip. While disconnected, reads miss and writes are dropped, but gets which are sent and
+    fail, such as on a timeout, fail rather than miss.
+    """
+
+    def __init__(self, host='127.0.0.1', port=11211, timeout=1, clock=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.clock = clock or reactor
+        self.factory = _MemcacheClientFactory(self)
+        self.protocol = None
+        self._batch = {}
+        self._flushCall = None
+
+    def connect(self):
+        self.clock.connectTCP(self.host, self.port, self.factory)
+        return self
+
+    def disconnect(self):
+        self.factory.stopTrying()
+        if self.protocol is not None:
+            self.protocol.transport.loseConnection()
+
+    def _connected(self, protocol):
+        self.protocol = protocol
+
+    def _disconnected(self):
+        self.protocol = None
+
+    def _safeKey(self, key):
+        """
+        _safeKey hashes keys which memcache won't accept as they are, because of their length or characters
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if len(key) > MemCacheProtocol.MAX_KEY_LENGTH or any(ord(char) <= 32 or ord(char) == 127 for char in key):
+            key = 'md5:' + hashlib.md5(key).hexdigest()
+        return key
+
+    def get(self, key):
+        key = self._safeKey(key)
+        if self.protocol is None:
+            return succeed(None)
+        waiters = self._batch.setdefault(key, [])
+
+        def cancel(d):
+            # a cancelled get still waiting for the batch to go out is dropped from it
+            if d in waiters:
+                waiters.remove(d)
+
+        d = Deferred(cancel)
+        waiters.append(d)
+        if self._flushCall is None:
+            self._flushCall = self.clock.callLater(0, self._flush)
+        return d
+
+    def _flush(self):
+        batch, self._batch = self._batch, {}
+        self._flushCall = None
+        batch = dict((key, waiters) for key, waiters in batch.iteritems() if waiters)
+        if not batch:
+            return
+
+        def deliver(values):
+            for key, waiters in batch.iteritems():
+                for waiter in waiters:
+                    if not waiter.called:
+                        waiter.callback(values.get(key))
+
+        def failed(failure):
+            # passed on, rather than turned into misses, so that callers can tell a miss from an error
+            for waiters in batch.itervalues():
+                for waiter in waiters:
+                    if not waiter.called:
+                        waiter.errback(failure)
+
+        d = self._getMultiple(batch.keys())
+        d.addCallbacks(deliver, failed)
+
+    def getMultiple(self, keys):
+        """
+        getMultiple returns a Deferred firing with a dict of key -> value, with None for every key which missed
+        """
+        def failed(failure):
+            log.err("Memcache get of {} keys failed: {}".format(len(keys), failure.getErrorMessage()))
+            return dict((key, None) for key in keys)
+
+        d = self._getMultiple(keys)
+        d.addErrback(failed)
+        return d
+
+    def _getMultiple(self, keys):
+        keys = dict((self._safeKey(key), key) for key in keys)
+        if self.protocol is None or not keys:
+            return succeed(dict((key, None) for key in keys.itervalues()))
+
+        def unpack(values):
+            return dict((keys[safeKey], value[1]) for safeKey, value in values.iteritems())
+
+        d = self.protocol.getMultiple(keys.keys())
+        d.addCallback(unpack)
+        return d
+
+    def _store(self, method, key, value, time):
+        if self.protocol is None:
+            return succeed(False)
+
+        def failed(failure):
+            log.err("Memcache {} of {} failed: {}".format(method, key, failure.getErrorMessage()))
+            return False
+
+        d = getattr(self.protocol, method)(self._safeKey(key), value, expireTime=time)
+        d.addErrback(failed)
+        return d
+
+    def set(self, key, value, time=0):
+        return self._store('set', key, value, time)
+
+    def add(self, key, value, time=0):
+        return self._store('add', key, value, time)
+
+    def delete(self, key):
+        if self.protocol is None:
+            return succeed(False)
+        d = self.protocol.delete(self._safeKey(key))
+        d.addErrback(lambda failure: False)
+        return d
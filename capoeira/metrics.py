@@ -0,0 +1,163 @@
+from collections import OrderedDict
+
+# the default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, description, labelNames=()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self._values = OrderedDict()  # label values -> value
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelNames):
+            raise ValueError("{} takes labels {}, not {}".format(self.name, self.labelNames, sorted(labels)))
+        return tuple(labels[name] for name in self.labelNames)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in self._values.iteritems():
+            yield self.name, key, (), value
+
+    def render(self, labels=()):
+        """
+        render returns the metric in the Prometheus text format, with the (name, value) pairs in labels added to every
+        sample
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, key, extra, value in self._samples():
+            lines.append('{}{} {}'.format(name, _formatLabels(self.labelNames, key, tuple(labels) + extra),
+                                          _formatValue(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelNames=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, description, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        self._values[key] = (counts, total + value)
+
+    def value(self, **labels):
+        """
+        value returns the number of observations
+        """
+        counts, total = self._values.get(self._key(labels), ([0], 0))
+        return sum(counts)
+
+    def _samples(self):
+        for key, (counts, total) in self._values.iteritems():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + '_bucket', key, (('le', _formatValue(bound)),), cumulative
+            yield self.name + '_sum', key, (), total
+            yield self.name + '_count', key, (), cumulative
+
+
+class MetricsRegistry(object):
+    """
+    MetricsRegistry holds a set of counters, gauges and histograms, and renders them in the Prometheus text format.
+    Labels set with setLabels are added to every sample, so that the series exported by each of several worker
+    processes can be told apart
+    """
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.labels = ()
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric {} is already registered".format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labelNames=()):
+        return self._register(Counter(name, description, labelNames))
+
+    def gauge(self, name, description, labelNames=()):
+        return self._register(Gauge(name, description, labelNames))
+
+    def histogram(self, name, description, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, description, labelNames, buckets))
+
+    def setLabels(self, **labels):
+        self.labels = tuple(sorted(labels.iteritems()))
+
+    def render(self):
+        return '\n'.join(metric.render(self.labels) for metric in self.metrics.itervalues()) + '\n'
+
+
+# the process-wide registry, served at /capoeira/metrics
+registry = MetricsRegistry()
+
+upstreamLatency = registry.histogram('capoeira_upstream_latency_seconds',
+                                     "Time taken by upstream API calls, from sending the request to reading the body",
+                                     ('endpoint',))
+upstreamRequests = registry.counter('capoeira_upstream_requests_total', "Upstream API calls made, by outcome",
+                                    ('endpoint', 'outcome'))
+upstreamInFlight = registry.gauge('capoeira_upstream_in_flight', "Upstream API calls in progress", ('endpoint',))
+cacheRequests = registry.counter('capoeira_cache_requests_total', "Cache lookups, by tier and result",
+                                 ('tier', 'result'))
+fanOutWidth = registry.histogram('capoeira_fanout_width', "Similar artists covered per events request", ('mode',),
+                                 buckets=(0, 10, 25, 50, 100, 250, 500, 1000))
+requestsInFlight = registry.gauge('capoeira_requests_in_flight', "Client requests in progress", ('path',))
+renderTime = registry.histogram('capoeira_render_seconds', "Time taken to render responses, by content type",
+                                ('content_type',), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+singleFlightCalls = registry.counter('capoeira_single_flight_calls_total',
+                                     "Calls which could share one already in flight, by who made them and whether they "
+                                     "did", ('name', 'result'))
+circuitState = registry.gauge('capoeira_circuit_state', "Upstream circuit breaker state: 0 closed, 1 half open, 2 open",
+                              ('upstream',))
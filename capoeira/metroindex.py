@@ -0,0 +1,86 @@
+import bisect
+import sqlite3
+
+from util import normalizeName
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class MetroAreaIndex(object):
+    """
+    MetroAreaIndex maps location names to songkick metro area ids, so that most location queries never leave the
+    process. It's built up from songkick location search results: the query itself maps to the first result, like
+    locationQuery, and every result's city and metro area names become aliases. Lookups are served from memory, while
+    the index is persisted to SQLite so it survives restarts.
+    """
+    # shortest partial name that a prefix lookup will try to complete
+    minPrefixLength = 3
+
+    def __init__(self, path=':memory:'):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS metro_areas "
+                        "(name TEXT PRIMARY KEY, metro_area_id INTEGER NOT NULL, display_name TEXT)")
+        self.db.commit()
+        self._names = dict(self.db.execute("SELECT name, metro_area_id FROM metro_areas"))
+        self._sortedNames = sorted(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def lookup(self, name, prefix=False):
+        """
+        lookup returns the metro area id for a name or an alias, or with prefix, an unambiguous prefix of one, or None on
+        a miss. A prefix can just as well be the whole name of a place the index doesn't know yet, so it's only worth
+        trying once songkick has nothing for the name
+        """
+        name = normalizeName(name)
+        if name in self._names:
+            return self._names[name]
+        if not prefix or len(name) < self.minPrefixLength:
+            return None
+        matches = set()
+        for index in xrange(bisect.bisect_left(self._sortedNames, name), len(self._sortedNames)):
+            if not self._sortedNames[index].startswith(name):
+                break
+            matches.add(self._names[self._sortedNames[index]])
+            if len(matches) > 1:
+                return None
+        return matches.pop() if matches else None
+
+    def _add(self, name, metroAreaId, displayName, replace=False):
+        name = normalizeName(name)
+        if not name or (name in self._names and not replace):
+            return
+        if name not in self._names:
+            bisect.insort(self._sortedNames, name)
+        self._names[name] = metroAreaId
+        self.db.execute("INSERT OR REPLACE INTO metro_areas VALUES (?, ?, ?)", (name, metroAreaId, displayName))
+
+    def record(self, query, locations):
+        """
+        record adds the location list from a songkick location search for query to the index
+        """
+        for index, location in enumerate(locations):
+            try:
+                metroArea = location['metroArea']
+                metroAreaId = metroArea['id']
+            except (KeyError, TypeError):
+                continue
+            displayName = _text(metroArea.get('displayName'))
+            if index == 0:
+                self._add(query, metroAreaId, displayName, replace=True)
+            city = location.get('city', {})
+            cityName = _text(city.get('displayName'))
+            names = [displayName, cityName]
+            qualifiers = [_text(city.get('state', {}).get('displayName')),
+                          _text(city.get('country', {}).get('displayName'))]
+            if cityName:
+                names.append(u', '.join([cityName] + [part for part in qualifiers if part]))
+            for name in names:
+                if name:
+                    self._add(name, metroAreaId, displayName)
+        self.db.commit()
@@ -1,13 +1,32 @@
+import json
+import random
+import zlib
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+
 class DictionaryCache(object):
 
     def __init__(self, *args, **kwargs):
         self.cache = {}
 
-    def add(self, key, value):
+    def add(self, key, value, time=0):
+        self.cache.setdefault(key, value)
+
+    def set(self, key, value, time=0):
         self.cache[key] = value
 
+    def delete(self, key):
+        self.cache.pop(key, None)
+
     def get(self, key):
-        return self.cache[key]
+        # like memcache, a miss returns None rather than raising
+        return self.cache.get(key)
 
 
 class MockRequest(object):
@@ -16,3 +35,218 @@ class MockRequest(object):
         self.args = dict()
         for key, value in args.iteritems():
             self.args[key] = [value]
+
+
+class MockHTTPClient(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def getPage(self, url):
+        d = Deferred()
+        self.requests.append((url, d))
+        return d
+
+    def close(self):
+        pass
+
+
+class MemcacheServerProtocol(LineReceiver):
+    """
+    MemcacheServerProtocol is an in-process stand-in for memcached, speaking enough of the text protocol (get, set, add,
+    delete) for AsyncMemcacheClient. Items never expire.
+    """
+    # a get for a batch of keys is a single line
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else {}
+        self.commands = []
+        self._pending = None
+        self._buffer = ''
+
+    def lineReceived(self, line):
+        parts = line.split()
+        self.commands.append(parts[0])
+        if parts[0] == 'get':
+            for key in parts[1:]:
+                if key in self.store:
+                    flags, value = self.store[key]
+                    self.sendLine('VALUE {} {} {}'.format(key, flags, len(value)))
+                    self.sendLine(value)
+            self.sendLine('END')
+        elif parts[0] in ('set', 'add'):
+            self._pending = (parts[0], parts[1], int(parts[2]), int(parts[4]))
+            self.setRawMode()
+        elif parts[0] == 'delete':
+            self.sendLine('DELETED' if self.store.pop(parts[1], None) else 'NOT_FOUND')
+        else:
+            self.sendLine('ERROR')
+
+    def rawDataReceived(self, data):
+        self._buffer += data
+        command, key, flags, length = self._pending
+        if len(self._buffer) < length + 2:
+            return
+        value, rest = self._buffer[:length], self._buffer[length + 2:]
+        self._pending, self._buffer = None, ''
+        if command == 'add' and key in self.store:
+            self.sendLine('NOT_STORED')
+        else:
+            self.store[key] = (flags, value)
+            self.sendLine('STORED')
+        self.setLineMode(rest)
+
+
+class MemcacheServerFactory(Factory):
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else {}
+
+    def buildProtocol(self, addr):
+        protocol = MemcacheServerProtocol(self.store)
+        protocol.factory = self
+        return protocol
+
+
+def fakeArtistName(index):
+    return 'Artist {}'.format(index)
+
+
+def _fakeArtistIndex(name, poolSize):
+    try:
+        return int(name.replace('+', ' ').rsplit(' ', 1)[-1]) % poolSize
+    except ValueError:
+        return zlib.crc32(name) % poolSize
+
+
+class FakeUpstreamResource(Resource):
+    """
+    FakeUpstreamResource is the base for local stand-ins for the upstream APIs. It answers after latency seconds, fails
+    errorRate of requests with a 503, and generates responses deterministically from a pool of poolSize artists, so that
+    runs can be compared. calls and errors count the requests it's had.
+    """
+    isLeaf = True
+
+    def __init__(self, latency=0, errorRate=0, poolSize=5000, seed=0, clock=None):
+        Resource.__init__(self)
+        self.latency = latency
+        self.errorRate = errorRate
+        self.poolSize = poolSize
+        self.clock = clock or reactor
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+
+    def respond(self, request):
+        raise NotImplementedError()
+
+    def render_GET(self, request):
+        self.calls += 1
+        failed = self._random.random() < self.errorRate
+        closed = []
+        request.notifyFinish().addBoth(closed.append)
+
+        def finish():
+            if closed:
+                return
+            if failed:
+                self.errors += 1
+                request.setResponseCode(503)
+                request.write('{"error": "unavailable"}')
+            else:
+                request.setHeader('Content-Type', 'application/json')
+                request.write(json.dumps(self.respond(request)))
+            request.finish()
+
+        if self.latency:
+            self.clock.callLater(self.latency, finish)
+        else:
+            finish()
+        return NOT_DONE_YET
+
+
+class FakeLastFMResource(FakeUpstreamResource):
+    """
+    FakeLastFMResource answers artist.getsimilar and track.getsimilar with up to similarArtists artists from the pool
+    """
+
+    def __init__(self, similarArtists=100, *args, **kwargs):
+        FakeUpstreamResource.__init__(self, *args, **kwargs)
+        self.similarArtists = similarArtists
+
+    def _similar(self, seed, limit):
+        count = min(limit, self.similarArtists, self.poolSize)
+        indexes = random.Random(seed).sample(xrange(self.poolSize), count)
+        return [{'name': fakeArtistName(index), 'mbid': '', 'match': '{:.6f}'.format(1 - float(rank) / count),
+                 'url': 'http://www.last.fm/music/Artist+{}'.format(index), 'streamable': '0'}
+                for rank, index in enumerate(indexes)]
+
+    def respond(self, request):
+        method = request.args.get('method', [''])[0]
+        limit = int(request.args.get('limit', [self.similarArtists])[0])
+        if method == 'artist.getsimilar':
+            artist = request.args.get('artist', [''])[0]
+            return {'similarartists': {'artist': self._similar(artist, limit), '@attr': {'artist': artist}}}
+        if method == 'track.getsimilar':
+            track = request.args.get('track', [''])[0]
+            tracks = [{'name': 'Track {}'.format(rank), 'match': artist['match'], 'artist': {'name': artist['name']}}
+                      for rank, artist in enumerate(self._similar(track, limit))]
+            return {'similartracks': {'track': tracks, '@attr': {'artist': request.args.get('artist', [''])[0]}}}
+        return {'error': 3, 'message': 'Invalid Method'}
+
+
+class FakeSongkickResource(FakeUpstreamResource):
+    """
+    FakeSongkickResource answers location searches, upcoming events for an artist and metro area calendars. Each artist
+    in the pool plays eventsPerArtist events, the first of which it shares with the next artist in the pool.
+    """
+
+    def __init__(self, eventsPerArtist=3, *args, **kwargs):
+        FakeUpstreamResource.__init__(self, *args, **kwargs)
+        self.eventsPerArtist = eventsPerArtist
+
+    def _event(self, eventId):
+        index = eventId // self.eventsPerArtist
+        performers = [index]
+        if eventId % self.eventsPerArtist == 0:
+            performers.append((index + 1) % self.poolSize)
+        return {'id': eventId,
+                'displayName': '{} at Venue {}'.format(fakeArtistName(index), eventId % 97),
+                'type': 'Concert',
+                'uri': 'http://www.songkick.com/concerts/{}'.format(eventId),
+                'status': 'ok',
+                'popularity': 0.01,
+                'start': {'date': '2014-{:02d}-{:02d}'.format(eventId % 12 + 1, eventId % 28 + 1), 'time': None},
+                'location': {'city': 'London, UK', 'lat': 51.5, 'lng': -0.13},
+                'venue': {'id': eventId % 97, 'displayName': 'Venue {}'.format(eventId % 97),
+                          'metroArea': {'id': 24426, 'displayName': 'London'}},
+                'performance': [{'id': eventId * 10 + billing, 'displayName': fakeArtistName(performer),
+                                 'billing': 'headline' if billing == 0 else 'support', 'billingIndex': billing + 1,
+                                 'artist': {'id': performer, 'displayName': fakeArtistName(performer)}}
+                                for billing, performer in enumerate(performers)]}
+
+    def _page(self, events, page=1, perPage=50, totalEntries=None):
+        return {'resultsPage': {'status': 'ok', 'page': page, 'perPage': perPage,
+                                'totalEntries': len(events) if totalEntries is None else totalEntries,
+                                'results': {'event': events} if events else {}}}
+
+    def respond(self, request):
+        if request.path.endswith('/search/locations.json'):
+            query = request.args.get('query', [''])[0]
+            metroAreaId = zlib.crc32(query) % 100000
+            return {'resultsPage': {'status': 'ok', 'page': 1, 'perPage': 50, 'totalEntries': 1,
+                                    'results': {'location': [{'city': {'displayName': query},
+                                                              'metroArea': {'displayName': query,
+                                                                            'id': metroAreaId}}]}}}
+        if request.path.endswith('/calendar.json'):
+            page = int(request.args.get('page', [1])[0])
+            perPage = int(request.args.get('per_page', [50])[0])
+            total = self.poolSize * self.eventsPerArtist
+            ids = xrange((page - 1) * perPage, min(total, page * perPage))
+            return self._page([self._event(eventId) for eventId in ids], page, perPage, total)
+        index = _fakeArtistIndex(request.args.get('artist_name', [''])[0], self.poolSize)
+        ids = range(index * self.eventsPerArtist, (index + 1) * self.eventsPerArtist)
+        # the event this artist supports the previous artist at
+        ids.append(((index - 1) % self.poolSize) * self.eventsPerArtist)
+        return self._page([self._event(eventId) for eventId in ids])
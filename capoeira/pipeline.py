@@ -0,0 +1,86 @@
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+
+
+class Pipeline(object):
+    """
+    Pipeline runs a small graph of named stages on the reactor. Each stage starts as soon as every stage it depends on
+    has finished, so independent stages run concurrently, and is called with its dependencies' results as keyword
+    arguments. Stages may return a value or a Deferred. The start and end time of every stage is recorded in timings.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or reactor
+        self.stages = OrderedDict()  # name -> (fn, dependsOn)
+        self.timings = OrderedDict()  # name -> (start, end)
+        self._results = {}
+        self._started = set()
+        self._done = None
+
+    def addStage(self, name, fn, dependsOn=()):
+        """
+        addStage adds a stage. Stages may only depend on stages added before them, which keeps the graph acyclic
+        """
+        if name in self.stages:
+            raise ValueError("Stage {} is already defined".format(name))
+        for dependency in dependsOn:
+            if dependency not in self.stages:
+                raise ValueError("Stage {} depends on undefined stage {}".format(name, dependency))
+        self.stages[name] = (fn, tuple(dependsOn))
+        return self
+
+    def run(self):
+        """
+        run starts the pipeline, returning a Deferred which fires with a dict of stage name -> result once every stage
+        has finished, or fails with the first stage failure
+        """
+        self._done = Deferred()
+        self._startReady()
+        return self._done
+
+    def _startReady(self):
+        for name, (fn, dependsOn) in self.stages.items():
+            if name in self._started or not all(dependency in self._results for dependency in dependsOn):
+                continue
+            self._started.add(name)
+            self.timings[name] = (self.clock.seconds(), None)
+            kwargs = dict((dependency, self._results[dependency]) for dependency in dependsOn)
+            d = maybeDeferred(fn, **kwargs)
+            d.addCallbacks(self._stageFinished, self._stageFailed, callbackArgs=(name,))
+
+    def _stageFinished(self, result, name):
+        self.timings[name] = (self.timings[name][0], self.clock.seconds())
+        self._results[name] = result
+        if self._done.called:
+            return
+        if len(self._results) == len(self.stages):
+            self._done.callback(dict(self._results))
+        else:
+            self._startReady()
+
+    def _stageFailed(self, failure):
+        if not self._done.called:
+            self._done.errback(failure)
+
+    def durations(self):
+        """
+        durations returns the run time of every finished stage, in seconds
+        """
+        return OrderedDict((name, end - start) for name, (start, end) in self.timings.iteritems() if end is not None)
+
+    def criticalPath(self):
+        """
+        criticalPath returns the chain of stages which decided when the pipeline finished, from first to last
+        """
+        finished = dict((name, end) for name, (start, end) in self.timings.iteritems() if end is not None)
+        if not finished:
+            return []
+        path = [max(finished, key=finished.get)]
+        while True:
+            dependsOn = [dependency for dependency in self.stages[path[-1]][1] if dependency in finished]
+            if not dependsOn:
+                break
+            path.append(max(dependsOn, key=finished.get))
+        return list(reversed(path))
@@ -0,0 +1,179 @@
+import heapq
+import json
+
+from twisted.application import service
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, DeferredList
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+class SpaceSaving(object):
+    """
+    SpaceSaving counts the most frequent items in a stream in at most capacity counters. Once it's full, a new item
+    takes over the smallest counter, inheriting its count as an error bound, so heavy hitters are never missed and their
+    counts are overestimated by at most their error.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self._counts = {}  # item -> [count, error]
+        self._heap = []  # (count, item), with stale entries skipped lazily
+
+    def __len__(self):
+        return len(self._counts)
+
+    def offer(self, item, weight=1):
+        counter = self._counts.get(item)
+        if counter is None:
+            error = 0
+            if len(self._counts) >= self.capacity:
+                error = self._evictSmallest()
+            counter = self._counts[item] = [error, error]
+        counter[0] += weight
+        heapq.heappush(self._heap, (counter[0], item))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, key) for key, (count, error) in self._counts.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _evictSmallest(self):
+        while True:
+            count, item = heapq.heappop(self._heap)
+            counter = self._counts.get(item)
+            if counter is not None and counter[0] == count:
+                del self._counts[item]
+                return count
+
+    def decay(self, factor):
+        """
+        decay scales every count by factor, so that recent traffic outweighs old traffic
+        """
+        for counter in self._counts.itervalues():
+            counter[0] *= factor
+            counter[1] *= factor
+        self._heap = [(count, item) for item, (count, error) in self._counts.iteritems()]
+        heapq.heapify(self._heap)
+
+    def top(self, k):
+        """
+        top returns the k most frequent items as (item, count, error), most frequent first
+        """
+        ranked = heapq.nlargest(k, self._counts.iteritems(), key=lambda entry: entry[1][0])
+        return [(item, count, error) for item, (count, error) in ranked]
+
+
+class CachePrewarmer(service.Service):
+    """
+    CachePrewarmer keeps the cache entries behind the most popular queries warm. CapoeiraAPIService records the seed
+    artist or track and metro area of every query with it, and a request log can be loaded to start it off. Every
+    interval seconds, the topK most popular seeds are queried again at refresh priority: fresh entries are cache hits,
+    entries past their soft TTL are refreshed in the background, and missing ones are fetched, all behind live traffic
+    and within each API's rate limits. Seeds are prewarmed one after another, for at most maxArtists similar artists.
+    """
+    interval = 15 * 60
+    topK = 50
+    maxArtists = 100
+    # counts are scaled by this after every round, so popularity follows traffic
+    decayFactor = 0.5
+
+    def __init__(self, capoeiraService, topK=None, interval=None, capacity=1000, clock=None):
+        self.capoeiraService = capoeiraService
+        if topK is not None:
+            self.topK = topK
+        if interval is not None:
+            self.interval = interval
+        self.clock = clock or reactor
+        self.sketch = SpaceSaving(capacity)
+        self._loop = None
+        self._running = None
+
+    def record(self, location, artist, track=None):
+        """
+        record counts a query for artist, or for track by artist, near location
+        """
+        if artist:
+            self.sketch.offer((location, artist, track))
+
+    def loadLog(self, path):
+        """
+        loadLog counts the artist and track queries in a JSON lines request log of {"path": ..., "args": {...}} entries,
+        as replayed by benchmark.py, resolving location names from the metro area index and skipping any it doesn't know
+        """
+        loaded = 0
+        with open(path) as requestLog:
+            for line in requestLog:
+                try:
+                    entry = json.loads(line)
+                    args = entry.get('args', {})
+                    path = entry.get('path', '')
+                except (ValueError, AttributeError):
+                    continue
+                if path not in ('/capoeira/events/similar/artist', '/capoeira/events/similar/track'):
+                    continue
+                location = self._location(args.get('location'))
+                if location is None:
+                    continue
+                self.record(location, args.get('artist'), args.get('track'))
+                loaded += 1
+        log.msg("loaded {} queries from {}".format(loaded, path))
+        return loaded
+
+    def _location(self, name):
+        if not name:
+            return 'sk:26330'
+        metroAreaId = self.capoeiraService.metroIndex.lookup(name)
+        return 'sk:' + str(metroAreaId) if metroAreaId is not None else None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._loop = LoopingCall(self.prewarm)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+    def prewarm(self):
+        """
+        prewarm starts a round of prewarming for the most popular seeds, unless the last round is still going
+        """
+        if self._running is not None:
+            log.msg("Skipping prewarm, the last round is still running")
+            return
+        seeds = [seed for seed, count, error in self.sketch.top(self.topK)]
+        self.sketch.decay(self.decayFactor)
+        self._running = self._prewarmSeeds(seeds)
+
+        def finished(_):
+            self._running = None
+
+        self._running.addBoth(finished)
+
+    @inlineCallbacks
+    def _prewarmSeeds(self, seeds):
+        for seed in seeds:
+            try:
+                yield self._prewarmSeed(*seed)
+            except Exception as e:
+                log.err("Prewarming {} failed: {}".format(seed, e))
+
+    @inlineCallbacks
+    def _prewarmSeed(self, location, artist, track=None):
+        lastfmService = self.capoeiraService.lastfmService
+        songkickService = self.capoeiraService.songkickService
+        if track:
+            response = yield lastfmService.lastFMTrackSimilar(track=track, artist=artist,
+                                                              priority=lastfmService.refreshPriority)
+        else:
+            response = yield lastfmService.lastFMArtistSimilar(artist=artist, priority=lastfmService.refreshPriority)
+
+        calendarIndex = self.capoeiraService.calendarIndex
+        if calendarIndex is not None:
+            calendarIndex.calendar(location)
+            return
+        names = self.capoeiraService._similarArtistNames(response)
+        yield DeferredList([songkickService.songkickUpcomingEvents(escaped, location=location,
+                                                                   priority=songkickService.refreshPriority)
+                            for escaped, raw in names[:self.maxArtists]], consumeErrors=True)
@@ -0,0 +1,107 @@
+import heapq
+import itertools
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+
+
+class QueryScheduler(object):
+    """
+    QueryScheduler runs upstream calls for a single API. Calls wait in a priority queue until a concurrency slot and a
+    token from the rate limiter are both available. Lower priority values run first, ties run in submission order.
+    """
+
+    def __init__(self, maxConcurrent=None, requestRate=None, requestBurst=None, clock=None):
+        self.maxConcurrent = maxConcurrent
+        self.requestRate = requestRate
+        self.requestBurst = requestBurst or max(1, requestRate or 1)
+        self.clock = clock or reactor
+
+        self._queue = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._tokens = float(self.requestBurst)
+        self._lastRefill = self.clock.seconds()
+        self._wakeup = None
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def pending(self):
+        return len([entry for entry in self._queue if entry[3] is not None])
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        submit queues fn(*args, **kwargs) and returns a Deferred firing with its result. Pass priority=n to jump the queue
+        """
+        priority = kwargs.pop('priority', 0)
+        entry = [priority, next(self._sequence), None, fn, args, kwargs, None]
+
+        def cancel(d):
+            # drop the call if it's still queued, otherwise pass the cancellation on to the running call
+            entry[3] = None
+            if entry[6] is not None:
+                entry[6].cancel()
+
+        entry[2] = Deferred(cancel)
+        heapq.heappush(self._queue, entry)
+        self._pump()
+        return entry[2]
+
+    def promote(self, d, priority):
+        """
+        promote moves a queued call, given by the Deferred submit returned for it, up to priority if that's sooner.
+        Returns whether it was still queued
+        """
+        for entry in self._queue:
+            if entry[2] is d and entry[3] is not None:
+                if priority < entry[0]:
+                    entry[0] = priority
+                    heapq.heapify(self._queue)
+                return True
+        return False
+
+    def _pump(self):
+        while self._queue and (self.maxConcurrent is None or self._active < self.maxConcurrent):
+            if self._queue[0][3] is None:  # cancelled while queued
+                heapq.heappop(self._queue)
+                continue
+            if not self._takeToken():
+                self._scheduleWakeup()
+                return
+            self._run(heapq.heappop(self._queue))
+
+    def _takeToken(self):
+        if self.requestRate is None:
+            return True
+        now = self.clock.seconds()
+        self._tokens = min(self.requestBurst, self._tokens + (now - self._lastRefill) * self.requestRate)
+        self._lastRefill = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _scheduleWakeup(self):
+        if self._wakeup is None or not self._wakeup.active():
+            delay = (1 - self._tokens) / self.requestRate
+            self._wakeup = self.clock.callLater(delay, self._wake)
+
+    def _wake(self):
+        self._wakeup = None
+        self._pump()
+
+    def _run(self, entry):
+        d, fn, args, kwargs = entry[2:6]
+        self._active += 1
+        running = maybeDeferred(fn, *args, **kwargs)
+        entry[6] = running
+        running.addBoth(self._finished)
+        running.chainDeferred(d)
+
+    def _finished(self, result):
+        self._active -= 1
+        self._pump()
+        return result
@@ -0,0 +1,272 @@
+import heapq
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+from util import nameKey
+
+# the graph file starts with a header, then a node table of (first edge, edge count, updated at) per node, with -1 for
+# updated at if the node's neighbours aren't known, then every node's neighbour ids, then their match weights, and then
+# each node's name and normalized name, length prefixed. Neighbours are stored most similar first. Bump GRAPH_VERSION
+# whenever the layout changes, so that older files are ignored rather than misread.
+GRAPH_MAGIC = 'CSG'
+GRAPH_VERSION = 2
+_HEADER = struct.Struct('<3sBIQ')
+_NODE = struct.Struct('<QId')
+_NAME_LENGTH = struct.Struct('<H')
+
+
+def similarFromResponse(response):
+    """
+    similarFromResponse returns the (name, match) pairs in a last.fm similar artists response, most similar first, or
+    None if it isn't one
+    """
+    try:
+        entries = response['similarartists']['artist']
+    except (KeyError, TypeError):
+        return None
+    if isinstance(entries, dict):
+        entries = [entries]
+    similar = []
+    for entry in entries:
+        try:
+            similar.append((entry['name'], float(entry.get('match', 0))))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            continue
+    return similar
+
+
+class SimilarityGraph(object):
+    """
+    SimilarityGraph keeps last.fm's artist similarity locally, so that similar artists can be found without asking
+    last.fm. Artist names are interned as integer ids, and each artist's similar artists are kept as arrays of ids and
+    match weights, most similar first. The graph is persisted to a file at path, which is memory mapped when it's loaded,
+    so that neighbours are only read from it as they're asked for; artists recorded since are kept in memory until the
+    next save. Names are all read when the file is loaded, and stay in memory. Neighbours recorded more than maxAge
+    seconds ago are stale.
+    """
+    maxAge = 60 * 60 * 24
+    # most neighbours kept per artist
+    maxNeighbours = 1000
+    # how many of an artist's neighbours, and of theirs, a two hop expansion looks through
+    expandWidth = 50
+    deferToThread = staticmethod(deferToThread)
+
+    def __init__(self, path=None, clock=None):
+        self.path = path
+        self.clock = clock or reactor
+        self._ids = {}  # normalized name -> id
+        self._names = []  # id -> name, as last.fm spells it
+        self._keys = []  # id -> normalized name
+        self._recorded = {}  # id -> (neighbour ids, weights, updated at), recorded since the file was loaded
+        self._file = None
+        self._map = None
+        self._nodeCount = 0
+        self._edgeCount = 0
+        self._saving = None
+        if path is not None and os.path.exists(path):
+            try:
+                self._load()
+            except (ValueError, struct.error, EnvironmentError) as e:
+                log.msg("Ignoring similarity graph {}: {}".format(path, e))
+                self._unmap()
+                self._ids, self._names, self._keys = {}, [], []
+
+    def __len__(self):
+        """
+        the number of artists whose neighbours are known
+        """
+        return sum(1 for nodeId in xrange(len(self._names)) if self._node(nodeId) is not None)
+
+    def _intern(self, name):
+        key = nameKey(name)
+        nodeId = self._ids.get(key)
+        if nodeId is None:
+            nodeId = self._ids[key] = len(self._names)
+            self._names.append(name)
+            self._keys.append(key)
+        return nodeId
+
+    def _open(self, path):
+        """
+        _open maps a graph file in, returning (file, map, node count, edge count)
+        """
+        graphFile = open(path, 'rb')
+        try:
+            graphMap = mmap.mmap(graphFile.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, nodeCount, edgeCount = _HEADER.unpack_from(graphMap, 0)
+        except Exception:
+            graphFile.close()
+            raise
+        if magic != GRAPH_MAGIC or version != GRAPH_VERSION:
+            graphMap.close()
+            graphFile.close()
+            raise ValueError("unknown graph format {!r} version {}".format(magic, version))
+        return graphFile, graphMap, nodeCount, edgeCount
+
+    def _load(self):
+        self._file, self._map, self._nodeCount, self._edgeCount = self._open(self.path)
+        offset = self._namesOffset()
+        for nodeId in xrange(self._nodeCount):
+            name, offset = self._readString(offset)
+            key, offset = self._readString(offset)
+            self._ids.setdefault(key, nodeId)
+            self._names.append(name)
+            self._keys.append(key)
+
+    def _readString(self, offset):
+        length, = _NAME_LENGTH.unpack_from(self._map, offset)
+        offset += _NAME_LENGTH.size
+        return self._map[offset:offset + length].decode('utf-8', 'replace'), offset + length
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._file = self._map = None
+        self._nodeCount = self._edgeCount = 0
+
+    def _namesOffset(self):
+        return _HEADER.size + self._nodeCount * _NODE.size + self._edgeCount * 8
+
+    def _node(self, nodeId):
+        """
+        _node returns (neighbour ids, weights, updated at) for a node, or None if its neighbours aren't known
+        """
+        return self._recorded.get(nodeId) or self._fileNode(nodeId)
+
+    def _fileNode(self, nodeId):
+        if nodeId >= self._nodeCount:
+            return None
+        first, count, updatedAt = _NODE.unpack_from(self._map, _HEADER.size + nodeId * _NODE.size)
+        if updatedAt < 0:
+            return None
+        idsAt = _HEADER.size + self._nodeCount * _NODE.size + first * 4
+        weightsAt = idsAt + self._edgeCount * 4
+        return (struct.unpack_from('<{}i'.format(count), self._map, idsAt),
+                struct.unpack_from('<{}f'.format(count), self._map, weightsAt), updatedAt)
+
+    def record(self, name, similar):
+        """
+        record sets the neighbours of the artist name to similar, a list of (name, match) pairs, most similar first
+        """
+        similar = similar[:self.maxNeighbours]
+        nodeId = self._intern(name)
+        ids = array('i', (self._intern(neighbour) for neighbour, match in similar))
+        weights = array('f', (match for neighbour, match in similar))
+        self._recorded[nodeId] = (ids, weights, self.clock.seconds())
+
+    def isStale(self, name):
+        """
+        isStale tells whether the neighbours of name are unknown, or were recorded more than maxAge seconds ago
+        """
+        nodeId = self._ids.get(nameKey(name))
+        node = self._node(nodeId) if nodeId is not None else None
+        return node is None or node[2] + self.maxAge <= self.clock.seconds()
+
+    def similar(self, name, k=None, hops=1):
+        """
+        similar returns up to k of the artists most similar to name as (name, match) pairs, or None if the neighbours
+        of name aren't known. With two hops, the neighbours of its closest neighbours are included too, scored by the
+        product of the matches along the way. Matches are kept as single precision floats, so come back rounded to the
+        six places last.fm gives them to
+        """
+        nodeId = self._ids.get(nameKey(name))
+        node = self._node(nodeId) if nodeId is not None else None
+        if node is None:
+            return None
+        ids, weights, updatedAt = node
+        if hops < 2:
+            count = len(ids) if k is None else min(k, len(ids))
+            return [(self._names[ids[index]], round(weights[index], 6)) for index in xrange(count)]
+
+        scores = {}
+        for neighbour, weight in zip(ids, weights):
+            if neighbour not in scores:
+                scores[neighbour] = weight
+        for neighbour, weight in zip(ids[:self.expandWidth], weights[:self.expandWidth]):
+            second = self._node(neighbour)
+            if second is None:
+                continue
+            for further, furtherWeight in zip(second[0][:self.expandWidth], second[1][:self.expandWidth]):
+                score = weight * furtherWeight
+                if further != nodeId and score > scores.get(further, 0):
+                    scores[further] = score
+        ranked = heapq.nlargest(k or len(scores), scores.iteritems(), key=lambda item: item[1])
+        return [(self._names[neighbour], round(score, 6)) for neighbour, score in ranked]
+
+    def save(self):
+        """
+        save writes the graph to path, in a thread, and maps the new file in once it's written. Returns a Deferred
+        """
+        if self.path is None or not self._recorded:
+            return succeed(None)
+        if self._saving is not None:
+            return self._saving
+        # the mapped file isn't touched until the new one is mapped in, so the thread can read it alongside us
+        names = list(self._names)
+        keys = list(self._keys)
+        recorded = dict(self._recorded)
+        d = self._saving = self.deferToThread(self._write, names, keys, recorded)
+
+        def written(opened):
+            # names are written in id order, so the ids we hold stay good for the new file, and only the map changes.
+            # Neighbours recorded while it was being written stay in memory until the next save
+            self._unmap()
+            self._file, self._map, self._nodeCount, self._edgeCount = opened
+            for nodeId, node in self._recorded.items():
+                if recorded.get(nodeId) is node:
+                    del self._recorded[nodeId]
+
+        def failed(failure):
+            log.err("Saving the similarity graph to {} failed: {}".format(self.path, failure.getErrorMessage()))
+
+        def finished(_):
+            self._saving = None
+
+        d.addCallback(written)
+        d.addErrback(failed)
+        d.addBoth(finished)
+        return d
+
+    def _write(self, names, keys, recorded):
+        nodes = [recorded.get(nodeId) or self._fileNode(nodeId) for nodeId in xrange(len(names))]
+        edgeCount = sum(len(node[0]) for node in nodes if node is not None)
+        # worker processes may share a path, so each writes its own temporary file, and the last rename wins
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temporary, 'wb') as graphFile:
+            graphFile.write(_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, len(names), edgeCount))
+            first = 0
+            for node in nodes:
+                count = len(node[0]) if node is not None else 0
+                graphFile.write(_NODE.pack(first, count, node[2] if node is not None else -1))
+                first += count
+            for column, typecode in ((0, 'i'), (1, 'f')):
+                for node in nodes:
+                    if node is not None:
+                        values = array(typecode, node[column])
+                        if sys.byteorder == 'big':
+                            values.byteswap()
+                        values.tofile(graphFile)
+            for name, key in zip(names, keys):
+                for value in (name, key):
+                    encoded = (value.encode('utf-8') if isinstance(value, unicode) else value)[:0xffff]
+                    graphFile.write(_NAME_LENGTH.pack(len(encoded)))
+                    graphFile.write(encoded)
+        # the file is mapped in before it's renamed into place, so that another worker's file taking its place can't
+        # be mapped in instead
+        opened = self._open(temporary)
+        try:
+            os.rename(temporary, self.path)
+        except Exception:
+            opened[1].close()
+            opened[0].close()
+            raise
+        return opened
@@ -0,0 +1,69 @@
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+from metrics import singleFlightCalls
+
+
+class SingleFlight(object):
+    """
+    SingleFlight lets concurrent callers asking for the same key share one outstanding call. calls counts every request
+    made through it, and coalesced counts the ones which were answered by joining a call already in flight; both are
+    exported under name, if it's given. Calls may pass priority=n, for a scheduler; when a caller joins a call with a
+    sooner priority, promote is called with the call's Deferred and that priority.
+    """
+
+    def __init__(self, name=None, promote=None):
+        self.name = name
+        self.promote = promote
+        self._inFlight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    @property
+    def inFlight(self):
+        return len(self._inFlight)
+
+    def call(self, key, fn, *args, **kwargs):
+        """
+        call returns a Deferred firing with the result of fn(*args, **kwargs), only calling fn if no call for key is
+        already outstanding
+        """
+        self.calls += 1
+        priority = kwargs.get('priority')
+        if self.name is not None:
+            singleFlightCalls.inc(name=self.name, result='coalesced' if key in self._inFlight else 'called')
+        if key in self._inFlight:
+            self.coalesced += 1
+            flight = self._inFlight[key]
+            if priority is not None and flight[2] is not None and priority < flight[2]:
+                flight[2] = priority
+                if self.promote is not None:
+                    self.promote(flight[0], priority)
+            return self._wait(flight)
+
+        flight = [None, [], priority]
+        self._inFlight[key] = flight
+        d = self._wait(flight)
+        flight[0] = maybeDeferred(fn, *args, **kwargs)
+        flight[0].addBoth(self._finished, key, flight)
+        return d
+
+    def _wait(self, flight):
+        def cancel(d):
+            # only give up on the shared call once nobody is waiting on it
+            flight[1].remove(d)
+            if not flight[1] and flight[0] is not None:
+                flight[0].cancel()
+
+        d = Deferred(cancel)
+        flight[1].append(d)
+        return d
+
+    def _finished(self, result, key, flight):
+        if self._inFlight.get(key) is flight:
+            del self._inFlight[key]
+        for waiter in flight[1]:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
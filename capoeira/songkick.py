@@ -1,6 +1,16 @@
 import datetime
 from apiservice import APIService
 
+# the parts of event listings which are worth caching: what clients are shown about each event, and what we join on
+EVENT_PROJECTION = {'id': True, 'displayName': True, 'type': True, 'uri': True, 'status': True, 'popularity': True,
+                    'ageRestriction': True, 'start': True, 'location': True,
+                    'venue': {'id': True, 'displayName': True, 'uri': True, 'lat': True, 'lng': True,
+                              'metroArea': {'id': True, 'displayName': True, 'uri': True}},
+                    'performance': {'id': True, 'displayName': True, 'billing': True, 'billingIndex': True,
+                                    'artist': {'id': True, 'displayName': True, 'uri': True}}}
+EVENTS_PROJECTION = {'resultsPage': {'status': True, 'error': True, 'page': True, 'perPage': True,
+                                     'totalEntries': True, 'results': {'event': EVENT_PROJECTION}}}
+
 
 class SongkickResponse(object):
 
@@ -27,39 +37,99 @@ class SongkickResponse(object):
 
 
 class SongkickAPIService(APIService):
+    upstreamName = 'songkick'
+    secretParams = ('apikey',)
+    normalizedParams = ('artist_name', 'query')
+    # songkick throttles keys that open too many connections, so keep the artist fan-out in check
+    maxConcurrent = 20
+    requestRate = 20
+    # cache TTLs in seconds; event calendars change daily, metro areas hardly ever
+    eventsSoftTTL = 60 * 60
+    eventsTTL = 60 * 60 * 12
+    # memcache reads TTLs over 30 days as timestamps, so that's as long as anything can live
+    locationSoftTTL = 60 * 60 * 24 * 7
+    locationTTL = 60 * 60 * 24 * 30
+    # where the API lives; point it elsewhere to run against a stand-in
+    apiRoot = 'http://api.songkick.com/api/3.0'
+    # how many days ahead to look for upcoming events
+    eventsWindow = 120
 
-    def __init__(self, apiKey, *args, **kwargs):
+    def __init__(self, apiKey, apiRoot=None, *args, **kwargs):
         APIService.__init__(self, *args, **kwargs)
         self._apiKey = apiKey
+        if apiRoot is not None:
+            self.apiRoot = apiRoot
         self.defaults = {'apikey': self._apiKey,
-                         '_baseURL': 'http://api.songkick.com/api/3.0/events.json?'}
+                         '_baseURL': self.apiRoot + '/events.json?'}
+
+    def _isErrorResponse(self, value):
+        # songkick wraps errors in a results page with an error status
+        return isinstance(value, dict) and value.get('resultsPage', {}).get('status', 'ok') != 'ok'
 
     # BEGIN DEFINE API CALLS
 
-    def upcomingEvents(self,
-                       artist,
-                       location='sk:26330',
-                       minDate=datetime.datetime.now().strftime("%Y-%m-%d"),
-                       maxDate=(datetime.datetime.now() + datetime.timedelta(days=120)).strftime("%Y-%m-%d")):
-        params = {'artist_name': artist,
+    def _dateWindow(self, minDate=None, maxDate=None):
+        # the date range is worked out on every call, to the day in UTC, so that it moves on, and cache keys with it,
+        # once a day
+        today = datetime.datetime.utcfromtimestamp(self.clock.seconds()).date()
+        return (minDate or today.isoformat(),
+                maxDate or (today + datetime.timedelta(days=self.eventsWindow)).isoformat())
+
+    def upcomingEvents(self, artist, location='sk:26330', minDate=None, maxDate=None):
+        minDate, maxDate = self._dateWindow(minDate, maxDate)
+        params = {'_endpoint': 'songkick.events',
+                  'artist_name': artist,
                   'location': location,
                   'min_date': minDate,
-                  'max_date': maxDate}
+                  'max_date': maxDate,
+                  '_ttl': self.eventsTTL,
+                  '_softTTL': self.eventsSoftTTL,
+                  '_projection': EVENTS_PROJECTION}
         return params
 
     def locationByName(self, name):
-        params = {'_baseURL': 'http://api.songkick.com/api/3.0/search/locations.json?',
-                  'query': name}
+        params = {'_baseURL': self.apiRoot + '/search/locations.json?',
+                  '_endpoint': 'songkick.location',
+                  'query': name,
+                  '_ttl': self.locationTTL,
+                  '_softTTL': self.locationSoftTTL}
+        return params
+
+    def metroAreaCalendar(self, metroAreaId, page=1, perPage=50, minDate=None, maxDate=None):
+        # calendars cover the same dates as artists' upcoming events, so that joining against one finds the same events
+        minDate, maxDate = self._dateWindow(minDate, maxDate)
+        params = {'_baseURL': '{}/metro_areas/{}/calendar.json?'.format(self.apiRoot, metroAreaId),
+                  '_endpoint': 'songkick.calendar',
+                  'page': page,
+                  'per_page': perPage,
+                  'min_date': minDate,
+                  'max_date': maxDate,
+                  '_ttl': self.eventsTTL,
+                  '_softTTL': self.eventsSoftTTL,
+                  '_projection': EVENTS_PROJECTION}
         return params
 
     # END DEFINE API CALLS
 
     # /songkick/events/upcoming
     def songkickUpcomingEvents(self, *args, **kwargs):
-        response = self._deferredQuery(self.upcomingEvents(*args, **kwargs))
+        priority = kwargs.pop('priority', 0)
+        parameters = self.upcomingEvents(*args, **kwargs)
+        parameters['_priority'] = priority
+        response = self._deferredQuery(parameters)
         return response
 
     # /songkick/location/name
     def songkickLocationByName(self, *args, **kwargs):
         response = self._deferredQuery(self.locationByName(*args, **kwargs))
         return response
+
+    # /songkick/metroarea/calendar
+    def songkickMetroAreaCalendar(self, *args, **kwargs):
+        priority = kwargs.pop('priority', 0)
+        bypassCache = kwargs.pop('bypassCache', False)
+        parameters = self.metroAreaCalendar(*args, **kwargs)
+        parameters['_priority'] = priority
+        parameters['_bypassCache'] = bypassCache
+        response = self._deferredQuery(parameters)
+        return response
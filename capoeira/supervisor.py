@@ -0,0 +1,259 @@
+import os
+import signal
+import socket
+import sys
+
+from twisted.application import service
+from twisted.internet import reactor, protocol
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.task import LoopingCall
+from twisted.protocols.policies import WrappingFactory
+from twisted.python import log
+
+# workers find the listening socket and the heartbeat pipe on these file descriptors, named in their environment,
+# along with their worker number, which a worker keeps when it's restarted
+LISTEN_FD = 3
+HEARTBEAT_FD = 4
+LISTEN_FD_ENV = 'CAPOEIRA_LISTEN_FD'
+HEARTBEAT_FD_ENV = 'CAPOEIRA_HEARTBEAT_FD'
+WORKER_NUMBER_ENV = 'CAPOEIRA_WORKER_NUMBER'
+
+
+def isWorker(environ=os.environ):
+    """
+    isWorker tells whether this process was started by a WorkerSupervisor
+    """
+    return LISTEN_FD_ENV in environ
+
+
+def workerNumber(environ=os.environ):
+    """
+    workerNumber returns this worker's number, from 0, or None if this process isn't a worker
+    """
+    if not isWorker(environ):
+        return None
+    return int(environ.get(WORKER_NUMBER_ENV, 0))
+
+
+def workerCommand(tacFile):
+    """
+    workerCommand returns the command line which runs tacFile in the foreground as a worker
+    """
+    return [sys.executable, '-c', 'from twisted.scripts.twistd import run; run()',
+            '--nodaemon', '--pidfile=', '--python', os.path.abspath(tacFile)]
+
+
+class _WorkerProcess(protocol.ProcessProtocol):
+    """
+    _WorkerProcess tracks one worker: its heartbeats, its output, which is passed on to our log, and when it ends
+    """
+
+    def __init__(self, supervisor, number):
+        self.supervisor = supervisor
+        self.number = number
+        self.lastHeartbeat = supervisor.clock.seconds()
+        self.retiring = False
+        self.ended = Deferred()
+
+    def childDataReceived(self, childFD, data):
+        if childFD == HEARTBEAT_FD:
+            self.lastHeartbeat = self.supervisor.clock.seconds()
+        else:
+            for line in data.splitlines():
+                log.msg("[worker {}] {}".format(self.number, line))
+
+    def signal(self, name):
+        try:
+            self.transport.signalProcess(name)
+        except ProcessExitedAlready:
+            pass
+
+    def processEnded(self, reason):
+        self.supervisor._workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerSupervisor(service.Service):
+    """
+    WorkerSupervisor binds the listening socket itself and hands it to workers worker processes running command, which
+    all accept connections from it. Workers heartbeat over a pipe, and one which misses heartbeatTimeout seconds of
+    heartbeats is killed. Workers which end are restarted. SIGHUP replaces the workers one at a time, so that there's
+    always a worker accepting connections, and stopping the supervisor stops the workers gracefully.
+    """
+    heartbeatTimeout = 30
+    checkInterval = 5
+    restartDelay = 1
+    # how long a worker has to finish its requests after being asked to stop, before it's killed
+    stopTimeout = 30
+    backlog = 128
+
+    def __init__(self, port, workers, command, interface='', env=None, clock=None):
+        self.port = port
+        self.workers = workers
+        self.command = command
+        self.interface = interface
+        self.env = env if env is not None else os.environ
+        self.clock = clock or reactor
+        self.processes = {}  # worker number -> _WorkerProcess
+        self.socket = None
+        self._checker = None
+
+    def _listen(self):
+        listening = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listening.bind((self.interface, self.port))
+        listening.listen(self.backlog)
+        listening.setblocking(False)
+        return listening
+
+    def startService(self):
+        service.Service.startService(self)
+        self.socket = self._listen()
+        for number in range(self.workers):
+            self._spawn(number)
+        self._checker = LoopingCall(self.checkHealth)
+        self._checker.clock = self.clock
+        self._checker.start(self.checkInterval, now=False)
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.clock.callFromThread(self.restart))
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._checker is not None and self._checker.running:
+            self._checker.stop()
+        d = DeferredList([self._retire(worker) for worker in self.processes.values()])
+        self.processes.clear()
+
+        def stopped(_):
+            self.socket.close()
+
+        d.addCallback(stopped)
+        return d
+
+    def _spawn(self, number):
+        env = dict(self.env)
+        env[LISTEN_FD_ENV] = str(LISTEN_FD)
+        env[HEARTBEAT_FD_ENV] = str(HEARTBEAT_FD)
+        env[WORKER_NUMBER_ENV] = str(number)
+        worker = _WorkerProcess(self, number)
+        self.clock.spawnProcess(worker, self.command[0], self.command, env=env,
+                                childFDs={0: 'w', 1: 'r', 2: 'r', LISTEN_FD: self.socket.fileno(), HEARTBEAT_FD: 'r'})
+        self.processes[number] = worker
+        return worker
+
+    def _retire(self, worker):
+        """
+        _retire asks a worker to stop, killing it if it hasn't within stopTimeout, and returns a Deferred which fires
+        once it's gone
+        """
+        worker.retiring = True
+        worker.signal('TERM')
+        timer = self.clock.callLater(self.stopTimeout, worker.signal, 'KILL')
+
+        def ended(_):
+            if timer.active():
+                timer.cancel()
+
+        worker.ended.addCallback(ended)
+        return worker.ended
+
+    def _workerEnded(self, worker, reason):
+        if worker.retiring or self.processes.get(worker.number) is not worker:
+            return
+        log.msg("Worker {} ended: {}".format(worker.number, reason.getErrorMessage()))
+        del self.processes[worker.number]
+        if self.running:
+            self.clock.callLater(self.restartDelay, self._respawn, worker.number)
+
+    def _respawn(self, number):
+        if self.running and number not in self.processes:
+            self._spawn(number)
+
+    def checkHealth(self):
+        """
+        checkHealth kills workers which have stopped heartbeating, so that they're restarted
+        """
+        now = self.clock.seconds()
+        for worker in self.processes.values():
+            if now - worker.lastHeartbeat > self.heartbeatTimeout:
+                log.msg("Worker {} missed its heartbeat, killing it".format(worker.number))
+                worker.signal('KILL')
+
+    def restart(self):
+        """
+        restart replaces the workers one at a time, starting each replacement before retiring the worker it replaces
+        """
+        d = succeed(None)
+        for number in sorted(self.processes):
+            d.addCallback(self._replace, number)
+        return d
+
+    def _replace(self, _, number):
+        if not self.running:
+            return None
+        old = self.processes.get(number)
+        self._spawn(number)
+        if old is not None:
+            return self._retire(old)
+
+
+class WorkerService(service.Service):
+    """
+    WorkerService serves factory on the listening socket handed down by a WorkerSupervisor, and heartbeats to it for as
+    long as the reactor is responsive. On stop, it stops accepting connections, closes idle ones, and gives requests in
+    progress up to drainTimeout seconds to finish.
+    """
+    heartbeatInterval = 5
+    drainTimeout = 20
+    drainPollInterval = 0.1
+
+    def __init__(self, factory, listenFD=LISTEN_FD, heartbeatFD=HEARTBEAT_FD, addressFamily=socket.AF_INET,
+                 clock=None):
+        self.factory = WrappingFactory(factory)
+        self.listenFD = listenFD
+        self.heartbeatFD = heartbeatFD
+        self.addressFamily = addressFamily
+        self.clock = clock or reactor
+        self.listeningPort = None
+        self._heartbeat = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.listeningPort = self.clock.adoptStreamPort(self.listenFD, self.addressFamily, self.factory)
+        os.close(self.listenFD)
+        self._heartbeat = LoopingCall(self.beat)
+        self._heartbeat.clock = self.clock
+        self._heartbeat.start(self.heartbeatInterval)
+
+    def beat(self):
+        try:
+            os.write(self.heartbeatFD, '.')
+        except OSError as e:
+            # the supervisor has gone away, so nobody will restart or stop us
+            log.msg("Lost the supervisor ({}), stopping".format(e))
+            self._heartbeat.stop()
+            self.clock.stop()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._heartbeat is not None and self._heartbeat.running:
+            self._heartbeat.stop()
+        d = self.listeningPort.stopListening() if self.listeningPort is not None else None
+        drained = Deferred()
+        deadline = self.clock.seconds() + self.drainTimeout
+
+        def poll():
+            for connection in self.factory.protocols.keys():
+                # keep-alive connections with no request in progress can go now
+                if not getattr(connection.wrappedProtocol, 'requests', None):
+                    connection.transport.loseConnection()
+            if not self.factory.protocols or self.clock.seconds() >= deadline:
+                drained.callback(None)
+            else:
+                self.clock.callLater(self.drainPollInterval, poll)
+
+        if d is None:
+            poll()
+        else:
+            d.addCallback(lambda _: poll())
+        return drained
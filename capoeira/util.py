@@ -1,5 +1,9 @@
+import re
 import sys
+import cgi
 import json
+import unicodedata
+import zlib
 
 
 def printSize(response):
@@ -33,7 +37,33 @@ def wrap(deferred):
     return lambda _: deferred
 
 
-def formatHTMLResponse(data):
+def materialize(value):
+    """
+    materialize is a json default hook which turns shared records, like EventRecords, back into dicts as they're written
+    """
+    if hasattr(value, 'toDict'):
+        return value.toDict()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def snapshot(value):
+    """
+    snapshot copies the dicts and lists in a response, turning shared records into dicts, so that it can be serialized
+    in another thread while the reactor goes on updating the records
+    """
+    if hasattr(value, 'toDict'):
+        return value.toDict()
+    if isinstance(value, dict):
+        return dict((key, snapshot(item)) for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [snapshot(item) for item in value]
+    return value
+
+
+def formatHTMLResponse(body):
+    """
+    formatHTMLResponse wraps an already serialized JSON body in a page, escaped
+    """
     return """
     <html>
       <body>
@@ -44,8 +74,93 @@ def formatHTMLResponse(data):
         </pre>
       </body>
     </html>
-    """.format(json.dumps(data, indent=4))
+    """.format(cgi.escape(body))
 
 
 def formatJSONResponse(data):
-    return json.dumps(data)
+    return json.dumps(data, default=materialize)
+
+
+def formatJSONChunks(data):
+    """
+    formatJSONChunks serializes data exactly as formatJSONResponse does, but one list item at a time, so that a thread
+    running it lets the reactor thread have the GIL in between
+    """
+    if isinstance(data, dict):
+        return '{' + ', '.join(json.dumps(key if isinstance(key, basestring) else json.dumps(key)) + ': ' +
+                               formatJSONChunks(value) for key, value in data.iteritems()) + '}'
+    if isinstance(data, list):
+        return '[' + ', '.join(formatJSONResponse(item) for item in data) + ']'
+    return formatJSONResponse(data)
+
+
+def compressBody(body, encoding, level=6):
+    """
+    compressBody encodes body with the gzip or deflate content coding
+    """
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(body) + compressor.flush()
+
+
+def acceptedEncoding(header, encodings=('gzip', 'deflate')):
+    """
+    acceptedEncoding returns the most preferred of encodings allowed by an Accept-Encoding header, or None
+    """
+    if not header:
+        return None
+    weights = {}
+    for part in header.split(','):
+        fields = part.split(';')
+        weight = 1.0
+        for param in fields[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[fields[0].strip().lower()] = weight
+    best, bestWeight = None, 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > bestWeight:
+            best, bestWeight = encoding, weight
+    return best
+
+
+def formatNDJSONRecord(kind, data):
+    return json.dumps({kind: data}, default=materialize) + "\n"
+
+
+def formatSSERecord(kind, data):
+    return "event: {}\ndata: {}\n\n".format(kind, json.dumps(data, default=materialize))
+
+
+def formatServerTiming(timings):
+    """
+    formatServerTiming formats a dict of step name -> seconds as a Server-Timing header value
+    """
+    return ', '.join('{};dur={:.1f}'.format(name, seconds * 1000) for name, seconds in timings.iteritems())
+
+
+def normalizeName(name):
+    """
+    normalizeName folds case, accents, punctuation and whitespace out of a name, so that names which only differ in
+    how they were typed compare equal
+    """
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'replace')
+    name = unicodedata.normalize('NFKD', name)
+    name = u''.join(char for char in name if not unicodedata.combining(char))
+    return u' '.join(re.sub(r'[^\w]+', u' ', name.lower(), flags=re.UNICODE).split())
+
+
+def nameKey(name):
+    """
+    nameKey returns the key a name is looked up under: its normalized form, or, for names made only of punctuation,
+    which normalize to nothing, the name as it is, lowercased
+    """
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'replace')
+    return normalizeName(name) or name.lower()
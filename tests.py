@@ -1,13 +1,51 @@
 # coding=utf-8
 import unittest
-from capoeira.mocks import DictionaryCache, MockRequest
-from capoeira.capoeira import CapoeiraAPIService
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+from calendar import timegm
+import zlib
+from twisted.internet.defer import CancelledError, Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.internet.error import ConnectionDone, ProcessTerminated
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import MemoryReactor, StringTransport
+from twisted.test import iosim
+from twisted.trial import unittest as trial
+from twisted.web.test.requesthelper import DummyRequest
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from twisted.web.error import Error
+from capoeira.mocks import DictionaryCache, MockRequest, MockHTTPClient, MemcacheServerProtocol
+from capoeira.mocks import FakeLastFMResource, FakeSongkickResource
+from capoeira.capoeira import CapoeiraAPIService, CapoeiraResource
 from capoeira.lastfm import LastFMAPIService
 from capoeira.songkick import SongkickAPIService, SongkickResponse
+from capoeira.scheduler import QueryScheduler
+from capoeira.httpclient import PooledHTTPClient
+from capoeira.singleflight import SingleFlight
+from capoeira.cache import LRUCache, TieredCache, packEntry, unpackEntry
+from capoeira.codec import decodeValue, encodeValue, project
+from capoeira.memcacheclient import AsyncMemcacheClient
+from capoeira.metroindex import MetroAreaIndex
+from capoeira.pipeline import Pipeline
+from capoeira import metrics
+from capoeira.supervisor import WorkerSupervisor, WorkerService, LISTEN_FD, HEARTBEAT_FD, LISTEN_FD_ENV
+from capoeira.supervisor import workerNumber
+from capoeira.eventstore import EventStore
+from capoeira.util import acceptedEncoding, formatHTMLResponse, formatJSONChunks, formatJSONResponse, nameKey
+from capoeira.calendar import MetroCalendarIndex
+from capoeira.prewarm import CachePrewarmer, SpaceSaving
+from capoeira.breaker import CircuitBreaker, CircuitOpenError
+from capoeira import similaritygraph
+from capoeira.similaritygraph import SimilarityGraph
 import memcache
 
 
-class TestCapoeira(unittest.TestCase):
+class TestCapoeira(trial.TestCase):
     def setUp(self, cache=None):
         if cache == 'mock':
             self.cache = DictionaryCache()
@@ -111,8 +149,11 @@ class TestSongkickFunctionality(TestCapoeira):
         self.assertEqual(result, 'sk:26330')
 
     def testSongkickUpcomingEventsSuccess(self):
-        self.songkickResponses['http://api.songkick.com/api/3.0/events.json?apikey=hijklmn&max_date=2014-07-29'
-                               '&min_date=2014-03-31&artist_name=Tiga&location=sk%3A26330'] = {
+        self.songkickService.clock = Clock()
+        self.songkickService.clock.advance(timegm((2014, 3, 31, 12, 0, 0)))
+        parameters = self.songkickService.upcomingEvents('Tiga')
+        self.assertEqual((parameters['min_date'], parameters['max_date']), ('2014-03-31', '2014-07-29'))
+        self.songkickResponses[self.songkickService._buildQuery(parameters)] = {
             "resultsPage": {
                 "status": "ok",
                 "results": {
@@ -195,5 +236,1564 @@ class TestSongkickFunctionality(TestCapoeira):
         self.assertTrue(result.success)
 
 
+def songkickEvents(*ids):
+    return {'resultsPage': {'status': 'ok',
+                            'results': {'event': [{'id': eventId, 'displayName': 'Event {}'.format(eventId)}
+                                                  for eventId in ids]}}}
+
+
+def calendarEvents(*events):
+    return [{'id': eventId, 'performance': [{'artist': {'displayName': name, 'id': index}, 'displayName': name}
+                                            for index, name in enumerate(performers)]}
+            for eventId, performers in events]
+
+
+class TestEventsBySimilarQuery(TestCapoeira):
+    def setUp(self):
+        super(TestEventsBySimilarQuery, self).setUp()
+        self.similarArtists = ['Tiga', 'Green Velvet']
+        self.eventQueries = {}
+        self.lastFMQueries = []
+
+        def _fakeLastFMDeferredQuery(parameters):
+            self.lastFMQueries.append(parameters)
+            return succeed({'similarartists': {'artist': [{'name': name} for name in self.similarArtists]}})
+
+        def _fakeSongkickDeferredQuery(parameters):
+            if 'artist_name' not in parameters:
+                return succeed({'resultsPage': {'status': 'ok', 'results': {}}})
+            self.eventQueries[parameters['artist_name']] = Deferred()
+            return self.eventQueries[parameters['artist_name']]
+
+        self.lastfmService._deferredQuery = _fakeLastFMDeferredQuery
+        self.songkickService._deferredQuery = _fakeSongkickDeferredQuery
+
+    def testMergedEvents(self):
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}))
+        self.eventQueries['Tiga'].callback(songkickEvents(1, 2))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2, 3))
+        self.assertEqual([event['id'] for event in d.result['events']], [1, 2, 3])
+        self.assertEqual(d.result['event_count'], 3)
+
+    def testLocationAndSimilarConcurrent(self):
+        location = Deferred()
+        self.capoeiraService.locationQuery = lambda request: location
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga', 'location': 'LA'}))
+        self.assertEqual(len(self.lastFMQueries), 1)
+        self.assertNotIn('location', self.lastFMQueries[0])
+        self.assertEqual(self.eventQueries, {})
+        location.callback('sk:17835')
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents())
+        self.assertEqual(d.result['event_count'], 1)
+
+    def testDeadlineReturnsPartialResults(self):
+        self.similarArtists = ['Tiga', 'Green Velvet', 'Boys Noize']
+        self.capoeiraService.clock = Clock()
+        self.capoeiraService.initialFanOut = 1
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga', 'deadline': '1000'}))
+        self.assertEqual(self.eventQueries.keys(), ['Tiga'])
+        self.capoeiraService.clock.advance(0.3)
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.assertEqual(sorted(self.eventQueries), ['Boys+Noize', 'Green+Velvet', 'Tiga'])
+        self.capoeiraService.clock.advance(0.2)
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        self.assertFalse(d.called)
+        self.capoeiraService.clock.advance(0.5)
+        self.assertEqual([event['id'] for event in d.result['events']], [1, 2])
+        self.assertEqual((d.result['artists_covered'], d.result['partial']), (2, True))
+        self.assertTrue(self.eventQueries['Boys+Noize'].called)
+
+    def testFailedAndEmptyResponsesSkipped(self):
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}))
+        self.eventQueries['Tiga'].callback({})
+        self.eventQueries['Green+Velvet'].callback(None)
+        self.assertEqual(d.result['event_count'], 0)
+
+    def testNoSimilarArtists(self):
+        self.lastfmService._deferredQuery = lambda parameters: succeed({})
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}))
+        self.assertEqual((d.result['event_count'], d.result['artists_covered']), (0, 0))
+
+    def testFailedLocationQueryFallsBack(self):
+        self.songkickService._deferredQuery = lambda parameters: succeed({})
+        d = self.capoeiraService.locationQuery(MockRequest({'location': 'Atlantis'}))
+        self.assertEqual(d.result, 'sk:26330')
+        self.assertEqual(self.capoeiraService.metroIndex.lookup('Atlantis'), None)
+
+    def testInvalidDeadlineIgnored(self):
+        self.capoeiraService.clock = Clock()
+        for deadline in ['soon', 'nan', 'inf', '-inf']:
+            self.assertEqual(self.capoeiraService._deadline(deadline), None)
+        self.capoeiraService.defaultDeadline = 2
+        self.assertEqual(self.capoeiraService._deadline('nan'), 2)
+        self.assertEqual(self.capoeiraService._deadline('500'), 0.5)
+
+    def testDeadlineNotCached(self):
+        resource = CapoeiraResource(self.capoeiraService)
+        self.capoeiraService.clock = Clock()
+        request = DummyRequest([])
+        request.path = '/capoeira/events/similar/artist'
+        request.args = {'artist': ['Tiga'], 'deadline': ['0']}
+        request.headers['accept'] = 'application/json'
+        request.render(resource)
+        self.assertEqual(json.loads(request.written[0])['partial'], True)
+        self.assertEqual(len(resource.responseCache), 0)
+
+    def testStreamedEvents(self):
+        streamed = []
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}), onEvent=streamed.append)
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2, 3))
+        self.assertEqual([event['id'] for event in streamed], [2, 3])
+        self.eventQueries['Tiga'].callback(songkickEvents(1, 2))
+        self.assertEqual([event['id'] for event in streamed], [2, 3, 1])
+        self.assertEqual(d.result['event_count'], 3)
+
+    def testCalendarJoin(self):
+        calendarIndex = MetroCalendarIndex(self.songkickService)
+        calendarIndex._loaded((calendarEvents((1, ['Green Velvet']), (2, ['TIGA', u'Green V\xe9lvet']),
+                                              (3, ['Other'])), False), 'sk:26330')
+        self.capoeiraService.calendarIndex = calendarIndex
+        streamed = []
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}), location='sk:26330',
+                                                              onEvent=streamed.append)
+        self.assertEqual(self.eventQueries, {})
+        self.assertEqual([event['id'] for event in d.result['events']], [2, 1])
+        self.assertEqual([event['id'] for event in streamed], [2, 1])
+        self.assertEqual((d.result['artists_covered'], d.result['partial']), (2, False))
+
+    def testStreamedEventsStoredOnce(self):
+        added = []
+        store = self.capoeiraService.eventStore = EventStore()
+        add = store.add
+        store.add = lambda event: added.append(event['id']) or add(event)
+        streamed = []
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}), onEvent=streamed.append)
+        self.eventQueries['Tiga'].callback(songkickEvents(1, 2))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2, 3))
+        self.assertEqual(sorted(added), [1, 2, 3])
+        self.assertEqual([event['id'] for event in d.result['events']], [1, 2, 3])
+        self.assertIs(d.result['events'][0], streamed[0])
+
+    def testTruncatedCalendarJoinPartial(self):
+        calendarIndex = MetroCalendarIndex(self.songkickService)
+        calendarIndex._loaded((calendarEvents((1, ['Tiga'])), True), 'sk:26330')
+        self.capoeiraService.calendarIndex = calendarIndex
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}), location='sk:26330')
+        self.assertEqual((d.result['event_count'], d.result['partial']), (1, True))
+
+    def testColdCalendarFallsBackToFanOut(self):
+        self.capoeiraService.calendarIndex = MetroCalendarIndex(self.songkickService)
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}), location='sk:26330')
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        self.assertEqual(d.result['event_count'], 2)
+
+    def testTrackQuery(self):
+        self.lastfmService._deferredQuery = lambda parameters: succeed(
+            {'similartracks': {'track': [{'name': 'Bugged Out', 'artist': {'name': 'Tiga'}},
+                                         {'name': 'Burning Up', 'artist': {'name': 'Tiga'}},
+                                         {'name': 'Flash', 'artist': {'name': 'Green Velvet'}}]}})
+        d = self.capoeiraService.capoeiraSimilarByTrackQuery(MockRequest({'track': 'You Gonna Want Me',
+                                                                          'artist': 'Tiga'}))
+        self.assertEqual(sorted(self.eventQueries), ['Green+Velvet', 'Tiga'])
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        self.assertEqual(d.result['event_count'], 2)
+
+    def testBatchQuery(self):
+        similar = {'Tiga': ['Green Velvet', 'Boys Noize'], 'Justice': ['Boys Noize', 'Daft Punk'],
+                   'Bugged Out': ['Tiga']}
+
+        def _fakeLastFMDeferredQuery(parameters):
+            self.lastFMQueries.append(parameters)
+            names = similar[parameters.get('track', parameters['artist'])]
+            return succeed({'similarartists': {'artist': [{'name': name} for name in names]}})
+
+        self.lastfmService._deferredQuery = _fakeLastFMDeferredQuery
+        locations = []
+        self.capoeiraService.locationQuery = lambda request: locations.append(request) or succeed('sk:17835')
+        request = MockRequest({'location': 'LA'})
+        request.args.update({'artist': ['Tiga', 'Justice'], 'track': ['Bugged Out'], 'track_artist': ['Tiga']})
+        d = self.capoeiraService.capoeiraSimilarBatchQuery(request)
+        self.assertEqual((len(locations), len(self.lastFMQueries)), (1, 3))
+        self.assertEqual(sorted(self.eventQueries), ['Boys+Noize', 'Daft+Punk', 'Green+Velvet', 'Tiga'])
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(1))
+        self.eventQueries['Boys+Noize'].callback(songkickEvents(2, 3))
+        self.eventQueries['Daft+Punk'].callback(songkickEvents(3, 4))
+        self.eventQueries['Tiga'].callback(songkickEvents())
+        self.assertEqual(d.result['event_count'], 4)
+        self.assertEqual(d.result['seeds'], [{'artist': 'Tiga', 'event_ids': [1, 2, 3]},
+                                             {'artist': 'Justice', 'event_ids': [2, 3, 4]},
+                                             {'track': 'Bugged Out', 'artist': 'Tiga', 'event_ids': []}])
+
+    def testBatchResponseKey(self):
+        resource = CapoeiraResource(self.capoeiraService)
+        keys = []
+        for artists in (['Tiga', 'Justice'], ['Tiga', 'Daft Punk'], ['Justice', 'Tiga']):
+            request = DummyRequest([])
+            request.path = '/capoeira/events/similar/batch'
+            request.args = {'artist': artists}
+            keys.append(resource._responseKey(request, 'application/json', 'sk:26330'))
+        self.assertEqual(len(set(keys)), 3)
+
+    def _render(self, accept, resource=None, artist='Tiga', headers=None):
+        request = DummyRequest([])
+        request.path = '/capoeira/events/similar/artist'
+        request.args = {'artist': [artist]}
+        request.headers['accept'] = accept
+        request.headers.update(headers or {})
+        request.render(resource or CapoeiraResource(self.capoeiraService))
+        return request
+
+    def testResponseCached(self):
+        resource = CapoeiraResource(self.capoeiraService)
+        first = self._render('application/json', resource)
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        second = self._render('application/json', resource, artist=' TIGA ')
+        self.assertEqual(len(self.lastFMQueries), 1)
+        self.assertEqual(first.written, second.written)
+        self.assertEqual(first.outgoingHeaders['etag'], second.outgoingHeaders['etag'])
+        html = self._render('text/html', resource)
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        self.assertEqual(len(self.lastFMQueries), 2)
+        self.assertNotEqual(html.outgoingHeaders['etag'], first.outgoingHeaders['etag'])
+
+    def testInjectedResponseCacheUsed(self):
+        responseCache = LRUCache()
+        resource = CapoeiraResource(self.capoeiraService, responseCache=responseCache)
+        self.assertIdentical(resource.responseCache, responseCache)
+
+    def testClientGoneBeforeResponse(self):
+        resource = CapoeiraResource(self.capoeiraService)
+        request = self._render('application/json', resource)
+        request.processingFailed(Failure(ConnectionDone()))
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        self.assertEqual((request.written, request.finished), ([], 0))
+        self.assertEqual(len(resource.responseCache), 1)
+
+    def testDegradedResponseCachedBriefly(self):
+        clock = Clock()
+        resource = CapoeiraResource(self.capoeiraService, responseCache=LRUCache(clock=clock))
+        self._render('application/json', resource)
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback({})
+        self.assertEqual(len(self.lastFMQueries), 1)
+        clock.advance(self.capoeiraService.negativeTTL + 1)
+        request = self._render('application/json', resource)
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        self.assertEqual(len(self.lastFMQueries), 2)
+        self.assertEqual(json.loads(request.written[0])['degraded'], False)
+
+    def testFailedSimilarLookupDegraded(self):
+        self.lastfmService._deferredQuery = lambda parameters: succeed({})
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}))
+        self.assertEqual((d.result['event_count'], d.result['degraded']), (0, True))
+
+    def testClientGoneBeforeFailure(self):
+        result = Deferred()
+        self.capoeiraService.capoeiraSimilarByArtistQuery = lambda *args, **kwargs: result
+        request = self._render('application/json')
+        request.processingFailed(Failure(ConnectionDone()))
+        result.errback(ValueError("broken"))
+        self.assertEqual((request.responseCode, request.finished), (None, 0))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def testFailedLocationFallsBackWhenRendering(self):
+        self.capoeiraService.locationQuery = lambda request: fail(ValueError("no location"))
+        request = self._render('application/json')
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        self.assertEqual(json.loads(request.written[0])['event_count'], 2)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def testServerTiming(self):
+        request = self._render('application/json')
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        steps = [step.split(';')[0] for step in request.outgoingHeaders['server-timing'].split(', ')]
+        self.assertEqual(steps, ['location', 'similar', 'events', 'render'])
+
+    def testConditionalGet(self):
+        resource = CapoeiraResource(self.capoeiraService)
+        first = self._render('application/json', resource)
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        etag = first.outgoingHeaders['etag']
+        second = self._render('application/json', resource, headers={'if-none-match': '"stale", ' + etag})
+        self.assertEqual(second.responseCode, 304)
+        self.assertEqual(second.written, [])
+        self.assertEqual(second.finished, 1)
+
+    def testCompressedResponse(self):
+        resource = CapoeiraResource(self.capoeiraService)
+        resource.compressAbove = 0
+        plain = self._render('application/json', resource)
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(2))
+        compressed = self._render('application/json', resource, headers={'accept-encoding': 'deflate;q=0.5, gzip'})
+        self.assertEqual(compressed.outgoingHeaders['content-encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(compressed.written[0], 16 + zlib.MAX_WBITS), plain.written[0])
+        self.assertNotEqual(compressed.outgoingHeaders['etag'], plain.outgoingHeaders['etag'])
+        self.assertEqual(len(resource.responseCache), 2)
+        again = self._render('application/json', resource,
+                             headers={'accept-encoding': 'gzip', 'if-none-match': compressed.outgoingHeaders['etag']})
+        self.assertEqual(again.responseCode, 304)
+
+    def testLargeResponseSerializedInThread(self):
+        resource = CapoeiraResource(self.capoeiraService)
+        resource.threadAbove = 1
+        threaded = []
+        resource.deferToThread = lambda fn, *args: threaded.append(fn) or succeed(fn(*args))
+        request = self._render('text/html', resource)
+        self.eventQueries['Tiga'].callback(songkickEvents(1, 2))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(3))
+        self.assertEqual(threaded, [formatJSONChunks])
+        self.assertIn('"event_count": 3', request.written[0])
+
+    def testNDJSONResponse(self):
+        request = self._render('application/x-ndjson')
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.assertEqual(len(request.written), 1)
+        self.eventQueries['Green+Velvet'].callback(songkickEvents(1, 2))
+        records = [json.loads(line) for line in ''.join(request.written).splitlines()]
+        self.assertEqual(records[:2], [{'event': {'id': 1, 'displayName': 'Event 1'}},
+                                       {'event': {'id': 2, 'displayName': 'Event 2'}}])
+        self.assertEqual(records[2], {'summary': {'event_count': 2, 'artists_covered': 2, 'partial': False,
+                                                  'degraded': False}})
+        self.assertEqual(request.finished, 1)
+
+    def testSSEResponse(self):
+        request = self._render('text/event-stream')
+        self.eventQueries['Tiga'].callback(songkickEvents(1))
+        self.eventQueries['Green+Velvet'].callback(songkickEvents())
+        self.assertEqual(request.written[0], 'event: event\ndata: {"displayName": "Event 1", "id": 1}\n\n')
+        self.assertTrue(request.written[-1].startswith('event: summary\n'))
+        self.assertEqual(request.outgoingHeaders['content-type'], 'text/event-stream')
+
+
+class TestEventStore(unittest.TestCase):
+    def setUp(self):
+        self.store = EventStore()
+
+    def _event(self, eventId, venue=u'Fabric'):
+        return {'id': eventId, 'displayName': u'Event {}'.format(eventId), 'venue': {'displayName': venue},
+                'series': {'displayName': u'Weekend'}}
+
+    def testSharedRecords(self):
+        first = self.store.merge([[self._event(1), self._event(2)], [self._event(2)]])
+        second = self.store.merge([[self._event(2), self._event(3)]])
+        self.assertEqual([record['id'] for record in first], [1, 2])
+        self.assertIs(first[1], second[0])
+        self.assertEqual(len(self.store), 3)
+
+    def testInternedStrings(self):
+        first, second = self.store.merge([[self._event(1, u''.join([u'Fab', u'ric'])), self._event(2)]])
+        self.assertIs(first['venue']['displayName'], second['venue']['displayName'])
+
+    def testMaterialize(self):
+        record = self.store.add(self._event(1))
+        self.assertEqual(record.toDict(), self._event(1))
+        self.assertEqual(json.loads(formatJSONResponse({'events': [record]})), {'events': [self._event(1)]})
+
+    def testNullFieldsKept(self):
+        event = dict(self._event(1), ageRestriction=None, note=None)
+        record = self.store.add(event)
+        self.assertEqual(record.toDict(), event)
+        self.assertEqual((record['ageRestriction'], record['note']), (None, None))
+        self.assertRaises(KeyError, lambda: record['uri'])
+        self.assertEqual(record.get('uri', 'missing'), 'missing')
+        self.store.add(self._event(1))
+        self.assertEqual(record.toDict(), self._event(1))
+
+    def testUpdatedInPlace(self):
+        record = self.store.add(self._event(1))
+        self.assertIs(self.store.add(self._event(1, u'Berghain')), record)
+        self.assertEqual(record['venue'], {'displayName': u'Berghain'})
+
+    def testUnchangedNotRebuilt(self):
+        record = self.store.add(self._event(1))
+        size = self.store.bytes
+        self.store._intern = lambda value: self.fail("interned an unchanged event")
+        self.assertIs(self.store.add(self._event(1)), record)
+        self.assertEqual(self.store.bytes, size)
+
+    def testEviction(self):
+        self.store.maxEvents = 2
+        record = self.store.add(self._event(1))
+        self.store.add(self._event(2))
+        self.store.get(1)
+        self.store.add(self._event(3))
+        self.assertEqual((1 in self.store, 2 in self.store, 3 in self.store), (True, False, True))
+        self.store.maxBytes = self.store.bytes - 1
+        self.store.add(self._event(4))
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.store.bytes, self.store.get(4).size)
+        self.assertEqual(record['id'], 1)
+
+
+class TestResponseFormatting(unittest.TestCase):
+    def testChunkedJSONMatches(self):
+        data = {'events': [{'id': 1, 'displayName': u'Caf\xe9 <3'}, {'id': 2}], 'event_count': 2, 'partial': False,
+                'seeds': [{'artist': 'Tiga', 'event_ids': [1]}], 'nested': {'a': [1, 2], 'b': None}}
+        self.assertEqual(formatJSONChunks(data), formatJSONResponse(data))
+
+    def testHTMLEscaped(self):
+        page = formatHTMLResponse(formatJSONResponse({'displayName': '</code><script>'}))
+        self.assertIn('&lt;/code&gt;&lt;script&gt;', page)
+        self.assertNotIn('<script>', page)
+
+    def testAcceptedEncoding(self):
+        self.assertEqual(acceptedEncoding(None), None)
+        self.assertEqual(acceptedEncoding('gzip, deflate'), 'gzip')
+        self.assertEqual(acceptedEncoding('gzip;q=0.2, deflate;q=0.8'), 'deflate')
+        self.assertEqual(acceptedEncoding('gzip;q=0, br'), None)
+        self.assertEqual(acceptedEncoding('*'), 'gzip')
+        self.assertEqual(acceptedEncoding('identity'), None)
+
+    def testNameKey(self):
+        self.assertEqual(nameKey(' GREEN  V\xc3\xa9lvet '), u'green velvet')
+        self.assertEqual(nameKey('!!!'), u'!!!')
+        self.assertNotEqual(nameKey(u'!!!'), nameKey(u'???'))
+
+
+class TestFakeUpstreams(unittest.TestCase):
+    def _get(self, resource, path, **args):
+        request = DummyRequest([])
+        request.path = path
+        request.args = dict((key, [str(value)]) for key, value in args.iteritems())
+        request.render(resource)
+        return request.responseCode, ''.join(request.written)
+
+    def testLastFMSimilar(self):
+        lastfm = FakeLastFMResource(similarArtists=50, poolSize=1000)
+        code, body = self._get(lastfm, '/2.0/', method='artist.getsimilar', artist='Tiga', limit=1000)
+        artists = json.loads(body)['similarartists']['artist']
+        self.assertEqual((code, len(artists)), (None, 50))
+        self.assertEqual(body, self._get(lastfm, '/2.0/', method='artist.getsimilar', artist='Tiga', limit=1000)[1])
+        self.assertEqual(lastfm.calls, 2)
+
+    def testSongkickEvents(self):
+        songkick = FakeSongkickResource(eventsPerArtist=2, poolSize=10)
+        code, body = self._get(songkick, '/api/3.0/events.json', artist_name='Artist+3')
+        events = json.loads(body)['resultsPage']['results']['event']
+        self.assertEqual([event['id'] for event in events], [6, 7, 4])
+        code, body = self._get(songkick, '/api/3.0/metro_areas/24426/calendar.json', page=2, per_page=15)
+        self.assertEqual(len(json.loads(body)['resultsPage']['results']['event']), 5)
+
+    def testErrorRate(self):
+        songkick = FakeSongkickResource(errorRate=1)
+        self.assertEqual(self._get(songkick, '/api/3.0/events.json', artist_name='Tiga')[0], 503)
+        self.assertEqual(songkick.errors, 1)
+
+    def testAPIRoot(self):
+        songkickService = SongkickAPIService("hijklmn", apiRoot='http://127.0.0.1:8000/api/3.0')
+        self.assertTrue(songkickService._buildQuery(songkickService.locationByName('LA')).startswith(
+            'http://127.0.0.1:8000/api/3.0/search/locations.json?'))
+        lastfmService = LastFMAPIService("abcdefg", apiRoot='http://127.0.0.1:8001/2.0')
+        self.assertTrue(lastfmService._buildQuery(lastfmService._artistGetSimilar('Tiga')).startswith(
+            'http://127.0.0.1:8001/2.0/?'))
+
+
+class TestMetroAreaIndex(unittest.TestCase):
+    locations = [{'city': {'displayName': 'Los Angeles', 'state': {'displayName': 'CA'},
+                           'country': {'displayName': 'US'}},
+                  'metroArea': {'displayName': 'Los Angeles', 'id': 17835}},
+                 {'city': {'displayName': u'Los \xc1ngeles', 'country': {'displayName': 'Chile'}},
+                  'metroArea': {'displayName': u'Los \xc1ngeles', 'id': 27512}}]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'metroareas.db')
+        self.index = MetroAreaIndex(self.path)
+        self.index.record('LA', self.locations)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testLookup(self):
+        self.assertEqual(self.index.lookup('la'), 17835)
+        self.assertEqual(self.index.lookup('  Los Angeles '), 17835)
+        self.assertEqual(self.index.lookup('los angeles, ca, us'), 17835)
+        self.assertEqual(self.index.lookup('Los Angeles, Chile'), 27512)
+        self.assertEqual(self.index.lookup('narnia'), None)
+
+    def testPrefixLookup(self):
+        self.assertEqual(self.index.lookup('los angeles, ch'), None)
+        self.assertEqual(self.index.lookup('los angeles, ch', prefix=True), 27512)
+        self.assertEqual(self.index.lookup('los ang', prefix=True), None)
+
+    def testPrefixOnlyWhenSongkickHasNothing(self):
+        self.index.record('Jacksonville', [{'city': {'displayName': 'Jacksonville'},
+                                            'metroArea': {'displayName': 'Jacksonville', 'id': 8618}}])
+        queried = []
+        results = {'Jackson': {'location': [{'city': {'displayName': 'Jackson'},
+                                             'metroArea': {'displayName': 'Jackson', 'id': 3373}}]},
+                   'Jacksonvil': {}}
+
+        def _fakeDeferredQuery(parameters):
+            queried.append(parameters['query'])
+            return succeed({'resultsPage': {'status': 'ok', 'results': results[parameters['query']]}})
+
+        songkickService = SongkickAPIService("hijklmn")
+        songkickService._deferredQuery = _fakeDeferredQuery
+        capoeiraService = CapoeiraAPIService(songkickService=songkickService, lastfmService=None,
+                                             metroIndex=self.index)
+        self.assertEqual(capoeiraService.locationQuery(MockRequest({'location': 'Jackson'})).result, 'sk:3373')
+        self.assertEqual(capoeiraService.locationQuery(MockRequest({'location': 'Jacksonvil'})).result, 'sk:8618')
+        self.assertEqual(queried, ['Jackson', 'Jacksonvil'])
+
+    def testPersisted(self):
+        self.assertEqual(MetroAreaIndex(self.path).lookup('los angeles, chile'), 27512)
+
+    def testLocationQueryUsesIndex(self):
+        songkickService = SongkickAPIService("hijklmn")
+        songkickService._deferredQuery = lambda parameters: self.fail("queried songkick")
+        capoeiraService = CapoeiraAPIService(songkickService=songkickService, lastfmService=None,
+                                             metroIndex=self.index)
+        result = capoeiraService.locationQuery(MockRequest({'location': 'Los Angeles'})).result
+        self.assertEqual(result, 'sk:17835')
+
+
+class TestMetroCalendarIndex(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.songkickService = SongkickAPIService("hijklmn")
+        self.pages = []
+        self.queries = []
+        self.failedPages = set()
+
+        def _fakeDeferredQuery(parameters):
+            self.pages.append((parameters['page'], parameters['_priority']))
+            self.queries.append(parameters)
+            page = parameters['page']
+            if page in self.failedPages:
+                return succeed({})
+            events = calendarEvents(*[(eventId, ['Tiga']) for eventId in (page * 2 - 1, page * 2) if eventId <= 3])
+            return succeed({'resultsPage': {'status': 'ok', 'totalEntries': 3, 'perPage': 2, 'page': page,
+                                            'results': {'event': events}}})
+
+        self.songkickService._deferredQuery = _fakeDeferredQuery
+        self.index = MetroCalendarIndex(self.songkickService, clock=self.clock)
+        self.index.perPage = 2
+
+    def testLoadPagesCalendar(self):
+        self.assertEqual(self.index.calendar('sk:26330'), None)
+        calendar = self.index.calendar('sk:26330')
+        self.assertEqual([event['id'] for event in calendar.eventsFor('tiga')], [1, 2, 3])
+        self.assertEqual(sorted(self.pages), [(1, self.songkickService.refreshPriority),
+                                              (2, self.songkickService.refreshPriority)])
+
+    def testRefreshInBackground(self):
+        self.index.load('sk:26330')
+        calendar = self.index.calendar('sk:26330')
+        self.clock.advance(self.index.refreshInterval)
+        self.assertIs(self.index.calendar('sk:26330'), calendar)
+        self.assertEqual(len(self.pages), 4)
+        self.assertIsNot(self.index.calendar('sk:26330'), calendar)
+
+    def testSameWindowAsUpcomingEvents(self):
+        self.clock.advance(timegm((2026, 10, 18, 12, 0, 0)))
+        self.index.load('sk:26330')
+        upcoming = self.songkickService.upcomingEvents('Tiga')
+        self.assertEqual(set((query['min_date'], query['max_date']) for query in self.queries),
+                         set([(upcoming['min_date'], upcoming['max_date'])]))
+
+    def testRefreshBypassesCache(self):
+        self.index.load('sk:26330')
+        self.assertEqual([query['_bypassCache'] for query in self.queries], [False, False])
+        self.index.load('sk:26330')
+        self.assertEqual([query['_bypassCache'] for query in self.queries[2:]], [True, True])
+
+    def testTruncationFlagged(self):
+        self.index.maxPages = 1
+        self.assertTrue(self.index.load('sk:26330').result.truncated)
+        self.assertEqual(len(self.pages), 1)
+
+    def testFailedFirstPageKeepsCalendar(self):
+        calendar = self.index.load('sk:26330').result
+        self.failedPages.add(1)
+        self.clock.advance(self.index.refreshInterval)
+        self.assertEqual(self.index.load('sk:26330').result, None)
+        self.assertIs(self.index.calendar('sk:26330'), calendar)
+
+    def testFailedPageFlagsTruncation(self):
+        self.failedPages.add(2)
+        calendar = self.index.load('sk:26330').result
+        self.assertEqual((len(calendar), calendar.truncated), (2, True))
+
+    def testEvictsLeastRecentlyUsed(self):
+        self.index.maxMetroAreas = 2
+        for location in ['sk:1', 'sk:2', 'sk:3']:
+            self.index.load(location)
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index._calendars.keys(), ['sk:2', 'sk:3'])
+
+
+class TestCachePrewarmer(TestCapoeira):
+    def setUp(self):
+        super(TestCachePrewarmer, self).setUp()
+        self.lastFMQueries = []
+        self.eventQueries = []
+        self.similar = {'similarartists': {'artist': [{'name': 'Green Velvet'}]}}
+
+        def _fakeLastFMDeferredQuery(parameters):
+            self.lastFMQueries.append(parameters)
+            return succeed(self.similar) if not isinstance(self.similar, Deferred) else self.similar
+
+        def _fakeSongkickDeferredQuery(parameters):
+            self.eventQueries.append(parameters)
+            return succeed(songkickEvents(len(self.eventQueries)))
+
+        self.lastfmService._deferredQuery = _fakeLastFMDeferredQuery
+        self.songkickService._deferredQuery = _fakeSongkickDeferredQuery
+        self.clock = Clock()
+        self.prewarmer = CachePrewarmer(self.capoeiraService, topK=1, interval=60, clock=self.clock)
+        self.capoeiraService.prewarmer = self.prewarmer
+
+    def testSketchKeepsHeavyHitters(self):
+        sketch = SpaceSaving(capacity=3)
+        for item in ['a', 'b', 'a', 'c', 'd', 'a', 'e', 'b', 'f', 'a']:
+            sketch.offer(item)
+        self.assertEqual(len(sketch), 3)
+        self.assertEqual(sketch.top(1)[0][:2], ('a', 4))
+        sketch.decay(0.5)
+        self.assertEqual(sketch.top(1)[0][:2], ('a', 2))
+
+    def _render(self, resource, args):
+        request = DummyRequest([])
+        request.path = '/capoeira/events/similar/artist'
+        request.args = args
+        request.headers['accept'] = 'application/json'
+        request.render(resource)
+        return request
+
+    def testLiveQueriesPrewarmed(self):
+        self.capoeiraService.metroIndex.lookup = {'london': 24426, 'la': 17835}.get
+        resource = CapoeiraResource(self.capoeiraService)
+        for location in ['london', 'london', 'la']:
+            self._render(resource, {'artist': ['Tiga'], 'location': [location]})
+        self.assertEqual(self.prewarmer.sketch.top(1)[0][:2], (('sk:24426', 'Tiga', None), 2))
+        del self.lastFMQueries[:], self.eventQueries[:]
+
+        self.prewarmer.startService()
+        self.clock.advance(60)
+        self.assertEqual([(query['artist'], query['_priority']) for query in self.lastFMQueries],
+                         [('Tiga', self.lastfmService.refreshPriority)])
+        self.assertEqual([(query['artist_name'], query['location'], query['_priority'])
+                          for query in self.eventQueries],
+                         [('Green+Velvet', 'sk:24426', self.songkickService.refreshPriority)])
+        self.prewarmer.stopService()
+
+    def testCachedResponsesCounted(self):
+        resource = CapoeiraResource(self.capoeiraService)
+        for _ in range(5):
+            self._render(resource, {'artist': ['Tiga']})
+        self.assertEqual(len(self.lastFMQueries), 1)
+        self.assertEqual(self.prewarmer.sketch.top(1)[0][:2], (('sk:26330', 'Tiga', None), 5))
+
+    def testSlowRoundNotOverlapped(self):
+        self.similar = Deferred()
+        self.prewarmer.record('sk:24426', 'Tiga')
+        self.prewarmer.prewarm()
+        self.prewarmer.prewarm()
+        self.assertEqual(len(self.lastFMQueries), 1)
+        self.similar.callback({'similarartists': {'artist': [{'name': 'Green Velvet'}]}})
+        self.similar = {}
+        self.prewarmer.prewarm()
+        self.assertEqual(len(self.lastFMQueries), 2)
+
+    def testLoadLog(self):
+        self.capoeiraService.metroIndex.lookup = {'london': 24426}.get
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'requests.log')
+        with open(path, 'w') as requestLog:
+            for entry in [{'path': '/capoeira/events/similar/artist', 'args': {'artist': 'Tiga', 'location': 'london'}},
+                          {'path': '/capoeira/events/similar/track',
+                           'args': {'artist': 'Tiga', 'track': 'Shoes', 'location': 'london'}},
+                          {'path': '/capoeira/events/similar/artist', 'args': {'artist': 'Tiga', 'location': 'mars'}},
+                          {'path': '/capoeira/metrics', 'args': {}}]:
+                requestLog.write(json.dumps(entry) + '\n')
+            requestLog.write('not json\n')
+        self.assertEqual(self.prewarmer.loadLog(path), 2)
+        self.assertEqual(sorted(seed for seed, count, error in self.prewarmer.sketch.top(5)),
+                         [('sk:24426', 'Tiga', None), ('sk:24426', 'Tiga', 'Shoes')])
+
+
+class TestSimilarityGraph(TestCapoeira):
+    def setUp(self):
+        super(TestSimilarityGraph, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'similarity.graph')
+        self.clock = Clock()
+        self.graph = self.newGraph()
+        self.graph.record('Tiga', [('Green Velvet', 0.9), ('Boys Noize', 0.5)])
+        self.graph.record('Green Velvet', [('Tiga', 0.9), ('Felix da Housecat', 0.8), ('Boys Noize', 0.7)])
+        self.lastFMQueries = []
+
+        def _fakeLastFMDeferredQuery(parameters):
+            self.lastFMQueries.append(parameters)
+            return succeed({'similarartists': {'artist': [{'name': 'Boys Noize', 'match': '0.6'}]}})
+
+        def _fakeSongkickDeferredQuery(parameters):
+            return succeed(songkickEvents())
+
+        self.lastfmService._deferredQuery = _fakeLastFMDeferredQuery
+        self.songkickService._deferredQuery = _fakeSongkickDeferredQuery
+        self.lastfmService.similarityGraph = self.graph
+        self.capoeiraService.similarityGraph = self.graph
+
+    def newGraph(self):
+        graph = SimilarityGraph(self.path, clock=self.clock)
+        graph.deferToThread = lambda f, *args: succeed(f(*args))
+        return graph
+
+    def testSimilar(self):
+        self.assertEqual(self.graph.similar('tiga'), [('Green Velvet', 0.9), ('Boys Noize', 0.5)])
+        self.assertEqual(self.graph.similar('Green  Velvet', k=1), [('Tiga', 0.9)])
+        self.assertEqual(self.graph.similar('Boys Noize'), None)
+        self.assertEqual(len(self.graph), 2)
+
+    def testTwoHops(self):
+        similar = self.graph.similar('Tiga', hops=2)
+        self.assertEqual(similar, [('Green Velvet', 0.9), ('Felix da Housecat', 0.72), ('Boys Noize', 0.63)])
+
+    def testStale(self):
+        self.assertFalse(self.graph.isStale('Tiga'))
+        self.assertTrue(self.graph.isStale('Boys Noize'))
+        self.clock.advance(self.graph.maxAge)
+        self.assertTrue(self.graph.isStale('Tiga'))
+
+    def testSaveAndLoad(self):
+        self.graph.save()
+        self.assertEqual(self.graph._recorded, {})
+        self.assertEqual(self.graph.similar('Tiga'), [('Green Velvet', 0.9), ('Boys Noize', 0.5)])
+        self.graph.record('Boys Noize', [(u'Mr. Oizo', 0.4)])
+        self.graph.save()
+        loaded = self.newGraph()
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(loaded.similar('green velvet', k=2), [('Tiga', 0.9), ('Felix da Housecat', 0.8)])
+        self.assertEqual(loaded.similar('boys noize'), [(u'Mr. Oizo', 0.4)])
+        self.assertFalse(loaded.isStale('Tiga'))
+
+    def testNamesNotNormalizedOnSaveOrLoad(self):
+        def nameKey(name):
+            self.fail("normalized {}".format(name))
+
+        self.graph.save()
+        self.graph.record('Boys Noize', [('Tiga', 0.5)])
+        original, similaritygraph.nameKey = similaritygraph.nameKey, nameKey
+        self.addCleanup(setattr, similaritygraph, 'nameKey', original)
+        self.graph.save()
+        loaded = self.newGraph()
+        similaritygraph.nameKey = original
+        self.assertEqual(self.graph.similar('Boys Noize'), [('Tiga', 0.5)])
+        self.assertEqual(loaded._ids, self.graph._ids)
+        self.assertEqual(loaded.similar('Boys Noize'), [('Tiga', 0.5)])
+
+    def testUnreadableFileIgnored(self):
+        with open(self.path, 'w') as graphFile:
+            graphFile.write('not a graph')
+        self.assertEqual(len(self.newGraph()), 0)
+
+    def testQueryServedFromGraph(self):
+        d = self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}), location='sk:24426')
+        self.assertEqual(d.result['event_count'], 0)
+        self.assertEqual(self.lastFMQueries, [])
+
+    def testStaleQueryRefreshed(self):
+        self.clock.advance(self.graph.maxAge)
+        self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}), location='sk:24426')
+        self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Tiga'}), location='sk:24426')
+        self.assertEqual([(query['artist'], query['_priority']) for query in self.lastFMQueries],
+                         [('Tiga', self.lastfmService.refreshPriority)])
+        self.assertEqual(self.graph.similar('Tiga'), [('Boys Noize', 0.6)])
+        self.assertFalse(self.graph.isStale('Tiga'))
+
+    def testUnknownArtistRecorded(self):
+        self.capoeiraService.capoeiraSimilarByArtistQuery(MockRequest({'artist': 'Boys Noize'}), location='sk:24426')
+        self.assertEqual(len(self.lastFMQueries), 1)
+        self.assertEqual(self.graph.similar('Boys Noize'), [('Boys Noize', 0.6)])
+        self.lastfmService.lastFMArtistSimilar(artist='Mr. Oizo', limit=10)
+        self.assertEqual(self.graph.similar('Mr. Oizo'), None)
+
+
+class TestMetrics(unittest.TestCase):
+    def testRender(self):
+        registry = metrics.MetricsRegistry()
+        counter = registry.counter('hits_total', "Hits", ('tier',))
+        histogram = registry.histogram('latency_seconds', "Latency", buckets=(0.1, 1))
+        counter.inc(tier='local')
+        counter.inc(2, tier='re"mote')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP hits_total Hits', '# TYPE hits_total counter',
+            'hits_total{tier="local"} 1', 'hits_total{tier="re\\"mote"} 2',
+            '# HELP latency_seconds Latency', '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1', 'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 2', 'latency_seconds_sum 0.55', 'latency_seconds_count 2']) + '\n')
+        self.assertRaises(ValueError, counter.inc, endpoint='x')
+
+    def testWorkerLabel(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter('hits_total', "Hits", ('tier',)).inc(tier='local')
+        registry.histogram('latency_seconds', "Latency", buckets=(1,)).observe(0.5)
+        registry.setLabels(worker=1)
+        rendered = registry.render()
+        self.assertIn('hits_total{tier="local",worker="1"} 1', rendered)
+        self.assertIn('latency_seconds_bucket{worker="1",le="1"} 1', rendered)
+        self.assertIn('latency_seconds_sum{worker="1"} 0.5', rendered)
+
+    def testUpstreamLatency(self):
+        clock = Clock()
+        httpClient = MockHTTPClient()
+        songkickService = SongkickAPIService("hijklmn", httpClient=httpClient, clock=clock)
+        before = metrics.upstreamLatency.value(endpoint='songkick.location')
+        songkickService.songkickLocationByName('los angeles')
+        self.assertEqual(metrics.upstreamInFlight.value(endpoint='songkick.location'), 1)
+        clock.advance(0.2)
+        httpClient.requests[0][1].callback('{}')
+        self.assertEqual(metrics.upstreamInFlight.value(endpoint='songkick.location'), 0)
+        self.assertEqual(metrics.upstreamLatency.value(endpoint='songkick.location'), before + 1)
+
+    def testCacheTiers(self):
+        cache = TieredCache(LRUCache(), DictionaryCache())
+        localHits = metrics.cacheRequests.value(tier='local', result='hit')
+        remoteMisses = metrics.cacheRequests.value(tier='remote', result='miss')
+        cache.get('a')
+        cache.set('a', '1')
+        cache.get('a')
+        self.assertEqual(metrics.cacheRequests.value(tier='local', result='hit'), localHits + 1)
+        self.assertEqual(metrics.cacheRequests.value(tier='remote', result='miss'), remoteMisses + 1)
+
+    def testSingleFlightCalls(self):
+        singleFlight = SingleFlight('test')
+        before = metrics.singleFlightCalls.value(name='test', result='coalesced')
+        singleFlight.call('a', Deferred)
+        singleFlight.call('a', Deferred)
+        self.assertEqual(metrics.singleFlightCalls.value(name='test', result='coalesced'), before + 1)
+        self.assertIn('capoeira_single_flight_calls_total{name="test",result="called"}', metrics.registry.render())
+
+    def testMetricsPath(self):
+        service = CapoeiraAPIService(songkickService=None, lastfmService=None)
+        request = DummyRequest([])
+        request.path = '/capoeira/metrics'
+        request.render(CapoeiraResource(service))
+        self.assertTrue(request.outgoingHeaders['content-type'].startswith('text/plain'))
+        self.assertIn('# TYPE capoeira_upstream_latency_seconds histogram', ''.join(request.written))
+        self.assertNotIn('capoeira_circuit_state{upstream="other"}', ''.join(request.written))
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.pipeline = Pipeline(clock=self.clock)
+        self.stages = {}
+
+    def _stage(self, name):
+        def run(**kwargs):
+            self.stages[name] = (Deferred(), kwargs)
+            return self.stages[name][0]
+        return run
+
+    def testIndependentStagesRunConcurrently(self):
+        self.pipeline.addStage('location', self._stage('location'))
+        self.pipeline.addStage('similar', self._stage('similar'))
+        self.pipeline.addStage('events', self._stage('events'), dependsOn=('location', 'similar'))
+        d = self.pipeline.run()
+        self.assertEqual(sorted(self.stages), ['location', 'similar'])
+        self.clock.advance(1)
+        self.stages['location'][0].callback('sk:1')
+        self.clock.advance(2)
+        self.stages['similar'][0].callback(['Tiga'])
+        self.assertEqual(self.stages['events'][1], {'location': 'sk:1', 'similar': ['Tiga']})
+        self.clock.advance(4)
+        self.stages['events'][0].callback('merged')
+        self.assertEqual(d.result, {'location': 'sk:1', 'similar': ['Tiga'], 'events': 'merged'})
+        self.assertEqual(dict(self.pipeline.durations()), {'location': 1, 'similar': 3, 'events': 4})
+        self.assertEqual(self.pipeline.criticalPath(), ['similar', 'events'])
+
+    def testStageFailure(self):
+        self.pipeline.addStage('location', lambda: 1 / 0)
+        self.pipeline.addStage('events', self._stage('events'), dependsOn=('location',))
+        failures = []
+        self.pipeline.run().addErrback(failures.append)
+        self.assertTrue(failures[0].check(ZeroDivisionError))
+        self.assertNotIn('events', self.stages)
+
+    def testUndefinedDependency(self):
+        self.assertRaises(ValueError, self.pipeline.addStage, 'events', self._stage('events'), ('location',))
+
+
+class TestQueryScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.calls = []
+
+    def _call(self, name):
+        d = Deferred()
+        self.calls.append((name, d))
+        return d
+
+    def testConcurrencyCap(self):
+        scheduler = QueryScheduler(maxConcurrent=2, clock=self.clock)
+        results = [scheduler.submit(self._call, name) for name in 'abc']
+        self.assertEqual([name for name, _ in self.calls], ['a', 'b'])
+        self.assertEqual(scheduler.pending, 1)
+        self.calls[0][1].callback('done')
+        self.assertEqual(results[0].result, 'done')
+        self.assertEqual([name for name, _ in self.calls], ['a', 'b', 'c'])
+
+    def testPriorityOrder(self):
+        scheduler = QueryScheduler(maxConcurrent=1, clock=self.clock)
+        scheduler.submit(self._call, 'first')
+        scheduler.submit(self._call, 'low', priority=10)
+        scheduler.submit(self._call, 'high', priority=1)
+        self.calls[0][1].callback(None)
+        self.calls[1][1].callback(None)
+        self.assertEqual([name for name, _ in self.calls], ['first', 'high', 'low'])
+
+    def testJoinedCallPromoted(self):
+        scheduler = QueryScheduler(maxConcurrent=1, clock=self.clock)
+        singleFlight = SingleFlight(promote=scheduler.promote)
+        scheduler.submit(self._call, 'first')
+        scheduler.submit(self._call, 'live', priority=0)
+        singleFlight.call('refresh', scheduler.submit, self._call, 'refresh', priority=10000)
+        scheduler.submit(self._call, 'later live', priority=0)
+        singleFlight.call('refresh', scheduler.submit, self._call, 'refresh', priority=0)
+        for _ in range(3):
+            self.calls[-1][1].callback(None)
+        self.assertEqual([name for name, _ in self.calls], ['first', 'live', 'refresh', 'later live'])
+
+    def testTokenBucket(self):
+        scheduler = QueryScheduler(requestRate=2, requestBurst=2, clock=self.clock)
+        for name in 'abcd':
+            scheduler.submit(self._call, name)
+        self.assertEqual(len(self.calls), 2)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.calls), 3)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.calls), 4)
+
+    def testCancelledQueryLeavesQueue(self):
+        httpClient = MockHTTPClient()
+        songkickService = SongkickAPIService("hijklmn", httpClient=httpClient, maxConcurrent=1, clock=self.clock)
+        first = songkickService.songkickLocationByName('los angeles')
+        second = songkickService.songkickLocationByName('narnia')
+        second.addErrback(lambda failure: None)
+        second.cancel()
+        self.assertEqual(songkickService.scheduler.pending, 0)
+        httpClient.requests[0][1].callback('{}')
+        self.assertEqual(first.result, {})
+        self.assertEqual(len(httpClient.requests), 1)
+
+    def testCancelQueued(self):
+        scheduler = QueryScheduler(maxConcurrent=1, clock=self.clock)
+        scheduler.submit(self._call, 'a')
+        queued = scheduler.submit(self._call, 'b')
+        queued.addErrback(lambda failure: None)
+        queued.cancel()
+        self.calls[0][1].callback(None)
+        self.assertEqual([name for name, _ in self.calls], ['a'])
+        self.assertEqual(scheduler.pending, 0)
+
+
+class FakeReactor(MemoryReactor, Clock):
+    def __init__(self):
+        MemoryReactor.__init__(self)
+        Clock.__init__(self)
+
+
+class FakeProcessTransport(object):
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, name):
+        self.signals.append(name)
+
+
+class FakeProcessReactor(FakeReactor):
+    def __init__(self):
+        FakeReactor.__init__(self)
+        self.processes = []
+
+    def spawnProcess(self, processProtocol, executable, args=(), env=None, childFDs=None):
+        processProtocol.transport = FakeProcessTransport()
+        self.processes.append((processProtocol, args, env, childFDs))
+        return processProtocol.transport
+
+
+class TestWorkerSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.supervisor = WorkerSupervisor(0, 2, ['python', 'worker.tac'], env={}, clock=self.reactor)
+        self.sighup = signal.getsignal(signal.SIGHUP)
+        self.supervisor.startService()
+
+    def tearDown(self):
+        signal.signal(signal.SIGHUP, self.sighup)
+        self.supervisor.socket.close()
+
+    def _worker(self, index):
+        return self.reactor.processes[index][0]
+
+    def _end(self, index):
+        self._worker(index).processEnded(Failure(ProcessTerminated(signal='TERM')))
+
+    def testWorkersShareSocket(self):
+        self.assertEqual(len(self.reactor.processes), 2)
+        for processProtocol, args, env, childFDs in self.reactor.processes:
+            self.assertEqual(childFDs[LISTEN_FD], self.supervisor.socket.fileno())
+            self.assertEqual(childFDs[HEARTBEAT_FD], 'r')
+            self.assertEqual(env[LISTEN_FD_ENV], str(LISTEN_FD))
+        self.assertEqual([workerNumber(env) for processProtocol, args, env, childFDs in self.reactor.processes], [0, 1])
+        self.assertEqual(workerNumber({}), None)
+
+    def testMissedHeartbeatKilled(self):
+        for _ in range(7):
+            self.reactor.advance(5)
+            self._worker(0).childDataReceived(HEARTBEAT_FD, '.')
+        self.assertEqual(self._worker(0).transport.signals, [])
+        self.assertEqual(self._worker(1).transport.signals, ['KILL'])
+
+    def testEndedWorkerRestarted(self):
+        self._worker(1).processEnded(Failure(ProcessTerminated(signal='KILL')))
+        self.assertEqual(len(self.reactor.processes), 2)
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertEqual(len(self.reactor.processes), 3)
+        self.assertIs(self.supervisor.processes[1], self._worker(2))
+
+    def testRollingRestart(self):
+        d = self.supervisor.restart()
+        self.assertEqual(len(self.reactor.processes), 3)
+        self.assertEqual((self._worker(0).transport.signals, self._worker(1).transport.signals), (['TERM'], []))
+        self._end(0)
+        self.assertEqual(len(self.reactor.processes), 4)
+        self.assertEqual(self._worker(1).transport.signals, ['TERM'])
+        self._end(1)
+        self.assertTrue(d.called)
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertEqual(len(self.reactor.processes), 4)
+        self.assertEqual(sorted(self.supervisor.processes.values()), sorted([self._worker(2), self._worker(3)]))
+
+    def testStopRetiresWorkers(self):
+        d = self.supervisor.stopService()
+        self._end(0)
+        self.reactor.advance(self.supervisor.stopTimeout)
+        self.assertEqual(self._worker(1).transport.signals, ['TERM', 'KILL'])
+        self.assertFalse(d.called)
+        self._end(1)
+        self.assertTrue(d.called)
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertEqual(len(self.reactor.processes), 2)
+
+
+class TestWorkerService(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.listening = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.heartbeatRead, heartbeatWrite = os.pipe()
+        self.site = Site(Resource())
+        self.worker = WorkerService(self.site, os.dup(self.listening.fileno()), heartbeatWrite, clock=self.reactor)
+        self.worker.startService()
+
+    def tearDown(self):
+        self.listening.close()
+        os.close(self.heartbeatRead)
+        os.close(self.worker.heartbeatFD)
+
+    def testAdoptsPortAndHeartbeats(self):
+        self.assertEqual(self.reactor.adoptedPorts[0][2].wrappedFactory, self.site)
+        self.reactor.advance(self.worker.heartbeatInterval)
+        self.assertEqual(os.read(self.heartbeatRead, 10), '..')
+
+    def testStopDrainsRequests(self):
+        busy = self.worker.factory.buildProtocol(None)
+        busy.makeConnection(StringTransport())
+        busy.wrappedProtocol.requests = ['in progress']
+        idle = self.worker.factory.buildProtocol(None)
+        idle.makeConnection(StringTransport())
+        d = self.worker.stopService()
+        self.assertTrue(idle.transport.disconnecting)
+        self.assertFalse(busy.transport.disconnecting)
+        busy.wrappedProtocol.requests = []
+        busy.connectionLost(Failure(ConnectionDone()))
+        idle.connectionLost(Failure(ConnectionDone()))
+        self.reactor.advance(self.worker.drainPollInterval)
+        self.assertTrue(d.called)
+
+
+class TestPooledHTTPClient(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.client = PooledHTTPClient(maxPerHost=2, readTimeout=10, clock=self.reactor)
+
+    def _respond(self, index, response):
+        factory = self.reactor.tcpClients[index][2]
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(response)
+        return protocol
+
+    def testConnectionReused(self):
+        first = self.client.getPage('http://example.com/a')
+        protocol = self._respond(0, 'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+        self.assertEqual(first.result, 'ok')
+        self.client.getPage('http://example.com/b')
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertIn('GET /b HTTP/1.1', protocol.transport.value())
+
+    def testErrorStatus(self):
+        d = self.client.getPage('http://example.com/a')
+        self._respond(0, 'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 4\r\n\r\nbusy')
+        failures = []
+        d.addErrback(failures.append)
+        self.assertEqual(failures[0].value.status, 503)
+
+    def testReadTimeout(self):
+        d = self.client.getPage('http://example.com/a')
+        protocol = self._respond(0, 'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\npart')
+        failures = []
+        d.addErrback(failures.append)
+        self.reactor.advance(10)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(protocol.transport.producerState, 'stopped')
+        self.assertEqual(self.client.pool._connections, {})
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.singleFlight = SingleFlight()
+        self.calls = []
+
+    def _call(self, key):
+        d = Deferred()
+        self.calls.append(d)
+        return d
+
+    def testCoalesced(self):
+        first = self.singleFlight.call('a', self._call, 'a')
+        second = self.singleFlight.call('a', self._call, 'a')
+        other = self.singleFlight.call('b', self._call, 'b')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual((self.singleFlight.calls, self.singleFlight.coalesced), (3, 1))
+        self.calls[0].callback('response')
+        self.assertEqual((first.result, second.result), ('response', 'response'))
+        self.assertFalse(other.called)
+        self.assertEqual(self.singleFlight.inFlight, 1)
+
+    def testCancelOneWaiter(self):
+        first = self.singleFlight.call('a', self._call, 'a')
+        second = self.singleFlight.call('a', self._call, 'a')
+        first.addErrback(lambda failure: None)
+        first.cancel()
+        self.calls[0].callback('response')
+        self.assertEqual(second.result, 'response')
+
+    def testDeferredQueryCoalesced(self):
+        httpClient = MockHTTPClient()
+        songkickService = SongkickAPIService("hijklmn", memcacheClient=DictionaryCache(), httpClient=httpClient)
+        parameters = songkickService.locationByName('los angeles')
+        first = songkickService._deferredQuery(parameters)
+        second = songkickService._deferredQuery(parameters)
+        self.assertEqual(len(httpClient.requests), 1)
+        httpClient.requests[0][1].callback('{"resultsPage": {"status": "ok"}}')
+        self.assertEqual(first.result, second.result)
+        self.assertEqual(songkickService.singleFlight.coalesced, 1)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def testLRUEvictsByCount(self):
+        cache = LRUCache(maxEntries=2, clock=self.clock)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        cache.get('a')
+        cache.set('c', '3')
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), ('1', None, '3'))
+
+    def testLRUEvictsByBytes(self):
+        cache = LRUCache(maxBytes=10, clock=self.clock)
+        cache.set('a', '1234')
+        cache.set('b', '1234')
+        self.assertEqual(cache.bytes, 10)
+        cache.set('c', '1234')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.bytes, 10)
+        self.assertFalse(cache.set('d', 'x' * 20))
+
+    def testLRUExpiry(self):
+        cache = LRUCache(clock=self.clock)
+        cache.set('a', '1', 10)
+        self.assertFalse(cache.add('a', '2'))
+        self.clock.advance(10)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.bytes, 0)
+
+    def testTieredPromotesRemoteHits(self):
+        remote = DictionaryCache()
+        remote.set('a', '1')
+        cache = TieredCache(LRUCache(clock=self.clock), remote, localTTL=5)
+        self.assertEqual(cache.get('a'), '1')
+        remote.delete('a')
+        self.assertEqual(cache.get('a'), '1')
+        self.clock.advance(5)
+        self.assertEqual(cache.get('a'), None)
+
+    def testTieredWritesBothTiers(self):
+        remote = DictionaryCache()
+        cache = TieredCache(LRUCache(clock=self.clock), remote)
+        cache.set('a', '1', 60)
+        self.assertEqual((cache.local.get('a'), remote.get('a')), ('1', '1'))
+
+
+class TestAsyncMemcacheClient(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.client = AsyncMemcacheClient(clock=self.reactor).connect()
+        self.server = MemcacheServerProtocol()
+        protocol = self.client.factory.buildProtocol(None)
+        self.pump = iosim.connect(self.server, iosim.makeFakeServer(self.server),
+                                  protocol, iosim.makeFakeClient(protocol))
+
+    def _run(self):
+        self.reactor.advance(0)
+        self.pump.flush()
+
+    def testGetsArePipelined(self):
+        self.client.set('a', '1')
+        self.client.set('b', '2')
+        self._run()
+        results = [self.client.get(key) for key in ['a', 'b', 'c', 'a']]
+        self._run()
+        self.assertEqual([d.result for d in results], ['1', '2', None, '1'])
+        self.assertEqual(self.server.commands, ['set', 'set', 'get'])
+
+    def testLongKeysHashed(self):
+        key = 'http://api.songkick.com/api/3.0/events.json?artist_name=' + 'x' * 300
+        self.client.set(key, 'value')
+        self._run()
+        d = self.client.get(key)
+        self._run()
+        self.assertEqual(d.result, 'value')
+        self.assertTrue(self.server.store.keys()[0].startswith('md5:'))
+
+    def testDisconnectedMisses(self):
+        client = AsyncMemcacheClient(clock=self.reactor)
+        self.assertEqual(client.get('a').result, None)
+        self.assertEqual(client.set('a', '1').result, False)
+
+    def testFailedGetCountedAsError(self):
+        self.client.protocol.getMultiple = lambda keys: fail(RuntimeError("timed out"))
+        cache = TieredCache(LRUCache(clock=self.reactor), self.client)
+        errors = metrics.cacheRequests.value(tier='remote', result='error')
+        d = cache.get('a')
+        self._run()
+        self.assertEqual(d.result, None)
+        self.assertEqual(metrics.cacheRequests.value(tier='remote', result='error'), errors + 1)
+        self.assertEqual(self.client.getMultiple(['a']).result, {'a': None})
+
+    def testTieredCacheWithAsyncRemote(self):
+        self.client.set('a', '1')
+        self._run()
+        cache = TieredCache(LRUCache(clock=self.reactor), self.client)
+        d = cache.get('a')
+        self._run()
+        self.assertEqual(d.result, '1')
+        self.assertEqual(cache.get('a'), '1')
+
+    def testCancelledGetDropped(self):
+        self.client.set('a', '1')
+        self._run()
+        cancelled, kept = self.client.get('a'), self.client.get('b')
+        cancelled.cancel()
+        cancelled.addErrback(lambda failure: failure.trap(CancelledError))
+        self._run()
+        self.assertEqual(kept.result, None)
+        self.assertEqual(self.server.commands, ['set', 'get'])
+
+    def testQueryCancelledWhileRemoteGetPending(self):
+        remote = DictionaryCache()
+        pending = []
+        remote.get = lambda key: pending.append(Deferred()) or pending[-1]
+        service = SongkickAPIService("hijklmn", memcacheClient=TieredCache(LRUCache(clock=self.reactor), remote))
+        fetched = []
+        service._fetch = lambda query, parameters, priority=None: fetched.append(query) or Deferred()
+        d = service._deferredQuery(service.locationByName('los angeles'))
+        d.cancel()
+        failures = []
+        d.addErrback(failures.append)
+        self.assertTrue(failures[0].check(CancelledError))
+        self.assertEqual(fetched, [])
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.httpClient = MockHTTPClient()
+        self.cache = DictionaryCache()
+        self.songkickService = SongkickAPIService("hijklmn", memcacheClient=self.cache, httpClient=self.httpClient,
+                                                  clock=self.clock)
+        self.parameters = self.songkickService.locationByName('los angeles')
+        self.parameters.update({'_softTTL': 60, '_ttl': 600})
+
+    def _query(self):
+        return self.songkickService._deferredQuery(self.parameters)
+
+    def testFreshEntryServedFromCache(self):
+        first = self._query()
+        self.httpClient.requests[0][1].callback('{"version": 1}')
+        self.assertEqual(first.result, {'version': 1})
+        self.assertEqual(self._query().result, {'version': 1})
+        self.clock.advance(0)
+        self.assertEqual(len(self.httpClient.requests), 1)
+
+    def testBypassCache(self):
+        self._query()
+        self.httpClient.requests[0][1].callback('{"version": 1}')
+        self.parameters['_bypassCache'] = True
+        bypassed = self._query()
+        self.httpClient.requests[1][1].callback('{"version": 2}')
+        self.assertEqual(bypassed.result, {'version': 2})
+        del self.parameters['_bypassCache']
+        self.assertEqual(self._query().result, {'version': 2})
+
+    def testStaleEntryRefreshedInBackground(self):
+        self._query()
+        self.httpClient.requests[0][1].callback('{"version": 1}')
+        self.clock.advance(61)
+        self.assertEqual(self._query().result, {'version': 1})
+        self.assertEqual(self._query().result, {'version': 1})
+        self.clock.advance(0)
+        self.assertEqual(len(self.httpClient.requests), 2)
+        self.httpClient.requests[1][1].callback('{"version": 2}')
+        self.assertEqual(self._query().result, {'version': 2})
+
+    def testBadRefreshKeepsStaleEntry(self):
+        self._query()
+        self.httpClient.requests[0][1].callback('{"version": 1}')
+        self.clock.advance(61)
+        self._query()
+        self.clock.advance(0)
+        self.httpClient.requests[1][1].callback('<html>oops</html>')
+        self.assertEqual(self._query().result, {'version': 1})
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker('test', failureThreshold=2, resetTimeout=10, maxResetTimeout=30, clock=self.clock)
+
+    def testOpensAfterFailuresInARow(self):
+        self.breaker.failed()
+        self.breaker.succeeded()
+        self.breaker.failed()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failed()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertTrue(self.breaker.isOpen())
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(metrics.circuitState.value(upstream='test'), 2)
+
+    def testHalfOpenProbeBacksOff(self):
+        self.breaker.failed()
+        self.breaker.failed()
+        self.clock.advance(10)
+        self.assertFalse(self.breaker.isOpen())
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.assertFalse(self.breaker.allow())
+        self.breaker.failed()
+        self.clock.advance(10)
+        self.assertFalse(self.breaker.allow())
+        self.clock.advance(10)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.abandoned()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.succeeded()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+
+class TestUpstreamFailures(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.httpClient = MockHTTPClient()
+        self.cache = DictionaryCache()
+        self.lastfmService = LastFMAPIService("abcdefg", memcacheClient=self.cache, httpClient=self.httpClient,
+                                              clock=self.clock)
+        self.lastfmService.breaker.failureThreshold = 2
+
+    def _query(self, artist='Tiga'):
+        return self.lastfmService.lastFMArtistSimilar(artist=artist)
+
+    def _fail(self, index):
+        self.httpClient.requests[index][1].errback(Error('503', 'Service Unavailable'))
+
+    def testFailureCachedBriefly(self):
+        first = self._query()
+        self._fail(0)
+        self.assertEqual(first.result, {})
+        self.assertEqual(self._query().result, {})
+        self.assertEqual(len(self.httpClient.requests), 1)
+        self.clock.advance(self.lastfmService.negativeTTL)
+        self._query()
+        self.assertEqual(len(self.httpClient.requests), 2)
+
+    def testErrorResponseCachedBriefly(self):
+        self._query()
+        self.httpClient.requests[0][1].callback('{"error": 6, "message": "The artist you supplied could not be found"}')
+        self.assertEqual(self._query().result['error'], 6)
+        self.clock.advance(self.lastfmService.errorTTL)
+        self._query()
+        self.clock.advance(0)
+        self.assertEqual(len(self.httpClient.requests), 2)
+
+    def testErrorDoesNotReplaceStaleEntry(self):
+        self._query()
+        self.httpClient.requests[0][1].callback('{"similarartists": {"artist": []}}')
+        self.clock.advance(self.lastfmService.similarSoftTTL)
+        self._query()
+        self.clock.advance(0)
+        self.httpClient.requests[1][1].callback('{"error": 29, "message": "Rate limit exceeded"}')
+        self.assertEqual(self._query().result, {'similarartists': {'artist': []}})
+
+    def testOpenCircuitFailsFast(self):
+        self._query('Tiga')
+        self._query('Green Velvet')
+        self._fail(0)
+        self._fail(1)
+        self.assertEqual(self._query('Boys Noize').result, {})
+        self.assertEqual(len(self.httpClient.requests), 2)
+        self.assertGreater(metrics.upstreamRequests.value(endpoint='lastfm.similar', outcome='rejected'), 0)
+        parameters = self.lastfmService._artistGetSimilar('Boys Noize')
+        failures = []
+        self.lastfmService._fetch(self.lastfmService._cacheKey(parameters), parameters).addErrback(failures.append)
+        self.assertTrue(failures[0].check(CircuitOpenError))
+
+        # once the circuit half opens, one probe goes through, and closes it again
+        self.clock.advance(self.lastfmService.breaker.resetTimeout)
+        probe = self._query('Boys Noize')
+        self.assertEqual(self._query('Tiga Again').result, {})
+        self.assertEqual(len(self.httpClient.requests), 3)
+        self.httpClient.requests[2][1].callback('{"similarartists": {"artist": []}}')
+        self.assertEqual(probe.result, {'similarartists': {'artist': []}})
+        self._query('Tiga Again')
+        self.assertEqual(len(self.httpClient.requests), 4)
+
+    def testClientErrorsDoNotOpenCircuit(self):
+        for index in range(3):
+            self._query('Artist {}'.format(index))
+            self.httpClient.requests[index][1].errback(Error('404', 'Not Found'))
+        self.assertEqual(self.lastfmService.breaker.state, 'closed')
+
+
+class TestCacheKeys(unittest.TestCase):
+    def setUp(self):
+        self.httpClient = MockHTTPClient()
+        self.cache = DictionaryCache()
+        self.songkickService = SongkickAPIService("hijklmn", memcacheClient=self.cache, httpClient=self.httpClient)
+        self.lastfmService = LastFMAPIService("abcdefg", memcacheClient=self.cache, httpClient=self.httpClient)
+
+    def testEquivalentQueriesShareKey(self):
+        key = self.lastfmService._cacheKey(self.lastfmService._artistGetSimilar('Green Velvet'))
+        self.assertEqual(self.lastfmService._cacheKey(self.lastfmService._artistGetSimilar(' GREEN  velvet ')), key)
+        self.assertNotEqual(self.lastfmService._cacheKey(self.lastfmService._artistGetSimilar('Green Velvet', 10)), key)
+        self.assertEqual(self.songkickService._cacheKey(self.songkickService.upcomingEvents('Green+Velvet')),
+                         self.songkickService._cacheKey(self.songkickService.upcomingEvents(u'green velvet')))
+        self.assertNotEqual(self.songkickService._cacheKey(self.songkickService.upcomingEvents('!!!')),
+                            self.songkickService._cacheKey(self.songkickService.upcomingEvents('???')))
+
+    def testKeysNamespacedHashedAndSecretFree(self):
+        key = self.songkickService._cacheKey(self.songkickService.upcomingEvents('x' * 1000))
+        self.assertTrue(key.startswith('songkick.events:'))
+        self.assertLess(len(key), 250)
+        other = SongkickAPIService("anotherkey")
+        self.assertEqual(other._cacheKey(other.upcomingEvents('x' * 1000)), key)
+
+    def testDatesWorkedOutPerCall(self):
+        self.songkickService.clock = Clock()
+        self.songkickService.clock.advance(timegm((2014, 3, 31, 23, 0, 0)))
+        before = self.songkickService.upcomingEvents('Tiga')
+        self.songkickService.clock.advance(60 * 60)
+        after = self.songkickService.upcomingEvents('Tiga')
+        self.assertEqual((after['min_date'], after['max_date']), ('2014-04-01', '2014-07-30'))
+        self.assertNotEqual(self.songkickService._cacheKey(before), self.songkickService._cacheKey(after))
+
+    def testEquivalentQueriesShareFetch(self):
+        first = self.lastfmService.lastFMArtistSimilar(artist='Tiga')
+        second = self.lastfmService.lastFMArtistSimilar(artist='tiga')
+        self.assertEqual(len(self.httpClient.requests), 1)
+        self.assertIn('artist=Tiga', self.httpClient.requests[0][0])
+        self.httpClient.requests[0][1].callback('{"similarartists": {"artist": []}}')
+        self.assertEqual(first.result, second.result)
+        self.assertEqual(self.lastfmService.lastFMArtistSimilar(artist='TIGA').result, first.result)
+        self.assertEqual(len(self.httpClient.requests), 1)
+
+
+class TestCacheCodec(unittest.TestCase):
+    projection = {'resultsPage': {'results': {'event': {'id': True, 'displayName': True}}}}
+    response = {'resultsPage': {'status': 'ok',
+                                'results': {'event': [{'id': 1, 'displayName': u'Tiga at Caf\xe9', 'junk': 'x'}]}}}
+
+    def testProject(self):
+        self.assertEqual(project(self.response, self.projection),
+                         {'resultsPage': {'results': {'event': [{'id': 1, 'displayName': u'Tiga at Caf\xe9'}]}}})
+        self.assertEqual(project(self.response, True), self.response)
+
+    def testRoundTrip(self):
+        entry = encodeValue(self.response)
+        self.assertTrue(entry.startswith('#1m'))
+        self.assertEqual(decodeValue(entry), self.response)
+
+    def testCompressesLargeValues(self):
+        value = {'similarartists': {'artist': [{'name': 'Artist {}'.format(index), 'match': 1.0 / (index + 1)}
+                                               for index in range(1000)]}}
+        entry = encodeValue(value)
+        self.assertTrue(entry.startswith('#1z'))
+        self.assertLess(len(entry), len(json.dumps(value)) / 2)
+        self.assertEqual(decodeValue(entry), value)
+
+    def testLegacyJSONEntries(self):
+        self.assertEqual(decodeValue(json.dumps(self.response), self.projection),
+                         project(self.response, self.projection))
+
+    def testUnknownVersion(self):
+        self.assertRaises(ValueError, decodeValue, '#9m' + encodeValue(self.response)[3:])
+        self.assertRaises(ValueError, decodeValue, '#1zgarbage')
+
+    def testProjectedResponsesCached(self):
+        cache = DictionaryCache()
+        httpClient = MockHTTPClient()
+        songkickService = SongkickAPIService("hijklmn", memcacheClient=cache, httpClient=httpClient)
+        parameters = songkickService.upcomingEvents('Tiga', minDate='2014-01-01', maxDate='2014-05-01')
+        d = songkickService._deferredQuery(parameters)
+        httpClient.requests[0][1].callback(json.dumps(self.response))
+        self.assertNotIn('junk', d.result['resultsPage']['results']['event'][0])
+        entry, staleAt = unpackEntry(cache.cache[songkickService._cacheKey(parameters)])
+        self.assertEqual(decodeValue(entry), d.result)
+        self.assertEqual(songkickService._deferredQuery(parameters).result, d.result)
+        self.assertEqual(len(httpClient.requests), 1)
+
+    def testUnreadableEntryRefetched(self):
+        cache = DictionaryCache()
+        httpClient = MockHTTPClient()
+        songkickService = SongkickAPIService("hijklmn", memcacheClient=cache, httpClient=httpClient)
+        parameters = songkickService.locationByName('los angeles')
+        cache.set(songkickService._cacheKey(parameters), packEntry('#9mold', 0))
+        d = songkickService._deferredQuery(parameters)
+        httpClient.requests[0][1].callback('{"version": 2}')
+        self.assertEqual(d.result, {'version': 2})
+
+
 if __name__ == "__main__":
     unittest.main()